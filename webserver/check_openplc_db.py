@@ -22,6 +22,10 @@ createTablePrograms = r"""CREATE TABLE `Programs` (
 
 insertblankProgram = r"INSERT INTO Programs VALUES (1, 'Blank Program', 'Dummy empty program', 'blank_program.st', 1527184953)"
 
+# the program list pages through uploads newest first, compiles look programs up by file
+createIndexesPrograms = [r"CREATE INDEX IF NOT EXISTS Programs_Date_upload ON Programs (Date_upload, Prog_ID)",
+                         r"CREATE INDEX IF NOT EXISTS Programs_File ON Programs (File)"]
+
 createTableSettings = r"""CREATE TABLE `Settings` (
     `Key`	TEXT NOT NULL UNIQUE,
     `Value`	TEXT NOT NULL,
@@ -91,6 +95,15 @@ def checkTablePrograms(conn):
         cur = conn.cursor()
         cur.execute(insertblankProgram)
         cur.close()
+    checkIndexesPrograms(conn)
+    return
+
+# databases created by older versions don't have the indexes yet
+def checkIndexesPrograms(conn):
+    cur = conn.cursor()
+    for createIndex in createIndexesPrograms:
+        cur.execute(createIndex)
+    cur.close()
     return
 
 def checkTableUsers(conn):
@@ -49,8 +49,6 @@ bool run_enip = 0;
 uint16_t enip_port = 44818;
 bool run_pstorage = 0;
 uint16_t pstorage_polling = 10;
-unsigned char server_command[1024];
-int command_index = 0;
 bool processing_command = 0;
 time_t start_time;
 time_t end_time;
@@ -229,10 +227,45 @@ int listenToClient_interactive(int client_fd, unsigned char *buffer)
     return n;
 }
 
+//-----------------------------------------------------------------------------
+// Write the whole buffer to the client, retrying on partial writes. Returns
+// the number of bytes written or -1 on error
+//-----------------------------------------------------------------------------
+int writeAll_interactive(int client_fd, unsigned char *data, int length)
+{
+    int sent = 0;
+    while (sent < length)
+    {
+        int n = write(client_fd, data + sent, length - sent);
+        if (n < 0)
+        {
+            if (errno == EINTR) continue;
+            return -1;
+        }
+        sent += n;
+    }
+    return sent;
+}
+
+//-----------------------------------------------------------------------------
+// Send a reply to the client. On framed connections the payload is preceded
+// by a "<length>\n" header so that the client knows how much to read
+//-----------------------------------------------------------------------------
+void sendReply_interactive(int client_fd, bool framed, unsigned char *data, int length)
+{
+    if (framed)
+    {
+        char header[32];
+        int header_len = sprintf(header, "%d\n", length);
+        if (writeAll_interactive(client_fd, (unsigned char *)header, header_len) < 0) return;
+    }
+    writeAll_interactive(client_fd, data, length);
+}
+
 //-----------------------------------------------------------------------------
 // Process client's commands for the interactive server
 //-----------------------------------------------------------------------------
-void processCommand(unsigned char *buffer, int client_fd)
+void processCommand(unsigned char *buffer, int client_fd, bool *framed)
 {
     char log_msg[1200];
     int count_char = 0;
@@ -240,11 +273,15 @@ void processCommand(unsigned char *buffer, int client_fd)
     if (processing_command)
     {
         count_char = sprintf(buffer, "Processing command...\n");
-        write(client_fd, buffer, count_char);
+        sendReply_interactive(client_fd, *framed, buffer, count_char);
         return;
     }
     
-    if (strncmp(buffer, "quit()", 6) == 0)
+    if (strncmp(buffer, "framing(", 8) == 0)
+    {
+        *framed = (readCommandArgument(buffer) != 0);
+    }
+    else if (strncmp(buffer, "quit()", 6) == 0)
     {
         processing_command = true;
         sprintf(log_msg, "Issued quit() command\n");
@@ -413,52 +450,65 @@ void processCommand(unsigned char *buffer, int client_fd)
         }
         processing_command = false;
     }
+    // Read-only queries don't take the processing flag, so clients that keep
+    // their connection open are not refused while another one is being served
     else if (strncmp(buffer, "runtime_logs()", 14) == 0)
     {
-        processing_command = true;
         printf("Issued runtime_logs() command\n");
-        write(client_fd, log_buffer, log_index);
-        processing_command = false;
+        sendReply_interactive(client_fd, *framed, log_buffer, log_index);
+        return;
+    }
+    else if (strncmp(buffer, "runtime_logs_since(", 19) == 0)
+    {
+        // Reply is "<next cursor>\n" followed by the logs after the cursor
+        uint64_t cursor = strtoull((char *)&buffer[19], NULL, 10);
+        uint64_t next_cursor;
+        int logs_len;
+        unsigned char *logs = readLogsSince(cursor, &next_cursor, &logs_len);
+        unsigned char *reply = (unsigned char *)malloc(logs_len + 32);
+        count_char = sprintf((char *)reply, "%llu\n", (unsigned long long)next_cursor);
+        memcpy(&reply[count_char], logs, logs_len);
+        sendReply_interactive(client_fd, *framed, reply, count_char + logs_len);
+        free(reply);
+        free(logs);
         return;
     }
     else if (strncmp(buffer, "exec_time()", 11) == 0)
     {
-        processing_command = true;
         time(&end_time);
         count_char = sprintf(buffer, "%llu\n", (unsigned long long)difftime(end_time, start_time));
-        write(client_fd, buffer, count_char);
-        processing_command = false;
+        sendReply_interactive(client_fd, *framed, buffer, count_char);
         return;
     }
     else
     {
-        processing_command = true;
         count_char = sprintf(buffer, "Error: unrecognized command\n");
-        write(client_fd, buffer, count_char);
-        processing_command = false;
+        sendReply_interactive(client_fd, *framed, buffer, count_char);
         return;
     }
     
     count_char = sprintf(buffer, "OK\n");
-    write(client_fd, buffer, count_char);
+    sendReply_interactive(client_fd, *framed, buffer, count_char);
 }
 
 //-----------------------------------------------------------------------------
-// Process client's request
+// Process client's request. The command buffer belongs to the connection, so
+// clients that keep their connection open don't mix up each other's commands
 //-----------------------------------------------------------------------------
-void processMessage_interactive(unsigned char *buffer, int bufferSize, int client_fd)
+void processMessage_interactive(unsigned char *buffer, int bufferSize, int client_fd, unsigned char *server_command, int *command_index, bool *framed)
 {
     for (int i = 0; i < bufferSize; i++)
     {
-        if (buffer[i] == '\r' || buffer[i] == '\n' || command_index >= 1024)
+        if (buffer[i] == '\r' || buffer[i] == '\n' || *command_index >= 1023)
         {
-            processCommand(server_command, client_fd);
-            command_index = 0;
+            processCommand(server_command, client_fd, framed);
+            *command_index = 0;
+            server_command[0] = '\0';
             break;
         }
-        server_command[command_index] = buffer[i];
-        command_index++;
-        server_command[command_index] = '\0';
+        server_command[*command_index] = buffer[i];
+        (*command_index)++;
+        server_command[*command_index] = '\0';
     }
 }
 
@@ -469,6 +519,9 @@ void *handleConnections_interactive(void *arguments)
 {
     int client_fd = *(int *)arguments;
     unsigned char buffer[1024];
+    unsigned char server_command[1024];
+    int command_index = 0;
+    bool framed = false;
     int messageSize;
 
     printf("Interactive Server: Thread created for client ID: %d\n", client_fd);
@@ -493,7 +546,7 @@ void *handleConnections_interactive(void *arguments)
             break;
         }
 
-        processMessage_interactive(buffer, messageSize, client_fd);
+        processMessage_interactive(buffer, messageSize, client_fd, server_command, &command_index, &framed);
     }
     //printf("Debug: Closing client socket and calling pthread_exit in interactive_server.cpp\n");
     closeSocket(client_fd);
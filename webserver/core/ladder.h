@@ -113,6 +113,7 @@ void updateBuffersOut();
 void sleep_until(struct timespec *ts, long long delay);
 void sleepms(int milliseconds);
 void log(char *logmsg);
+unsigned char *readLogsSince(uint64_t cursor, uint64_t *next_cursor, int *length);
 void handleSpecialFunctions();
 void timespec_diff(struct timespec *a, struct timespec *b, struct timespec *result);
 void *interactiveServerThread(void *arg);
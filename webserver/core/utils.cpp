@@ -36,6 +36,7 @@ pthread_mutex_t logLock; //mutex for the internal log
 unsigned char log_buffer[1000000]; //A very large buffer to store all logs
 int log_index = 0;
 int log_counter = 0;
+uint64_t log_base = 0; //Absolute offset in the log stream of log_buffer[0]
 int64_t cycle_counter = 0;
 uint8_t rpi_modbus_rts_pin;     // If <> 0, expect hardware RTS to be used with this pin
 
@@ -122,6 +123,7 @@ void log(char *logmsg)
     if (log_index + msg_len >= sizeof(log_buffer) - 1)
     {
         // Buffer overflow protection: clear the buffer if it's nearly full
+        log_base += log_index;
         log_index = 0;
     }
 
@@ -134,12 +136,48 @@ void log(char *logmsg)
     {
         // Clear log buffer
         log_counter = 0;
+        log_base += log_index;
         log_index = 0;
     }
 
     pthread_mutex_unlock(&logLock); // unlock mutex
 }
 
+/**
+ * @brief Copies the log messages appended after a given cursor
+ *
+ * Cursors are absolute offsets in the log stream, so they stay valid when
+ * the log buffer is cleared. A cursor pointing before the retained logs, or
+ * past the end of the stream (e.g. after a runtime restart), starts over
+ * from the oldest retained message.
+ *
+ * @param cursor Value of next_cursor from a previous call, or 0 for all logs
+ * @param next_cursor Receives the cursor to be used on the next call
+ * @param length Receives the number of bytes copied
+ * @return Newly allocated copy of the log slice (to be freed by the caller)
+ */
+unsigned char *readLogsSince(uint64_t cursor, uint64_t *next_cursor, int *length)
+{
+    pthread_mutex_lock(&logLock); // lock mutex
+
+    uint64_t log_end = log_base + log_index;
+    int start = 0;
+    if (cursor >= log_base && cursor <= log_end)
+    {
+        start = (int)(cursor - log_base);
+    }
+
+    *length = log_index - start;
+    *next_cursor = log_end;
+    unsigned char *logs = (unsigned char *)malloc(*length + 1);
+    memcpy(logs, &log_buffer[start], *length);
+    logs[*length] = '\0';
+
+    pthread_mutex_unlock(&logLock); // unlock mutex
+
+    return logs;
+}
+
 /**
  * @brief Creates the server to listen to commands on localhost
  *
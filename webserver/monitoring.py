@@ -1,4 +1,6 @@
-import time, threading
+import time, threading, math
+from array import array
+from bisect import bisect_left, bisect_right
 from struct import *
 from pymodbus.client.sync import ModbusTcpClient
 
@@ -8,17 +10,67 @@ class debug_var():
     type = ''
     forced = 'No'
     value = 0
+    address = None
+    seq = 0
+    history = None
 
 debug_vars = []
 monitor_active = False
 mb_client = None
+read_plan = None
+
+# Guards debug_vars, read_plan and vars_version, which parse_st replaces as a
+# set while the poller may be reading them
+vars_lock = threading.Lock()
+
+# Every poll that changes a value bumps change_seq and stamps the changed
+# variables with it, starting at 1 so that 0 can ask for every variable.
+# vars_version changes whenever debug_vars is reloaded
+change_seq = 1
+vars_version = 0
+
+# Notified whenever change_seq moves, so that push viewers don't have to poll
+monitor_changed = threading.Condition()
+monitor_viewers = 0
+
+# Poller thread state. monitor_lock serializes start_monitor/stop_monitor so
+# that only one poller can ever be running
+monitor_period = 0.5
+monitor_thread = None
+monitor_stop = None
+monitor_port = None
+monitor_lock = threading.Lock()
+
+# Set while the runtime is running with Modbus enabled. The poller then keeps
+# sampling history with nobody watching, and pages can't stop it
+history_recording = False
+poll_count = 0
+missed_deadlines = 0
+
+# Number of samples kept per variable. At the default period this covers the
+# last 10 minutes
+history_depth = 1200
+history_lock = threading.Lock()
+
+# History buffers by (name, location, type). Reloading the program keeps the
+# buffers of the variables that are still there
+histories = {}
+
+# Modbus limits for the amount of data a single read request may return
+max_read_bits = 2000
+max_read_registers = 125
 
 def parse_st(st_file):
     global debug_vars
+    global read_plan
+    global vars_version
     filepath = './st_files/' + st_file
     
     st_program = open(filepath, 'r')
     
+    # The new variables and their read plan are built aside and swapped in
+    # at once, the poller keeps using the old ones until then
+    new_vars = []
     for line in st_program.readlines():
         if line.find(' AT ') > 0 and line.find('%') > 0 and line.find('(*') < 0 and line.find('*)') < 0:
             debug_data = debug_var()
@@ -31,11 +83,31 @@ def parse_st(st_file):
             if (debug_data.location.find('ML')) > 0:
                 mb_address = debug_data.location.split('%ML')[1]
                 if (int(mb_address) < 1024):
-                    debug_vars.append(debug_data)
+                    new_vars.append(debug_data)
             else:
-                debug_vars.append(debug_data)
+                new_vars.append(debug_data)
+            
+            # Parse the location only once, the monitor loop reads from the
+            # compiled address
+            debug_data.address = compile_address(debug_data)
+    st_program.close()
+    
+    new_histories = {}
+    for debug_data in new_vars:
+        key = (debug_data.name, debug_data.location, debug_data.type)
+        if key not in new_histories:
+            new_histories[key] = histories.get(key) or tag_history(history_depth)
+        debug_data.history = new_histories[key]
     
-    for debugs in debug_vars:
+    new_plan = build_read_plan(new_vars)
+    with vars_lock:
+        histories.clear()
+        histories.update(new_histories)
+        debug_vars = new_vars
+        read_plan = new_plan
+        vars_version += 1
+    
+    for debugs in new_vars:
         print('Name: ' + debugs.name)
         print('Location: ' + debugs.location)
         print('Type: ' + debugs.type)
@@ -43,85 +115,335 @@ def parse_st(st_file):
 
 
 def cleanup():
-    del debug_vars[:]
+    global debug_vars
+    global read_plan
+    global vars_version
+    with vars_lock:
+        debug_vars = []
+        read_plan = None
+        vars_version += 1
     
-def modbus_monitor():
-    global mb_client
-    for debug_data in debug_vars:
-        if (debug_data.location.find('IX')) > 0:
-            #Reading Input Status
-            mb_address = debug_data.location.split('%IX')[1].split('.')
-            result = mb_client.read_discrete_inputs(int(mb_address[0])*8 + int(mb_address[1]), 1)
-            debug_data.value = result.bits[0]
-            
-        elif (debug_data.location.find('QX')) > 0:
-            #Reading Coils
-            mb_address = debug_data.location.split('%QX')[1].split('.')
-            if (len(mb_address) < 2):
-                result = mb_client.read_coils(int(mb_address[0])*8, 1)
+# Modbus tables a located variable can be read from
+AREA_DISCRETE_INPUTS = 0
+AREA_COILS = 1
+AREA_INPUT_REGISTERS = 2
+AREA_HOLDING_REGISTERS = 3
+
+signed_types = ('SINT', 'INT', 'DINT', 'LINT')
+unsigned_types = ('USINT', 'UINT', 'UDINT', 'ULINT')
+float_types = ('REAL', 'LREAL')
+
+pack_2_registers = Struct('>HH')
+pack_4_registers = Struct('>HHHH')
+
+def struct_decoder(packer, unpacker):
+    def decode(values, offset):
+        return unpacker.unpack(packer.pack(*values[offset:offset + packer.size // 2]))[0]
+    return decode
+
+def decode_single(values, offset):
+    return values[offset]
+
+def decode_signed_single(values, offset):
+    value = values[offset]
+    return value - 65536 if value > 32767 else value
+
+decoders_2_registers = {}
+decoders_4_registers = {}
+for var_type in signed_types:
+    decoders_2_registers[var_type] = struct_decoder(pack_2_registers, Struct('>i'))
+    decoders_4_registers[var_type] = struct_decoder(pack_4_registers, Struct('>q'))
+for var_type in unsigned_types:
+    decoders_2_registers[var_type] = struct_decoder(pack_2_registers, Struct('>I'))
+    decoders_4_registers[var_type] = struct_decoder(pack_4_registers, Struct('>Q'))
+for var_type in float_types:
+    decoders_2_registers[var_type] = struct_decoder(pack_2_registers, Struct('>f'))
+    decoders_4_registers[var_type] = struct_decoder(pack_4_registers, Struct('>d'))
+# %MD can't hold 64-bit types
+for var_type in ('LINT', 'ULINT', 'LREAL'):
+    del decoders_2_registers[var_type]
+
+class address_record():
+    '''
+    Compiled Modbus location of a debug variable: the area it lives in, the
+    first bit/register, how many of them it spans and the function that turns
+    them into the variable value
+    '''
+    __slots__ = ('area', 'start', 'count', 'decode')
+    
+    def __init__(self, area, start, count, decode):
+        self.area = area
+        self.start = start
+        self.count = count
+        self.decode = decode
+
+def compile_address(debug_data):
+    '''
+    Parses the location and type of a debug variable into an address_record.
+    Returns None for variables that can't be monitored
+    '''
+    location = debug_data.location
+    if (location.find('IX')) > 0 or (location.find('QX')) > 0:
+        mb_address = location[3:].split('.')
+        bit = int(mb_address[1]) if len(mb_address) > 1 else 0
+        area = AREA_DISCRETE_INPUTS if (location.find('IX')) > 0 else AREA_COILS
+        return address_record(area, int(mb_address[0])*8 + bit, 1, decode_single)
+    
+    elif (location.find('IW')) > 0:
+        decode = decode_signed_single if (debug_data.type == 'INT') else decode_single
+        return address_record(AREA_INPUT_REGISTERS, int(location.split('%IW')[1]), 1, decode)
+    
+    elif (location.find('QW')) > 0:
+        decode = decode_signed_single if (debug_data.type == 'INT') else decode_single
+        return address_record(AREA_HOLDING_REGISTERS, int(location.split('%QW')[1]), 1, decode)
+    
+    elif (location.find('MW')) > 0:
+        decode = decode_signed_single if (debug_data.type == 'INT') else decode_single
+        return address_record(AREA_HOLDING_REGISTERS, int(location.split('%MW')[1]) + 1024, 1, decode)
+    
+    elif (location.find('MD')) > 0:
+        decode = decoders_2_registers.get(debug_data.type)
+        if decode is not None:
+            return address_record(AREA_HOLDING_REGISTERS, (int(location.split('%MD')[1])*2) + 2048, 2, decode)
+    
+    elif (location.find('ML')) > 0:
+        decode = decoders_4_registers.get(debug_data.type)
+        if decode is not None:
+            return address_record(AREA_HOLDING_REGISTERS, (int(location.split('%ML')[1])*4) + 4096, 4, decode)
+    
+    return None
+
+class tag_history():
+    '''
+    Fixed size ring buffer with the last samples of a variable. Timestamps
+    and values are kept in flat arrays, so memory doesn't grow with uptime
+    '''
+    __slots__ = ('times', 'values', 'index', 'count')
+    
+    def __init__(self, depth):
+        self.times = array('d', bytes(8 * depth))
+        self.values = array('d', bytes(8 * depth))
+        self.index = 0
+        self.count = 0
+    
+    def append(self, timestamp, value):
+        self.times[self.index] = timestamp
+        self.values[self.index] = value
+        self.index += 1
+        if (self.index == len(self.times)):
+            self.index = 0
+        if (self.count < len(self.times)):
+            self.count += 1
+    
+    def window(self, start, end):
+        '''
+        Returns (times, values) arrays with the samples taken between start
+        and end, oldest first
+        '''
+        with history_lock:
+            if (self.count < len(self.times)):
+                times = self.times[:self.count]
+                values = self.values[:self.count]
             else:
-                result = mb_client.read_coils(int(mb_address[0])*8 + int(mb_address[1]), 1)
-            debug_data.value = result.bits[0]
-            
-        elif (debug_data.location.find('IW')) > 0:
-            #Reading Input Registers
-            mb_address = debug_data.location.split('%IW')[1]
-            result = mb_client.read_input_registers(int(mb_address), 1)
-            debug_data.value = result.registers[0]
-            
-        elif (debug_data.location.find('QW')) > 0:
-            #Reading Holding Registers
-            mb_address = debug_data.location.split('%QW')[1]
-            result = mb_client.read_holding_registers(int(mb_address), 1)
-            debug_data.value = result.registers[0]
-            
-        elif (debug_data.location.find('MW')) > 0:
-            #Reading Word Memory
-            mb_address = debug_data.location.split('%MW')[1]
-            result = mb_client.read_holding_registers(int(mb_address) + 1024, 1)
-            debug_data.value = result.registers[0]
-            
-        elif (debug_data.location.find('MD')) > 0:
-            #Reading Double Memory
-            mb_address = debug_data.location.split('%MD')[1]
-            result = mb_client.read_holding_registers((int(mb_address)*2) + 2048, 2)
-            if (debug_data.type == 'SINT') or (debug_data.type == 'INT') or (debug_data.type == 'DINT'):
-                #signed integer
-                float_pack = pack('>HH', result.registers[0], result.registers[1])
-                debug_data.value = unpack('>i', float_pack)[0]
-                
-            if (debug_data.type == 'USINT') or (debug_data.type == 'UINT') or (debug_data.type == 'UDINT'):
-                #unsigned integer
-                float_pack = pack('>HH', result.registers[0], result.registers[1])
-                debug_data.value = unpack('>I', float_pack)[0]
-                
-            if (debug_data.type == 'REAL'):
-                #32-bit float
-                float_pack = pack('>HH', result.registers[0], result.registers[1])
-                debug_data.value = unpack('>f', float_pack)[0]
-                
-        elif (debug_data.location.find('ML')) > 0:
-            #Reading Long Memory
-            mb_address = debug_data.location.split('%ML')[1]
-            result = mb_client.read_holding_registers((int(mb_address)*4) + 4096, 4)
-            if (debug_data.type == 'SINT') or (debug_data.type == 'INT') or (debug_data.type == 'DINT') or (debug_data.type == 'LINT'):
-                #signed integer
-                float_pack = pack('>HHHH', result.registers[0], result.registers[1], result.registers[2], result.registers[3])
-                debug_data.value = unpack('>q', float_pack)[0]
-                
-            if (debug_data.type == 'USINT') or (debug_data.type == 'UINT') or (debug_data.type == 'UDINT') or (debug_data.type == 'ULINT'):
-                #unsigned integer
-                float_pack = pack('>HHHH', result.registers[0], result.registers[1], result.registers[2], result.registers[3])
-                debug_data.value = unpack('>Q', float_pack)[0]
-                
-            if (debug_data.type == 'REAL') or (debug_data.type == 'LREAL'):
-                #64-bit float
-                float_pack = pack('>HHHH', result.registers[0], result.registers[1], result.registers[2], result.registers[3])
-                debug_data.value = unpack('>d', float_pack)[0]
-            
+                times = self.times[self.index:] + self.times[:self.index]
+                values = self.values[self.index:] + self.values[:self.index]
+        first = bisect_left(times, start)
+        last = bisect_right(times, end)
+        return times[first:last], values[first:last]
+
+def finite_or_none(value):
+    '''
+    NaN and infinite REAL values have no JSON representation, they are sent
+    as null
+    '''
+    return value if math.isfinite(value) else None
+
+def downsample(times, values, start, end, buckets):
+    '''
+    Splits [start, end] into buckets of the same length and returns a
+    [bucket_start, min, max, avg] list for every bucket that has samples.
+    Samples that are not finite numbers are left out
+    '''
+    result = []
+    width = (end - start) / buckets
+    if not (width > 0) or not math.isfinite(width):
+        return result
+    current = None
+    for (timestamp, value) in zip(times, values):
+        if not math.isfinite(value):
+            continue
+        bucket = min(int((timestamp - start) / width), buckets - 1)
+        if (current is None) or (bucket != current[0]):
+            current = [bucket, value, value, 0.0, 0]
+            result.append(current)
+        if (value < current[1]):
+            current[1] = value
+        if (value > current[2]):
+            current[2] = value
+        current[3] += value
+        current[4] += 1
+    return [[start + bucket * width, low, high, total / count] for (bucket, low, high, total, count) in result]
+
+def build_read_plan(variables):
+    '''
+    Groups the variables by Modbus area and merges them into as few read
+    requests as the PDU limits allow. Returns a list of
+    (read_function, start, count, is_bits, [(debug_data, offset, decode), ...])
+    requests, where offset is the position of the variable inside the
+    request's result.
+    '''
+    by_area = {}
+    for debug_data in variables:
+        address = debug_data.address
+        if address is not None:
+            by_area.setdefault(address.area, []).append((address, debug_data))
     
-    if (monitor_active == True):
-        threading.Timer(0.5, modbus_monitor).start()
+    plan = []
+    for area, points in by_area.items():
+        is_bits = area in (AREA_DISCRETE_INPUTS, AREA_COILS)
+        max_count = max_read_bits if is_bits else max_read_registers
+        points.sort(key = lambda point: point[0].start)
+        request = None
+        for (address, debug_data) in points:
+            end = address.start + address.count
+            # Addresses in between are read too: a slightly bigger reply is
+            # far cheaper than another round trip
+            if request is None or end - request[1] > max_count:
+                request = [area, address.start, 0, is_bits, []]
+                plan.append(request)
+            request[2] = max(request[2], end - request[1])
+            request[4].append((debug_data, address.start - request[1], address.decode))
+    
+    return [tuple(request) for request in plan]
+
+def current_read_plan():
+    '''
+    Returns the read plan of the variables loaded right now, building it if
+    needed. The plan holds the debug_var objects themselves, so a poll that
+    is still running on an old plan only updates variables nobody shows
+    anymore
+    '''
+    global read_plan
+    with vars_lock:
+        if read_plan is None:
+            read_plan = build_read_plan(debug_vars)
+        return read_plan
+
+def modbus_monitor(client = None):
+    global mb_client
+    global change_seq
+    if client is None:
+        client = mb_client
+    plan = current_read_plan()
+    
+    new_seq = change_seq + 1
+    changed = False
+    now = time.time()
+    read_functions = (client.read_discrete_inputs, client.read_coils,
+                      client.read_input_registers, client.read_holding_registers)
+    for (area, start, count, is_bits, points) in plan:
+        result = read_functions[area](start, count)
+        if result.isError():
+            continue
+        
+        values = result.bits if is_bits else result.registers
+        with history_lock:
+            for (debug_data, offset, decode) in points:
+                value = decode(values, offset)
+                if (value != debug_data.value):
+                    debug_data.value = value
+                    debug_data.seq = new_seq
+                    changed = True
+                if (debug_data.history is not None):
+                    debug_data.history.append(now, value)
+    
+    # Published last, so that readers never see a sequence number whose
+    # variables are not stamped yet
+    if changed:
+        with monitor_changed:
+            change_seq = new_seq
+            monitor_changed.notify_all()
+
+def snapshot():
+    '''
+    Returns (vars_version, debug_vars) as one consistent pair. The list is
+    replaced, never changed in place, when a program is loaded
+    '''
+    with vars_lock:
+        return vars_version, debug_vars
+
+def changes_since(seq):
+    '''
+    Returns a (vars_version, current_seq, [(index, debug_data), ...]) tuple
+    with the variables that changed after seq. Passing 0, or a seq from
+    before the webserver restarted, returns every variable.
+    '''
+    current_seq = change_seq
+    (version, variables) = snapshot()
+    if (seq <= 0) or (seq > current_seq):
+        return version, current_seq, list(enumerate(variables))
+    return version, current_seq, [(index, debug_data) for (index, debug_data) in enumerate(variables) if debug_data.seq > seq]
+
+def wait_for_changes(seq, timeout):
+    '''
+    Blocks until a poll changes a value after seq or timeout seconds pass.
+    Returns the current change_seq
+    '''
+    with monitor_changed:
+        monitor_changed.wait_for(lambda: change_seq > seq, timeout)
+        return change_seq
+
+def add_viewer():
+    '''
+    Registers a push viewer. The monitor keeps running while there are
+    viewers, even if another page asks to stop it
+    '''
+    global monitor_viewers
+    with monitor_lock:
+        monitor_viewers += 1
+
+def remove_viewer():
+    global monitor_viewers
+    with monitor_lock:
+        monitor_viewers -= 1
+        last_viewer = (monitor_viewers == 0)
+    if last_viewer:
+        stop_monitor()
+
+def monitor_loop(stop_event, client):
+    '''
+    Polls the runtime every monitor_period seconds until stop_event is set.
+    Deadlines are kept on a fixed grid, so a slow poll doesn't make the
+    following ones drift. Polls that couldn't start on time are skipped and
+    counted in missed_deadlines instead of being run back to back. The
+    client belongs to this poller and is closed when it stops.
+    '''
+    global poll_count
+    global missed_deadlines
+    last_error = None
+    next_deadline = time.monotonic()
+    
+    while not stop_event.is_set():
+        try:
+            modbus_monitor(client)
+            last_error = None
+        except Exception as e:
+            # Keep polling, the runtime may just be restarting. Only report
+            # the error once instead of on every cycle
+            if (str(e) != last_error):
+                last_error = str(e)
+                print('Monitor poll failed: ' + last_error)
+        poll_count += 1
+        
+        next_deadline += monitor_period
+        now = time.monotonic()
+        if (now > next_deadline):
+            missed = int((now - next_deadline) // monitor_period) + 1
+            missed_deadlines += missed
+            next_deadline += missed * monitor_period
+        stop_event.wait(next_deadline - now)
+    
+    client.close()
 
 def write_value(point_address, point_value):
     global mb_client
@@ -134,20 +456,61 @@ def write_value(point_address, point_value):
         else:
             result = mb_client.write_coil(int(mb_address[0])*8 + int(mb_address[1]), int(point_value))
     
-def start_monitor(modbus_port_cfg):
+def start_monitor(modbus_port_cfg, period = None):
     global monitor_active
     global mb_client
+    global monitor_period
+    global monitor_thread
+    global monitor_stop
+    global monitor_port
     
-    if (monitor_active != True):
-        monitor_active = True
-        mb_client = ModbusTcpClient('127.0.0.1', port=modbus_port_cfg)
-        
-        modbus_monitor()
+    with monitor_lock:
+        if (period is not None):
+            monitor_period = period
+        if (monitor_active == True) and (monitor_port != modbus_port_cfg):
+            # Modbus moved to another port, the old poller can't reach it
+            monitor_stop.set()
+            monitor_active = False
+        if (monitor_active != True):
+            monitor_active = True
+            monitor_port = modbus_port_cfg
+            mb_client = ModbusTcpClient('127.0.0.1', port=modbus_port_cfg)
+            
+            # Each poller gets its own stop event, so a poller that is still
+            # winding down can't be revived by a later start
+            monitor_stop = threading.Event()
+            monitor_thread = threading.Thread(target = monitor_loop, args = (monitor_stop, mb_client))
+            monitor_thread.daemon = True
+            monitor_thread.start()
+
+def start_recording(modbus_port_cfg):
+    '''
+    Keeps the poller running, and so the history filling, until
+    stop_recording() is called. Meant to be called when the runtime starts
+    with its Modbus server enabled
+    '''
+    global history_recording
+    with monitor_lock:
+        history_recording = True
+    start_monitor(modbus_port_cfg)
+
+def stop_recording():
+    global history_recording
+    with monitor_lock:
+        history_recording = False
+    stop_monitor()
 
 def stop_monitor():
+    '''
+    Tells the poller to stop without waiting for it. An in-flight poll
+    finishes in the background and the poller closes its own client, so
+    page handlers calling this never block on a slow Modbus read.
+    '''
     global monitor_active
-    global mb_client
+    global monitor_thread
     
-    if (monitor_active != False):
-        monitor_active = False
-        mb_client.close()
\ No newline at end of file
+    with monitor_lock:
+        if (monitor_active != False) and (monitor_viewers == 0) and not history_recording:
+            monitor_active = False
+            monitor_stop.set()
+            monitor_thread = None
\ No newline at end of file
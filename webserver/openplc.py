@@ -1,11 +1,11 @@
 #Use this for OpenPLC console: http://eyalarubas.com/python-subproc-nonblock.html
 import subprocess
 import socket
-import errno
+import select
 import time
-from threading import Thread
-from queue import Queue, Empty
+from threading import Thread, Lock, Event, Condition
 import os.path
+import shutil
 
 intervals = (
     ('weeks', 604800),  # 60 * 60 * 24 * 7
@@ -27,47 +27,335 @@ def display_time(seconds, granularity=2):
             result.append("{} {}".format(value, name))
     return ', '.join(result[:granularity])
 
-class NonBlockingStreamReader:
+# Lines printed by compile_program.sh when it moves on to another stage
+compile_stages = {
+    'Program was built before, restoring cached build...': 'cache',
+    'Generating C files...': 'iec2c',
+    'Moving Files...': 'prepare',
+    'Generating glueVars...': 'glue',
+    'Generating object files...': 'compile',
+    'Compiling main program...': 'link',
+}
 
-    end_of_stream = False
-    
-    def __init__(self, stream):
+# Files in core/ a build writes for the program, on top of the binary. A hot
+# swap keeps the running program's copies in previous_build_dir until the new
+# one is running
+generated_files = ('POUS.c', 'POUS.h', 'LOCATED_VARIABLES.h', 'VARIABLES.csv', 'Config0.c', 'Config0.h', 'Res0.c', 'glueVars.cpp', 'debug.cpp')
+previous_build_dir = './core/previous'
+
+def read_file(path):
+    '''
+    Returns the contents of a text file, or None if it can't be read
+    '''
+    try:
+        with open(path, 'r') as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+class CompileJob:
+    '''
+    A program build, from the moment it is queued until the compile script
+    exits. Keeps the script output and how long each stage took.
+    '''
+
+    def __init__(self, job_id, st_file, project_name = '', project_description = '', hot_swap = False, after_swap = None):
+        self.id = job_id
+        self.st_file = st_file
+        self.project_name = project_name
+        self.project_description = project_description
+        self.hot_swap = hot_swap
+        self.after_swap = after_swap
+        self.state = 'queued'
+        self.exit_code = None
+        self.queued_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.stages = []
+        self.log = []
+        self._output = Condition()
+
+    def start(self):
+        self.state = 'running'
+        self.started_at = time.time()
+        self.start_stage('setup')
+
+    def start_stage(self, name):
+        now = time.time()
+        if self.stages and self.stages[-1]['finished_at'] is None:
+            self.stages[-1]['finished_at'] = now
+        self.stages.append({'name': name, 'started_at': now, 'finished_at': None, 'units': []})
+
+    def add_line(self, line):
+        with self._output:
+            self.log.append(line)
+            self._output.notify_all()
+        text = line.strip()
+        if text in compile_stages:
+            self.start_stage(compile_stages[text])
+        elif text.startswith('Compiling ') and self.stages and self.stages[-1]['name'] == 'compile':
+            self.stages[-1]['units'].append(text[len('Compiling '):])
+
+    def finish(self, exit_code):
+        self.finished_at = time.time()
+        if self.stages and self.stages[-1]['finished_at'] is None:
+            self.stages[-1]['finished_at'] = self.finished_at
+        self.exit_code = exit_code
+        with self._output:
+            self.state = 'succeeded' if exit_code == 0 else 'failed'
+            self._output.notify_all()
+
+    def output_since(self, cursor):
         '''
-        stream: the stream to read from.
-                Usually a process' stdout or stderr.
+        Returns a (next_cursor, text, done) tuple with the output lines after
+        cursor. done is True once the build is over and text holds its last
+        lines.
+        '''
+        with self._output:
+            if cursor > len(self.log):
+                cursor = 0
+            return len(self.log), ''.join(self.log[cursor:]), self.done
+
+    def wait_for_output(self, cursor, timeout):
         '''
+        Blocks until there are lines after cursor, the build is over or
+        timeout seconds pass
+        '''
+        with self._output:
+            self._output.wait_for(lambda: len(self.log) > cursor or self.done, timeout)
+
+    @property
+    def done(self):
+        return self.state in ('succeeded', 'failed')
+
+    def to_dict(self, logs = False):
+        job = {
+            'id': self.id,
+            'file': self.st_file,
+            'hot_swap': self.hot_swap,
+            'state': self.state,
+            'exit_code': self.exit_code,
+            'queued_at': self.queued_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'stages': [dict(stage, duration = (stage['finished_at'] - stage['started_at']) if stage['finished_at'] else None) for stage in self.stages],
+        }
+        if logs:
+            job['log'] = ''.join(self.log)
+        return job
+
+class CompileQueue:
+    '''
+    Runs compile jobs one at a time, in the order they were submitted, on a
+    worker thread that only lives while there is something to build. The
+    last max_finished finished jobs are kept around for the status API.
+    '''
+
+    def __init__(self, max_finished = 20):
+        self._max_finished = max_finished
+        self._jobs = []
+        self._pending = []
+        self._next_id = 1
+        self._worker = None
+        self._lock = Lock()
+
+    def submit(self, st_file, runner, project_name = '', project_description = '', hot_swap = False, after_swap = None):
+        '''
+        Queues a build of st_file, run by calling runner(job). If that file is
+        already waiting for its turn the same way (hot swap or not), the
+        queued job is returned instead of building it twice.
+        '''
+        with self._lock:
+            for (job, job_runner) in self._pending:
+                if (job.st_file == st_file) and (job.hot_swap == hot_swap):
+                    return job
+            job = CompileJob(self._next_id, st_file, project_name, project_description, hot_swap, after_swap)
+            self._next_id += 1
+            self._jobs.append(job)
+            self._pending.append((job, runner))
+            if self._worker is None:
+                self._worker = Thread(target = self._work)
+                self._worker.daemon = True
+                self._worker.start()
+            return job
+
+    def _work(self):
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._worker = None
+                    return
+                (job, runner) = self._pending.pop(0)
+            job.start()
+            try:
+                runner(job)
+            except Exception as e:
+                job.add_line(f'Error running the build: {e}\n')
+                job.add_line('Compilation finished with errors!\n')
+                job.finish(-1)
+            with self._lock:
+                finished = [old_job for old_job in self._jobs if old_job.done]
+                for old_job in finished[:-self._max_finished]:
+                    self._jobs.remove(old_job)
+
+    def busy(self):
+        with self._lock:
+            return any(not job.done for job in self._jobs)
+
+    def building(self, st_file):
+        '''
+        True while a queued or running job still needs st_file
+        '''
+        with self._lock:
+            return any((not job.done) and (job.st_file == st_file) for job in self._jobs)
+
+    def jobs(self):
+        with self._lock:
+            return list(self._jobs)
+
+    def get(self, job_id):
+        with self._lock:
+            for job in self._jobs:
+                if job.id == job_id:
+                    return job
+        return None
+
+    def latest(self):
+        with self._lock:
+            return self._jobs[-1] if self._jobs else None
 
-        self._s = stream
-        self._q = Queue()
+class RequestNotSent(socket.error):
+    '''
+    Raised when a request failed before any of it reached the runtime, so it
+    is safe to send it again on another connection
+    '''
 
-        def _populateQueue(stream, queue):
-            '''
-            Collect lines from 'stream' and put them in 'queue'.
-            '''
+class RuntimeConnection:
+    '''
+    A single connection to the runtime interactive server. The connection
+    asks the runtime for framed replies ("<length>\\n<payload>") so that
+    replies spanning several segments are read completely. Runtimes built
+    before framing existed answer the request with an error, in which case
+    the connection falls back to a single recv per reply and is not reused.
+    '''
 
-            #while True:
-            while (self.end_of_stream == False):
-                line = stream.readline().decode('utf-8')
-                if line:
-                    queue.put(line)
-                    if "Compilation finished with errors!" in line or "Compilation finished successfully!" in line:
-                        self.end_of_stream = True
-                else:
-                    self.end_of_stream = True
-                    raise UnexpectedEndOfStream
+    max_header_size = 32
+    max_reply_size = 2 * 1024 * 1024
 
-        self._t = Thread(target = _populateQueue, args = (self._s, self._q))
-        self._t.daemon = True
-        self._t.start() #start collecting lines from the stream
+    def __init__(self, host, port, timeout):
+        self.sock = socket.create_connection((host, port), timeout = timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._rfile = self.sock.makefile('rb')
+        self.framed = False
+        self._negotiate_framing()
 
-    def readline(self, timeout = None):
+    def _negotiate_framing(self):
+        self.sock.sendall(b'framing(1)\n')
+        header = self._rfile.readline(self.max_header_size)
+        if not header:
+            raise socket.error('connection closed by the runtime')
+        if header.strip().isdigit():
+            self._read_exactly(int(header))
+            self.framed = True
+
+    def _read_exactly(self, length):
+        if length > self.max_reply_size:
+            raise socket.error(f'reply of {length} bytes exceeds the limit')
+        payload = self._rfile.read(length)
+        if len(payload) < length:
+            raise socket.error('connection closed by the runtime')
+        return payload
+
+    @property
+    def reusable(self):
+        return self.framed
+
+    def is_stale(self):
+        '''
+        True when the runtime closed the connection (or sent something nobody
+        asked for) while it sat idle in the pool
+        '''
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+        except (socket.error, ValueError):
+            return True
+        return bool(readable)
+
+    def request(self, msg, max_size):
+        data = f'{msg}\n'.encode('utf-8')
+        # A failed send() transferred nothing, past that point the runtime
+        # may already be running the command
         try:
-            return self._q.get(block = timeout is not None,
-                    timeout = timeout)
-        except Empty:
-            return None
+            sent = self.sock.send(data)
+        except socket.error as e:
+            raise RequestNotSent(str(e))
+        if sent < len(data):
+            self.sock.sendall(data[sent:])
+        if not self.framed:
+            reply = self._rfile.read1(max_size)
+            if not reply:
+                raise socket.error('connection closed by the runtime')
+            return reply.decode('utf-8')
+
+        header = self._rfile.readline(self.max_header_size)
+        if not header.endswith(b'\n') or not header.strip().isdigit():
+            raise socket.error('malformed reply header from the runtime')
+        return self._read_exactly(int(header)).decode('utf-8')
+
+    def close(self):
+        try:
+            self._rfile.close()
+            self.sock.close()
+        except socket.error:
+            pass
+
+class RuntimeConnectionPool:
+    '''
+    Keeps a small set of open connections to the runtime interactive server,
+    so that an RPC costs a single round trip instead of a connect/teardown.
+    '''
+
+    def __init__(self, host = 'localhost', port = 43628, max_idle = 4, timeout = 10.0):
+        self._host = host
+        self._port = port
+        self._max_idle = max_idle
+        self._timeout = timeout
+        self._idle = []
+        self._lock = Lock()
+
+    def acquire(self):
+        '''
+        Returns a (connection, fresh) tuple. fresh is True when the connection
+        was just opened, False when it was reused from the idle list.
+        '''
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn = self._idle.pop()
+            if not conn.is_stale():
+                return conn, False
+            self.discard(conn)
+        return RuntimeConnection(self._host, self._port, self._timeout), True
+
+    def release(self, conn):
+        if conn.reusable:
+            with self._lock:
+                if len(self._idle) < self._max_idle:
+                    self._idle.append(conn)
+                    return
+        self.discard(conn)
+
+    def discard(self, conn):
+        if conn is not None:
+            conn.close()
 
-class UnexpectedEndOfStream(Exception): pass
+    def close_all(self):
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+        for conn in idle:
+            self.discard(conn)
 
 class runtime:
     project_file = ""
@@ -75,44 +363,272 @@ class runtime:
     project_description = ""
     runtime_status = "Stopped"
     
-    def start_runtime(self):
+    # Program without its debug lines, as handed to the compile script
+    build_source = './core/program.st'
+    
+    # Status cache, kept fresh by start_status_poller()
+    status_interval = 1.0
+    _status_poller = None
+    _status_valid = False
+    _status_exec_time = ""
+    
+    # Set while a spawned runtime hasn't answered on its control socket yet
+    _starting = False
+    
+    # Changes every time a runtime process is spawned. Log cursors only mean
+    # something within the process that handed them out
+    log_epoch = 0
+    
+    # Commands that can be sent twice without side effects
+    read_only_commands = ('exec_time', 'runtime_logs', 'runtime_logs_since')
+    
+    def __init__(self):
+        # Per instance, every runtime talks to its own process and builds
+        # through its own queue
+        self.rpc_pool = RuntimeConnectionPool()
+        self.compile_queue = CompileQueue()
+        self._status_lock = Lock()
+        self._status_wakeup = Event()
+    
+    def start_runtime(self, wait = True, timeout = 10.0):
+        '''
+        Spawns the runtime. With wait, returns once it answers on its control
+        socket (True) or when it exited or didn't answer within timeout
+        seconds (False). Without wait, returns right away and the readiness
+        check runs in the background, see is_ready().
+        '''
         if (self.status() == "Stopped"):
-            self.theprocess = subprocess.Popen(['./core/openplc'])  # XXX: iPAS
-            self.runtime_status = "Running"
+            return self._start_process(wait, timeout)
+        return self.is_ready()
+
+    def _start_process(self, wait = True, timeout = 10.0):
+        self.rpc_pool.close_all()
+        self.theprocess = subprocess.Popen(['./core/openplc'])  # XXX: iPAS
+        self.log_epoch = max(int(time.time() * 1000), self.log_epoch + 1)
+        self.runtime_status = "Running"
+        self._starting = True
+        self.invalidate_status()
+        if wait:
+            return self._wait_until_ready(timeout)
+        waiter = Thread(target = self._wait_until_ready, args = (timeout,))
+        waiter.daemon = True
+        waiter.start()
+        return False
 
-    def _rpc(self, msg, timeout=1000):
+    def _wait_until_ready(self, timeout):
+        '''
+        Retries the control socket until the runtime accepts the connection
+        and answers the framing handshake, the process exits or timeout
+        seconds pass. The handshake connection is kept in the pool.
+        '''
+        process = self.theprocess
+        deadline = time.monotonic() + timeout
+        ready = False
+        while (time.monotonic() < deadline) and (process.poll() is None):
+            try:
+                conn, fresh = self.rpc_pool.acquire()
+            except socket.error:
+                time.sleep(0.02)
+                continue
+            self.rpc_pool.release(conn)
+            ready = True
+            break
+        
+        if not ready:
+            if (process.poll() is not None):
+                print('Runtime exited while starting')
+                self.runtime_status = "Stopped"
+            else:
+                print('Runtime did not become ready after ' + str(timeout) + ' seconds')
+        self._starting = False
+        self.invalidate_status()
+        return ready
+
+    def is_ready(self):
+        '''
+        Non-blocking check: True when the runtime is running and done starting
+        '''
+        return (self.runtime_status == "Running") and not self._starting
+
+    def start_status_poller(self, interval = 1.0):
+        '''
+        Starts a background thread that refreshes the runtime status every
+        interval seconds, so that status() and exec_time() are answered from
+        memory instead of issuing an RPC per call.
+        '''
+        self.status_interval = interval
+        if self._status_poller is None:
+            self._status_poller = Thread(target = self._poll_status)
+            self._status_poller.daemon = True
+            self._status_poller.start()
+
+    def _poll_status(self):
+        while True:
+            self._status_wakeup.wait(self.status_interval)
+            self._status_wakeup.clear()
+            # The runtime needs a moment to open its control socket after it
+            # is spawned. Polling before that would flag it as stopped
+            if self._starting:
+                continue
+            self._refresh_status()
+
+    def _refresh_status(self):
+        exec_time = self._rpc('exec_time()')
+        with self._status_lock:
+            if not exec_time:
+                self.runtime_status = "Stopped"
+            self._status_exec_time = exec_time
+            self._status_valid = True
+
+    def invalidate_status(self):
+        '''
+        Drops the cached status and wakes the poller up, so that the next
+        status() reflects a start, stop or compile right away.
+        '''
+        with self._status_lock:
+            self._status_valid = False
+        self._status_wakeup.set()
+
+    def _rpc(self, msg, max_size=RuntimeConnection.max_reply_size):
         data = ""
         if not self.runtime_status == "Running":
             return data
-        try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect(('localhost', 43628))
-            s.send(f'{msg}\n'.encode('utf-8'))
-            data = s.recv(timeout).decode('utf-8')
-            s.close()
-            self.runtime_status = "Running"
-        except socket.error as serr:
-            print(f'Socket error during {msg}, is the runtime active?')
-            self.runtime_status = "Stopped"
+        # A pooled connection may have gone stale (runtime restarted), so a
+        # failure on a reused connection is retried once on a fresh one. That
+        # is only safe when the runtime can't have run the command already
+        read_only = msg.split('(')[0] in self.read_only_commands
+        while True:
+            conn = None
+            fresh = True
+            try:
+                conn, fresh = self.rpc_pool.acquire()
+                data = conn.request(msg, max_size)
+                self.rpc_pool.release(conn)
+                self.runtime_status = "Running"
+                return data
+            except RequestNotSent:
+                self.rpc_pool.discard(conn)
+                if fresh:
+                    break
+            except socket.error:
+                self.rpc_pool.discard(conn)
+                if fresh:
+                    break
+                if not read_only:
+                    # The runtime may be fine, let the status poller find out
+                    print(f'Connection lost during {msg}, not sending it again')
+                    self.rpc_pool.close_all()
+                    self.invalidate_status()
+                    return data
+        print(f'Socket error during {msg}, is the runtime active?')
+        self.runtime_status = "Stopped"
+        self.rpc_pool.close_all()
         return data
 
-    def stop_runtime(self):
+    def stop_runtime(self, wait = True, timeout = 10.0):
+        '''
+        Asks the runtime to quit. With wait, returns once the process exited,
+        terminating it if it's still alive after timeout seconds. Without
+        wait, the process is reaped in the background.
+        '''
         if (self.status() == "Running"):
-            self._rpc(f'quit()')
-            self.runtime_status = "Stopped"
+            if wait:
+                self._stop_process(timeout)
+            else:
+                reaper = Thread(target = self._stop_process, args = (timeout,))
+                reaper.daemon = True
+                reaper.start()
+
+    def _stop_process(self, timeout = 10.0):
+        self._rpc(f'quit()')
+        self.rpc_pool.close_all()
+        self.runtime_status = "Stopped"
 
-            while self.theprocess.poll() is None:  # XXX: iPAS, to prevent the defunct killed process.
-                time.sleep(1)  # https://www.reddit.com/r/learnpython/comments/776r96/defunct_python_process_when_using_subprocesspopen/
+        # Reap the process so it doesn't stay defunct
+        process = self.theprocess
+        try:
+            process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            print('Runtime did not quit after ' + str(timeout) + ' seconds, terminating it')
+            process.terminate()
+            try:
+                process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+        self.invalidate_status()
     
-    def compile_program(self, st_file):
-        if (self.status() == "Running"):
-            self.stop_runtime()
+    def compile_program(self, st_file, project_name = '', project_description = '', hot_swap = False, after_swap = None):
+        '''
+        Queues a build of st_file and returns its CompileJob. The runtime is
+        stopped when the build starts, not when it is queued.
         
-        self.is_compiling = True
-        global compilation_status_str
-        global compilation_object
-        compilation_status_str = ""
+        With hot_swap, a running runtime keeps scanning the old program while
+        the new one builds and is only restarted once the build succeeded.
+        after_swap(job) is then called, with the new runtime started, to
+        configure it again.
+        '''
+        job = self.compile_queue.submit(st_file, self._run_compile_job, project_name, project_description, hot_swap, after_swap)
+        self.invalidate_status()
+        return job
+
+    def _run_compile_job(self, job):
+        try:
+            self._build(job)
+        finally:
+            # Also when the build raised, so status() stops saying Compiling
+            # and the poller looks at the runtime again
+            self.invalidate_status()
+
+    def _build(self, job):
+        st_file = job.st_file
+        self._refresh_status()
+        hot_swap = job.hot_swap and (self.runtime_status == "Running")
+        if (self.runtime_status == "Running") and not hot_swap:
+            self._stop_process()
+        
+        if hot_swap:
+            # Keep what the running program needs to be restored if the build
+            # fails
+            old_layout = read_file('./core/LOCATED_VARIABLES.h')
+            old_active_program = read_file('./active_program')
+            self._keep_previous_build()
+        else:
+            self.project_name = job.project_name
+            self.project_description = job.project_description
+            self.project_file = st_file
         
+        swapped = False
+        try:
+            exit_code = self._compile(job, st_file)
+            if hot_swap and (exit_code == 0):
+                job.start_stage('swap')
+                job.add_line('Restarting runtime with the new program...\n')
+                self._stop_process()
+                # The old program is gone from here on. What fails next is
+                # the new program's start and is not rolled back
+                self._drop_previous_build()
+                swapped = True
+                exit_code = self._swap_program(job, old_layout)
+        finally:
+            # Whatever stopped the swap, failed build or exception, the old
+            # build goes back so the runtime can still be started
+            if hot_swap and not swapped:
+                job.add_line('Build failed, the running program was kept\n')
+                self._restore_previous_build()
+                if old_active_program is not None:
+                    with open('./active_program', 'w') as f:
+                        f.write(old_active_program)
+        
+        job.finish(exit_code)
+
+    def _compile(self, job, st_file):
+        '''
+        Splits the debug information out of the program and runs the compile
+        script on it. The uploaded file is left untouched, the program without
+        its debug lines is written to build_source. Returns the script's exit
+        code
+        '''
         # Extract debug information from program
         f = open('./st_files/' + st_file, "r")
         combined_lines = f.read()
@@ -141,52 +657,103 @@ class runtime:
                 c_debug = f.read()
                 f.close()
 
-            # Write c_debug file
-            f = open('./core/debug.cpp', "w")
-            f.write(c_debug)
-            f.close()
-
-            # Start compilation
-            a = subprocess.Popen(['./scripts/compile_program.sh', str(st_file)], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            compilation_object = NonBlockingStreamReader(a.stdout)
         else:
             # Debug info was extracted from program
-            program = '\n'.join(program_lines)
             c_debug = '\n'.join(c_debug_lines)
 
-            # Write c_debug file
-            f = open('./core/debug.cpp', "w")
-            f.write(c_debug)
-            f.close()
-
-            #Write program and debug files
-            f = open('./st_files/' + st_file, "w")
-            f.write(program)
-            f.close()
-            f = open('./st_files/' + st_file + '.dbg', "w")
-            f.write(c_debug)
-            f.close()
-
-            # Start compilation
-            a = subprocess.Popen(['./scripts/compile_program.sh', str(st_file)], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            compilation_object = NonBlockingStreamReader(a.stdout)
+        # Write c_debug file
+        f = open('./core/debug.cpp', "w")
+        f.write(c_debug)
+        f.close()
+
+        # Write the program the compiler gets. st_files is named by content
+        # hash and shared between uploads, so it is never rewritten
+        f = open(self.build_source, "w")
+        f.write('\n'.join(program_lines))
+        f.close()
+
+        # Start compilation
+        a = subprocess.Popen(['./scripts/compile_program.sh', str(st_file), self.build_source], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        for line in iter(a.stdout.readline, b''):
+            job.add_line(line.decode('utf-8', 'replace'))
+        a.stdout.close()
+        return a.wait()
+
+    def _keep_previous_build(self):
+        '''
+        Copies the running program's generated files to previous_build_dir
+        and moves its binary away (the running process keeps its inode) so
+        the build can't write into them.
+        '''
+        shutil.rmtree(previous_build_dir, ignore_errors = True)
+        os.makedirs(previous_build_dir)
+        for name in generated_files:
+            if os.path.isfile('./core/' + name):
+                shutil.copy2('./core/' + name, os.path.join(previous_build_dir, name))
+        if os.path.isfile('./core/openplc'):
+            os.replace('./core/openplc', './core/openplc.previous')
+
+    def _restore_previous_build(self):
+        if os.path.isfile('./core/openplc.previous'):
+            os.replace('./core/openplc.previous', './core/openplc')
+        if os.path.isdir(previous_build_dir):
+            for name in os.listdir(previous_build_dir):
+                os.replace(os.path.join(previous_build_dir, name), './core/' + name)
+        shutil.rmtree(previous_build_dir, ignore_errors = True)
+
+    def _drop_previous_build(self):
+        if os.path.isfile('./core/openplc.previous'):
+            os.remove('./core/openplc.previous')
+        shutil.rmtree(previous_build_dir, ignore_errors = True)
+
+    def _swap_program(self, job, old_layout):
+        '''
+        Starts the runtime on the program that was just built, once the old
+        one was stopped. Retained values are carried over through the
+        persistent storage file when the located variables didn't change,
+        otherwise they would land on the wrong addresses and the file is
+        dropped. Returns 0 when the new program is up and configured.
+        '''
+        if (read_file('./core/LOCATED_VARIABLES.h') != old_layout) and os.path.isfile('persistent.file'):
+            job.add_line('Located variables changed, discarding persistent storage\n')
+            os.remove('persistent.file')
+        
+        self.project_name = job.project_name
+        self.project_description = job.project_description
+        self.project_file = job.st_file
+        try:
+            started = self._start_process()
+        except Exception as e:
+            job.add_line(f'Error starting the new program: {e}\n')
+            return 1
+        if not started:
+            job.add_line('Error starting the new program: the runtime did not answer\n')
+            return 1
+        if job.after_swap is not None:
+            try:
+                job.after_swap(job)
+            except Exception as e:
+                job.add_line(f'The new program is running, but applying the settings to it failed: {e}\n')
+                return 1
+        return 0
     
     def compilation_status(self):
-        global compilation_status_str
-        global compilation_object
-        while compilation_object != None:
-            line = compilation_object.readline()
-            if not line: break
-            compilation_status_str += line
-        return compilation_status_str
+        job = self.compile_queue.latest()
+        if job is None:
+            return ""
+        return ''.join(job.log)
 
     def status(self):
-        if ('compilation_object' in globals()):
-            if (compilation_object.end_of_stream == False):
-                return "Compiling"
+        if self.compile_queue.busy():
+            return "Compiling"
 
-        if not self._rpc('exec_time()', 10000):
-            self.runtime_status = "Stopped"
+        if self._starting:
+            return self.runtime_status
+        # With the poller running an invalidated cache is refreshed by the
+        # poller thread, never by the caller, so a hung runtime can't block
+        # the request threads
+        if self._status_poller is None:
+            self._refresh_status()
 
         return self.runtime_status
 
@@ -215,7 +782,30 @@ class runtime:
         return self._rpc(f'stop_pstorage()')
     
     def logs(self):
-        return self._rpc(f'runtime_logs()',1000000)
+        return self._rpc(f'runtime_logs()')
+
+    def logs_since(self, cursor = 0, epoch = None):
+        '''
+        Returns an (epoch, next_cursor, text) tuple with the log lines written
+        after cursor. Pass epoch and next_cursor back on the following call to
+        only get the new lines. When the runtime was restarted in between the
+        epoch changes and text holds the new process' logs from the start.
+        '''
+        current_epoch = self.log_epoch
+        if (epoch is not None) and (epoch != current_epoch):
+            cursor = 0
+        reply = self._rpc(f'runtime_logs_since({int(cursor)})')
+        header, sep, text = reply.partition('\n')
+        if not sep or not header.isdigit():
+            # Runtime is stopped or predates log cursors
+            if cursor == 0 and reply:
+                return current_epoch, 0, self.logs()
+            return current_epoch, cursor, ''
+        return current_epoch, int(header), text
         
     def exec_time(self):
-        return self._rpc(f'exec_time()',10000) or "N/A"
+        if self._status_poller is not None:
+            if not self._status_valid:
+                return "N/A"
+            return self._status_exec_time or "N/A"
+        return self._rpc(f'exec_time()') or "N/A"
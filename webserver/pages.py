@@ -387,9 +387,39 @@ w3_style = """
         .w3-border-light-grey,.w3-hover-border-light-grey:hover,.w3-border-light-gray,.w3-hover-border-light-gray:hover{border-color:#f1f1f1!important}
         .w3-border-dark-grey,.w3-hover-border-dark-grey:hover,.w3-border-dark-gray,.w3-hover-border-dark-gray:hover{border-color:#616161!important}
         .w3-border-pale-red,.w3-hover-border-pale-red:hover{border-color:#ffe7e7!important}.w3-border-pale-green,.w3-hover-border-pale-green:hover{border-color:#e7ffe7!important}
-        .w3-border-pale-yellow,.w3-hover-border-pale-yellow:hover{border-color:#ffffcc!important}.w3-border-pale-blue,.w3-hover-border-pale-blue:hover{border-color:#e7ffff!important}"""
+        .w3-border-pale-yellow,.w3-hover-border-pale-yellow:hover{border-color:#ffffcc!important}.w3-border-pale-blue,.w3-hover-border-pale-blue:hover{border-color:#e7ffff!important}
+    </style>"""
+
+sidebar_items = [('dashboard', 'home-icon-64x64.png', 'Dashboard', 'Dashboard'),
+                 ('programs', 'programs-icon-64x64.png', 'Programs', 'Programs'),
+                 ('modbus', 'modbus-icon-512x512.png', 'Modbus', 'Slave Devices'),
+                 ('monitoring', 'monitoring-icon-64x64.png', 'Monitoring', 'Monitoring'),
+                 ('hardware', 'hardware-icon-980x974.png', 'Hardware', 'Hardware'),
+                 ('users', 'users-icon-64x64.png', 'Users', 'Users'),
+                 ('settings', 'settings-icon-64x64.png', 'Settings', 'Settings'),
+                 ('logout', 'logout-icon-64x64.png', 'Logout', 'Logout')]
+
+sidebar_head = """
+            <div class='main'>
+                <div class='w3-sidebar w3-bar-block' style='width:250px; background-color:#1F1F1F'>
+                    <br>
+                    <br>"""
+
+sidebar_link = """
+                    <a href='{href}' class='w3-bar-item w3-button'><img src='/static/{icon}' alt='{alt}' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:"Roboto", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>{label}</p></a>"""
+
+sidebar_active_link = """
+                    <a href='{href}' class='w3-bar-item w3-button' style='background-color:#0066FC; padding-right:0px;padding-top:0px;padding-bottom:0px'><img src='/static/{icon}' alt='{alt}' style='width:47px;height:39px;padding:7px 15px 0px 0px;float:left'><img src='/static/arrow.png' style='width:17px;height:49px;padding:0px 0px 0px 0px;margin: 0px 0px 0px 0px; float:right'><p style='font-family:"Roboto", sans-serif; font-size:20px; color:white;margin: 10px 0px 0px 0px'>{label}</p></a>"""
+
+sidebar_disabled_link = """
+                    <div class='w3-bar-item'><img src='/static/{icon}' alt='{alt}' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:"Roboto", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>{label}</p></div>"""
+
+sidebar_tail = """
+                    <br>
+                    <br>"""
 
 style = """
+    <style>
 /* OpenPLC Style */
         .top {
             position:absolute;
@@ -473,6 +503,7 @@ style = """
         
         
 dashboard_head = """
+    <style>
         .top {
             position:absolute;
             left:0; right:0; top:0;
@@ -609,6 +640,9 @@ loading logs...
         var mytext = document.getElementById('mytextarea');
         mytext.scrollTop = document.getElementById('mytextarea').scrollHeight;
         var req;
+        var log_cursor = 0;
+        var log_epoch = null;
+        var max_log_length = 1000000;
         
         function copyClipboard() 
         {
@@ -626,9 +660,43 @@ loading logs...
             tooltip.innerHTML = 'Copy to clipboard';
         }
         
+        function appendLogs(epoch, text)
+        {
+            var runtime_logs = document.getElementById('mytextarea');
+            var at_bottom = (runtime_logs.scrollTop + runtime_logs.clientHeight >= runtime_logs.scrollHeight - 20);
+            //A new epoch means the runtime restarted and text holds its logs from the start
+            if (epoch !== log_epoch)
+            {
+                runtime_logs.value = '';
+                log_epoch = epoch;
+            }
+            
+            runtime_logs.value += text;
+            if (runtime_logs.value.length > max_log_length)
+            {
+                runtime_logs.value = runtime_logs.value.slice(-max_log_length);
+            }
+            if (at_bottom)
+            {
+                runtime_logs.scrollTop = runtime_logs.scrollHeight;
+            }
+        }
+        
         function loadData()
         {
-            url = 'runtime_logs'
+            //Only new log lines are pushed by the server, the browser reconnects by itself
+            if (typeof(EventSource) !== 'undefined')
+            {
+                var log_source = new EventSource('runtime_logs_stream');
+                log_source.onmessage = function(e)
+                {
+                    var reply = JSON.parse(e.data);
+                    appendLogs(reply.epoch, reply.logs);
+                };
+                return;
+            }
+            
+            url = 'runtime_logs_since?cursor=' + log_cursor;
             try
             {
                 req = new XMLHttpRequest();
@@ -665,8 +733,10 @@ loading logs...
                 //If 'OK'
                 if (req.status == 200)
                 {
-                    //Update textarea text
-                    runtime_logs.value = req.responseText;
+                    //Append the new lines and remember where to continue from
+                    var reply = JSON.parse(req.responseText);
+                    log_cursor = reply.cursor;
+                    appendLogs(reply.epoch, reply.logs);
                     
                     //Start a new update timer
                     timeoutID = setTimeout('loadData()', 1000);
@@ -682,6 +752,7 @@ loading logs...
 </html>"""
 
 monitoring_head = """
+    <style>
 /* OpenPLC Style */
         .top {
             position:absolute;
@@ -837,11 +908,31 @@ monitoring_tail = """
     <script>
         var req;
         var refresh_rate = 500;
+        var monitor_seq = 0;
+        var monitor_version = '';
+        var monitor_source = null;
         
         function loadData()
         {
             html_modbus_port = document.getElementById('modbus_port_cfg');
-            url = 'monitor-update?mb_port=' + html_modbus_port.value;
+            if (monitor_version == '')
+            {
+                monitor_seq = document.getElementById('monitor_seq').value;
+                monitor_version = document.getElementById('monitor_version').value;
+            }
+            
+            //Changed values are pushed by the server, the browser reconnects by itself
+            if (typeof(EventSource) !== 'undefined')
+            {
+                monitor_source = new EventSource('monitor-stream?mb_port=' + html_modbus_port.value + '&seq=' + monitor_seq + '&rate=' + refresh_rate);
+                monitor_source.onmessage = function(e)
+                {
+                    applyChanges(JSON.parse(e.data));
+                };
+                return;
+            }
+            
+            url = 'monitor-changes?mb_port=' + html_modbus_port.value + '&seq=' + monitor_seq;
             try
             {
                 req = new XMLHttpRequest();
@@ -878,6 +969,53 @@ monitoring_tail = """
             }
             
             html_refresh_text.value = refresh_rate;
+            
+            //The push rate is set when the stream is opened
+            if (monitor_source != null)
+            {
+                monitor_source.close();
+                loadData();
+            }
+        }
+        
+        function drawValue(type, value)
+        {
+            if (type == 'BOOL')
+            {
+                if (value == 0)
+                    return '<img src="/static/bool_false.png" alt="bool_false" style="width:40px;height:40px;vertical-align:middle; margin-right:10px">FALSE';
+                else
+                    return '<img src="/static/bool_true.png" alt="bool_true" style="width:40px;height:40px;vertical-align:middle; margin-right:10px">TRUE';
+            }
+            else if (type == 'UINT' || type == 'INT')
+            {
+                var percentage = (type == 'UINT') ? (value*100)/65535 : ((value + 32768)*100)/65535;
+                return '<div class="w3-grey w3-round" style="height:40px"><div class="w3-container w3-blue w3-round" style="height:40px;width:' + parseInt(percentage) + '%"><p style="margin-top:10px">' + value + '</p></div></div>';
+            }
+            return String(value);
+        }
+        
+        function applyChanges(update)
+        {
+            //Program was reloaded, the table rows don't match anymore
+            if (update.version != monitor_version)
+            {
+                if (monitor_source != null) monitor_source.close();
+                location.reload();
+                return false;
+            }
+            
+            //Only patch the cells whose value changed
+            for (var i = 0; i < update.changes.length; i++)
+            {
+                var cell = document.getElementById('value_' + update.changes[i][0]);
+                if (cell != null)
+                {
+                    cell.innerHTML = drawValue(cell.getAttribute('data-type'), update.changes[i][1]);
+                }
+            }
+            monitor_seq = update.seq;
+            return true;
         }
         
         function processReqChange()
@@ -885,13 +1023,10 @@ monitoring_tail = """
             //If req shows 'complete'
             if (req.readyState == 4)
             {
-                mon_table = document.getElementById('monitor_table');
-                
                 //If 'OK'
                 if (req.status == 200)
                 {
-                    //Update table contents
-                    mon_table.innerHTML = req.responseText;
+                    if (!applyChanges(JSON.parse(req.responseText))) return;
                     
                     //Start a new update timer
                     timeoutID = setTimeout('loadData()', refresh_rate);
@@ -1040,6 +1175,7 @@ add_user_tail = """
 </html>"""
 
 settings_style = """
+    <style>
         /* OpenPLC Style */
         .top {
             position:absolute;
@@ -1157,22 +1293,6 @@ settings_style = """
     
     <body>"""
 
-settings_head = """
-        <div class='main'>
-            <div class="w3-sidebar w3-bar-block" style="width:250px; background-color:#1F1F1F">
-                <br>
-                <br>
-                <a href="dashboard" class="w3-bar-item w3-button"><img src="/static/home-icon-64x64.png" alt="Dashboard" style="width:47px;height:32px;padding:0px 15px 0px 0px;float:left"><p style='font-family:"Roboto", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Dashboard</p></a>
-                <a href='programs' class='w3-bar-item w3-button'><img src='/static/programs-icon-64x64.png' alt='Programs' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Programs</p></a>
-                <a href='modbus' class='w3-bar-item w3-button'><img src='/static/modbus-icon-512x512.png' alt='Modbus' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Slave Devices</p></a>
-                <a href='monitoring' class='w3-bar-item w3-button'><img src='/static/monitoring-icon-64x64.png' alt='Monitoring' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Monitoring</p></a>
-                <a href='hardware' class='w3-bar-item w3-button'><img src='/static/hardware-icon-980x974.png' alt='Hardware' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Hardware</p></a>
-                <a href="users" class="w3-bar-item w3-button"><img src="/static/users-icon-64x64.png" alt="Users" style="width:47px;height:32px;padding:0px 15px 0px 0px;float:left"><p style='font-family:"Roboto", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Users</p></a>
-                <a href="settings" class="w3-bar-item w3-button" style="background-color:#0066FC; padding-right:0px;padding-top:0px;padding-bottom:0px"><img src="/static/settings-icon-64x64.png" alt="Settings" style="width:47px;height:39px;padding:7px 15px 0px 0px;float:left"><img src="/static/arrow.png" style="width:17px;height:49px;padding:0px 0px 0px 0px;margin: 0px 0px 0px 0px; float:right"><p style='font-family:"Roboto", sans-serif; font-size:20px; color:white;margin: 10px 0px 0px 0px'>Settings</p></a>
-                <a href='logout' class='w3-bar-item w3-button'><img src='/static/logout-icon-64x64.png' alt='Logout' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Logout</p></a>
-                <br>
-                <br>"""
-                
 settings_tail = """
                         <br>
                         <br>
@@ -1311,6 +1431,7 @@ settings_tail = """
 </html>"""
 
 hardware_style = """
+    <style>
         /* OpenPLC Style */
         .top {
             position:absolute;
@@ -1385,22 +1506,6 @@ hardware_style = """
     
     <body onload='loadData()'>"""
 
-hardware_head = """
-        <div class='main'>
-            <div class="w3-sidebar w3-bar-block" style="width:250px; background-color:#1F1F1F">
-                <br>
-                <br>
-                <a href="dashboard" class="w3-bar-item w3-button"><img src="/static/home-icon-64x64.png" alt="Dashboard" style="width:47px;height:32px;padding:0px 15px 0px 0px;float:left"><p style='font-family:"Roboto", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Dashboard</p></a>
-                <a href='programs' class='w3-bar-item w3-button'><img src='/static/programs-icon-64x64.png' alt='Programs' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Programs</p></a>
-                <a href='modbus' class='w3-bar-item w3-button'><img src='/static/modbus-icon-512x512.png' alt='Modbus' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Slave Devices</p></a>
-                <a href='monitoring' class='w3-bar-item w3-button'><img src='/static/monitoring-icon-64x64.png' alt='Monitoring' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Monitoring</p></a>
-                <a href="hardware" class="w3-bar-item w3-button" style="background-color:#0066FC; padding-right:0px;padding-top:0px;padding-bottom:0px"><img src="/static/hardware-icon-980x974.png" alt="Hardware" style="width:47px;height:39px;padding:7px 15px 0px 0px;float:left"><img src="/static/arrow.png" style="width:17px;height:49px;padding:0px 0px 0px 0px;margin: 0px 0px 0px 0px; float:right"><p style='font-family:"Roboto", sans-serif; font-size:20px; color:white;margin: 10px 0px 0px 0px'>Hardware</p></a>
-                <a href="users" class="w3-bar-item w3-button"><img src="/static/users-icon-64x64.png" alt="Users" style="width:47px;height:32px;padding:0px 15px 0px 0px;float:left"><p style='font-family:"Roboto", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Users</p></a>
-                <a href='settings' class='w3-bar-item w3-button'><img src='/static/settings-icon-64x64.png' alt='Settings' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Settings</p></a>
-                <a href='logout' class='w3-bar-item w3-button'><img src='/static/logout-icon-64x64.png' alt='Logout' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Logout</p></a>
-                <br>
-                <br>"""
-
 hardware_tail = """</textarea>
                         </div>
                         <br>
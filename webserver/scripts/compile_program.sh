@@ -4,6 +4,11 @@ if [ $# -eq 0 ]; then
     exit 1
 fi
 
+#the program is read from st_files unless a second argument points to the
+#source to compile, e.g. a copy without the debug info. $1 is still the name
+#stored as the active program
+SOURCE_FILE="${2:-./st_files/$1}"
+
 #move into the scripts folder if you're not there already
 cd scripts &>/dev/null
 
@@ -14,10 +19,59 @@ OPENPLC_DRIVER=$(cat openplc_driver)
 #store the active program filename
 echo "$1" > ../active_program
 
-#compiling the ST file into C
 cd ..
+
+#previous builds are kept in the build cache, keyed by everything that goes
+#into the binary: the program, its debug info, the runtime sources, the
+#platform/driver settings and this script (which holds the compiler flags)
+BUILD_CACHE_DIR="$(pwd)/build_cache"
+BUILD_CACHE_SIZE=10
+GENERATED_FILES="POUS.c POUS.h LOCATED_VARIABLES.h VARIABLES.csv Config0.c Config0.h Res0.c glueVars.cpp"
+
+build_key() {
+    {
+        echo "$OPENPLC_PLATFORM $OPENPLC_DRIVER $ETHERCAT_OPT"
+        find ./scripts/compile_program.sh "$SOURCE_FILE" ./iec2c ./lib ./core/lib -type f 2>/dev/null
+        find ./core -maxdepth 1 -type f \( -name '*.cpp' -o -name '*.h' \) \
+            ! -name glueVars.cpp ! -name POUS.h ! -name LOCATED_VARIABLES.h ! -name Config0.h
+    } | sort | while read -r f; do
+        if [ -f "$f" ]; then sha256sum "$f"; else echo "$f"; fi
+    done | sha256sum | cut -d' ' -f1
+}
+
+#called from the core folder once the binary is linked
+save_build() {
+    local tmp_dir="$BUILD_CACHE_DIR/.tmp.$$"
+    rm -rf "$tmp_dir"
+    mkdir -p "$tmp_dir" &&
+        cp -f $GENERATED_FILES "$tmp_dir" &&
+        cp -f $(ls openplc openplc.exe 2>/dev/null) "$tmp_dir" &&
+        rm -rf "$BUILD_CACHE_DIR/$BUILD_KEY" &&
+        mv "$tmp_dir" "$BUILD_CACHE_DIR/$BUILD_KEY"
+    if [ $? -ne 0 ]; then
+        echo "Warning: could not store the build in the cache"
+        rm -rf "$tmp_dir"
+        return
+    fi
+    #only keep the most recently used builds
+    ls -1dt "$BUILD_CACHE_DIR"/*/ 2>/dev/null | tail -n +$((BUILD_CACHE_SIZE + 1)) | xargs -r rm -rf
+}
+
+BUILD_KEY=$(build_key)
+if [ -d "$BUILD_CACHE_DIR/$BUILD_KEY" ]; then
+    echo "Program was built before, restoring cached build..."
+    cp -f "$BUILD_CACHE_DIR/$BUILD_KEY"/* ./core/
+    if [ $? -eq 0 ]; then
+        touch "$BUILD_CACHE_DIR/$BUILD_KEY"
+        echo "Compilation finished successfully!"
+        exit 0
+    fi
+    echo "Error restoring cached build, compiling it again"
+fi
+
+#compiling the ST file into C
 echo "Generating C files..."
-./iec2c -f -l -p -r -R -a ./st_files/"$1"
+./iec2c -f -l -p -r -R -a "$SOURCE_FILE"
 if [ $? -ne 0 ]; then
     echo "Error generating C files"
     echo "Compilation finished with errors!"
@@ -48,139 +102,103 @@ fi
 cd core
 if [ "$OPENPLC_PLATFORM" = "win" ]; then
     echo "Compiling for Windows"
-    echo "Generating object files..."
-    g++ -I ./lib -c Config0.c -w
-    if [ $? -ne 0 ]; then
-        echo "Error compiling C files"
-        echo "Compilation finished with errors!"
-        exit 1
-    fi
-    g++ -I ./lib -c Res0.c -w
-    if [ $? -ne 0 ]; then
-        echo "Error compiling C files"
-        echo "Compilation finished with errors!"
-        exit 1
-    fi
-    echo "Generating glueVars..."
-    ./glue_generator
-    echo "Compiling main program..."
-    g++ *.cpp *.o -o openplc -I ./lib -pthread -fpermissive -I /usr/local/include/modbus -L /usr/local/lib -lmodbus -w
-    if [ $? -ne 0 ]; then
-        echo "Error compiling C files"
-        echo "Compilation finished with errors!"
-        exit 1
-    fi
-    echo "Compilation finished successfully!"
-    exit 0
-    
+    BUILD_FLAGS="-I ./lib -pthread -fpermissive -I /usr/local/include/modbus -L /usr/local/lib -lmodbus -w"
+
 elif [ "$OPENPLC_PLATFORM" = "linux" ]; then
     echo "Compiling for Linux"
-    echo "Generating object files..."
-    if [ "$OPENPLC_DRIVER" = "sl_rp4" ]; then
-        g++ -std=gnu++11 -I ./lib -c Config0.c -lasiodnp3 -lasiopal -lopendnp3 -lopenpal -w -DSL_RP4
-    else
-        g++ -std=gnu++11 -I ./lib -c Config0.c -lasiodnp3 -lasiopal -lopendnp3 -lopenpal -w
-    fi
-    if [ $? -ne 0 ]; then
-        echo "Error compiling C files"
-        echo "Compilation finished with errors!"
-        exit 1
-    fi
+    BUILD_FLAGS="-std=gnu++11 -I ./lib -pthread -fpermissive `pkg-config --cflags --libs libmodbus` -lasiodnp3 -lasiopal -lopendnp3 -lopenpal -w $ETHERCAT_INC"
     if [ "$OPENPLC_DRIVER" = "sl_rp4" ]; then
-        g++ -std=gnu++11 -I ./lib -c Res0.c -lasiodnp3 -lasiopal -lopendnp3 -lopenpal -w $ETHERCAT_INC -DSL_RP4
-    else
-        g++ -std=gnu++11 -I ./lib -c Res0.c -lasiodnp3 -lasiopal -lopendnp3 -lopenpal -w $ETHERCAT_INC
+        BUILD_FLAGS="$BUILD_FLAGS -DSL_RP4"
     fi
-    if [ $? -ne 0 ]; then
-        echo "Error compiling C files"
-        echo "Compilation finished with errors!"
-        exit 1
-    fi
-    echo "Generating glueVars..."
-    ./glue_generator
-    echo "Compiling main program..."
-    if [ "$OPENPLC_DRIVER" = "sl_rp4" ]; then
-        g++ -std=gnu++11 *.cpp *.o -o openplc -I ./lib -pthread -fpermissive `pkg-config --cflags --libs libmodbus` -lasiodnp3 -lasiopal -lopendnp3 -lopenpal -w $ETHERCAT_INC -DSL_RP4
-    else
-        g++ -std=gnu++11 *.cpp *.o -o openplc -I ./lib -pthread -fpermissive `pkg-config --cflags --libs libmodbus` -lasiodnp3 -lasiopal -lopendnp3 -lopenpal -w $ETHERCAT_INC
-    fi
-    if [ $? -ne 0 ]; then
-        echo "Error compiling C files"
-        echo "Compilation finished with errors!"
-        exit 1
-    fi
-    echo "Compilation finished successfully!"
-    exit 0
-    
+
 elif [ "$OPENPLC_PLATFORM" = "rpi" ]; then
     echo "Compiling for Raspberry Pi"
-    echo "Generating object files..."
+    BUILD_FLAGS="-std=gnu++11 -I ./lib -lrt -lpigpio -lpthread -fpermissive `pkg-config --cflags --libs libmodbus` -lasiodnp3 -lasiopal -lopendnp3 -lopenpal -w"
     if [ "$OPENPLC_DRIVER" = "sequent" ]; then
-        g++ -std=gnu++11 -I ./lib -c Config0.c -lasiodnp3 -lasiopal -lopendnp3 -lopenpal -w -DSEQUENT
-    else
-        g++ -std=gnu++11 -I ./lib -c Config0.c -lasiodnp3 -lasiopal -lopendnp3 -lopenpal -w
+        BUILD_FLAGS="$BUILD_FLAGS -DSEQUENT"
     fi
-    if [ $? -ne 0 ]; then
-        echo "Error compiling C files"
-        echo "Compilation finished with errors!"
-        exit 1
-    fi
-    if [ "$OPENPLC_DRIVER" = "sequent" ]; then
-        g++ -std=gnu++11 -I ./lib -c Res0.c -lasiodnp3 -lasiopal -lopendnp3 -lopenpal -w -DSEQUENT
-    else
-        g++ -std=gnu++11 -I ./lib -c Res0.c -lasiodnp3 -lasiopal -lopendnp3 -lopenpal -w
-    fi
-    if [ $? -ne 0 ]; then
-        echo "Error compiling C files"
-        echo "Compilation finished with errors!"
-        exit 1
-    fi
-    echo "Generating glueVars..."
-    ./glue_generator
-    echo "Compiling main program..."
-    if [ "$OPENPLC_DRIVER" = "sequent" ]; then
-        g++ -DSEQUENT -std=gnu++11 *.cpp *.o -o openplc -I ./lib -lrt -lpigpio -lpthread -fpermissive `pkg-config --cflags --libs libmodbus` -lasiodnp3 -lasiopal -lopendnp3 -lopenpal -w 
-    else    
-        g++ -std=gnu++11 *.cpp *.o -o openplc -I ./lib -lrt -lpigpio -lpthread -fpermissive `pkg-config --cflags --libs libmodbus` -lasiodnp3 -lasiopal -lopendnp3 -lopenpal -w
-    fi
-    if [ $? -ne 0 ]; then
-        echo "Error compiling C files"
-        echo "Compilation finished with errors!"
-        exit 1
-    fi
-    echo "Compilation finished successfully!"
-    exit 0
 
 elif [ "$OPENPLC_PLATFORM" = "opi" ]; then
     WIRINGOP_INC="-I/usr/local/include -L/usr/local/lib -lwiringPi -lwiringPiDev"
     echo "Compiling for Orange Pi"
-    echo "Generating object files..."
-    g++ -std=gnu++11 -I ./lib -c Config0.c -lasiodnp3 -lasiopal -lopendnp3 -lopenpal -w $WIRINGOP_INC
-    if [ $? -ne 0 ]; then
-        echo "Error compiling C files"
-        echo "Compilation finished with errors!"
-        exit 1
-    fi
-    g++ -std=gnu++11 -I ./lib -c Res0.c -lasiodnp3 -lasiopal -lopendnp3 -lopenpal -w $WIRINGOP_INC
-    if [ $? -ne 0 ]; then
-        echo "Error compiling C files"
-        echo "Compilation finished with errors!"
-        exit 1
-    fi
-    echo "Generating glueVars..."
-    ./glue_generator
-    echo "Compiling main program..."
-    g++ -std=gnu++11 *.cpp *.o -o openplc -I ./lib -lrt -lpthread -fpermissive `pkg-config --cflags --libs libmodbus` -lasiodnp3 -lasiopal -lopendnp3 -lopenpal -w $WIRINGOP_INC
-    if [ $? -ne 0 ]; then
-        echo "Error compiling C files"
-        echo "Compilation finished with errors!"
-        exit 1
-    fi
-    echo "Compilation finished successfully!"
-    exit 0
+    BUILD_FLAGS="-std=gnu++11 -I ./lib -lrt -lpthread -fpermissive `pkg-config --cflags --libs libmodbus` -lasiodnp3 -lasiopal -lopendnp3 -lopenpal -w $WIRINGOP_INC"
 
 else
     echo "Error: Undefined platform! OpenPLC can only compile for Windows, Linux and Raspberry Pi environments"
     echo "Compilation finished with errors!"
     exit 1
 fi
+
+build_error() {
+    echo "Error compiling C files"
+    echo "Compilation finished with errors!"
+    exit 1
+}
+
+#the runtime sources don't depend on the program, so their objects are kept
+#per platform/driver and only rebuilt when a source, a header or the flags
+#change. Only the program units are compiled on every build
+RUNTIME_OBJ_DIR="./runtime_objects/$OPENPLC_PLATFORM-$OPENPLC_DRIVER"
+RUNTIME_OBJECTS=""
+RUNTIME_HEADERS=$(ls *.h ./lib/*.h | grep -v -x -e POUS.h -e LOCATED_VARIABLES.h -e Config0.h)
+HEADERS_KEY=$( (echo "$BUILD_FLAGS"; cat $RUNTIME_HEADERS) | sha256sum | cut -d' ' -f1)
+mkdir -p "$RUNTIME_OBJ_DIR"
+
+#translation units are compiled concurrently, up to BUILD_JOBS at a time.
+#Set OPENPLC_BUILD_JOBS to override the default of one job per core
+BUILD_JOBS=${OPENPLC_BUILD_JOBS:-$(nproc 2>/dev/null || echo 1)}
+BUILD_FAILED="$RUNTIME_OBJ_DIR/.failed.$$"
+rm -f "$BUILD_FAILED"
+
+#compile_unit <source> <object> [key file contents]
+compile_unit() {
+    while [ $(jobs -rp | wc -l) -ge $BUILD_JOBS ]; do
+        wait -n
+    done
+    (
+        if g++ -c "$1" -o "$2" $BUILD_FLAGS; then
+            if [ -n "$3" ]; then echo "$3" > "$2.key"; fi
+        else
+            touch "$BUILD_FAILED"
+        fi
+    ) &
+}
+
+#glueVars.cpp is generated from LOCATED_VARIABLES.h, it doesn't need to wait
+#for the program objects
+echo "Generating glueVars..."
+./glue_generator
+
+echo "Generating object files..."
+compile_unit Config0.c Config0.o
+compile_unit Res0.c Res0.o
+compile_unit debug.cpp debug.o
+compile_unit glueVars.cpp glueVars.o
+
+for src in *.cpp; do
+    if [ "$src" = "debug.cpp" ] || [ "$src" = "glueVars.cpp" ]; then
+        continue
+    fi
+    obj="$RUNTIME_OBJ_DIR/${src%.cpp}.o"
+    RUNTIME_OBJECTS="$RUNTIME_OBJECTS $obj"
+    key=$( (echo "$HEADERS_KEY"; cat "$src") | sha256sum | cut -d' ' -f1)
+    if [ -f "$obj" ] && [ "$(cat "$obj.key" 2>/dev/null)" = "$key" ]; then
+        continue
+    fi
+    echo "Compiling $src"
+    rm -f "$obj.key"
+    compile_unit "$src" "$obj" "$key"
+done
+
+#linking needs every object
+wait
+if [ -f "$BUILD_FAILED" ]; then
+    rm -f "$BUILD_FAILED"
+    build_error
+fi
+
+echo "Compiling main program..."
+g++ Config0.o Res0.o debug.o glueVars.o $RUNTIME_OBJECTS -o openplc $BUILD_FLAGS || build_error
+save_build
+echo "Compilation finished successfully!"
+exit 0
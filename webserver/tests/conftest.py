@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The webserver modules import each other by name and expect to run from the
+# webserver directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
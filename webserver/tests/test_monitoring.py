@@ -0,0 +1,167 @@
+import math
+import struct
+
+import pytest
+
+pytest.importorskip('pymodbus')
+
+import monitoring
+
+
+PROGRAM = """PROGRAM prog0
+  VAR
+    start AT %IX0.0 : BOOL;
+    stop AT %IX0.3 : BOOL;
+    motor AT %QX0.1 : BOOL;
+    speed AT %IW2 : INT;
+    setpoint AT %MW0 : UINT;
+    level AT %MD1 : REAL;
+  END_VAR
+END_PROGRAM
+"""
+
+
+class Reply:
+    def __init__(self, bits = None, registers = None):
+        self.bits = bits
+        self.registers = registers
+
+    def isError(self):
+        return False
+
+
+class FakeClient:
+    def __init__(self):
+        self.requests = []
+        self.holding = [0] * 8192
+
+    def read_discrete_inputs(self, start, count):
+        self.requests.append(('di', start, count))
+        return Reply(bits = [(start + i) % 2 == 1 for i in range(count)])
+
+    def read_coils(self, start, count):
+        self.requests.append(('coils', start, count))
+        return Reply(bits = [True] * count)
+
+    def read_input_registers(self, start, count):
+        self.requests.append(('ir', start, count))
+        return Reply(registers = [65535] * count)
+
+    def read_holding_registers(self, start, count):
+        self.requests.append(('hr', start, count))
+        return Reply(registers = self.holding[start:start + count])
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def program(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'st_files').mkdir()
+    (tmp_path / 'st_files' / 'prog.st').write_text(PROGRAM)
+    monitoring.cleanup()
+    monitoring.histories.clear()
+    yield 'prog.st'
+    monitoring.cleanup()
+    monitoring.histories.clear()
+
+
+def variable(name, location, var_type):
+    debug_data = monitoring.debug_var()
+    debug_data.name = name
+    debug_data.location = location
+    debug_data.type = var_type
+    debug_data.address = monitoring.compile_address(debug_data)
+    return debug_data
+
+
+def test_read_plan_merges_nearby_addresses():
+    variables = [variable('a', '%IX0.0', 'BOOL'), variable('b', '%IX1.7', 'BOOL'), variable('c', '%IW3', 'UINT')]
+    plan = monitoring.build_read_plan(variables)
+    requests = sorted((area, start, count) for (area, start, count, is_bits, points) in plan)
+    assert requests == [(monitoring.AREA_DISCRETE_INPUTS, 0, 16), (monitoring.AREA_INPUT_REGISTERS, 3, 1)]
+
+
+def test_read_plan_respects_the_pdu_limit():
+    variables = [variable('w%d' % i, '%%IW%d' % (i * 100), 'UINT') for i in range(3)]
+    plan = monitoring.build_read_plan(variables)
+    assert [(start, count) for (area, start, count, is_bits, points) in plan] == [(0, 101), (200, 1)]
+
+
+def test_poll_decodes_every_type(program):
+    monitoring.parse_st(program)
+    client = FakeClient()
+    client.holding[1024] = 1234
+    client.holding[2050:2052] = struct.unpack('>HH', struct.pack('>f', 2.5))
+    monitoring.modbus_monitor(client)
+    values = dict((debug_data.name, debug_data.value) for debug_data in monitoring.snapshot()[1])
+    assert values == {'start': False, 'stop': True, 'motor': True, 'speed': -1, 'setpoint': 1234, 'level': 2.5}
+    # both discrete inputs come from a single request
+    assert len([request for request in client.requests if request[0] == 'di']) == 1
+
+
+def test_reload_swaps_variables_and_plan_together(program):
+    monitoring.parse_st(program)
+    (version, old_vars) = monitoring.snapshot()
+    old_plan = monitoring.current_read_plan()
+    
+    monitoring.parse_st(program)
+    (new_version, new_vars) = monitoring.snapshot()
+    assert new_version == version + 1
+    assert new_vars is not old_vars
+    assert monitoring.current_read_plan() is not old_plan
+    planned = [point[0] for request in monitoring.current_read_plan() for point in request[4]]
+    assert all(any(debug_data is planned_var for planned_var in planned) for debug_data in new_vars)
+
+
+def test_history_window_wraps_around():
+    history = monitoring.tag_history(4)
+    for second in range(6):
+        history.append(100.0 + second, second)
+    (times, values) = history.window(102, 104)
+    assert list(times) == [102.0, 103.0, 104.0]
+    assert list(values) == [2.0, 3.0, 4.0]
+
+
+def test_downsample_buckets():
+    times = [0.0, 1.0, 2.0, 7.0, 9.0]
+    values = [1.0, 3.0, 2.0, 10.0, 20.0]
+    assert monitoring.downsample(times, values, 0, 10, 2) == [[0.0, 1.0, 3.0, 2.0], [5.0, 10.0, 20.0, 15.0]]
+
+
+def test_downsample_leaves_out_values_that_are_not_numbers():
+    buckets = monitoring.downsample([0.0, 1.0, 2.0], [float('nan'), 4.0, float('inf')], 0, 3, 1)
+    assert buckets == [[0.0, 4.0, 4.0, 4.0]]
+
+
+def test_downsample_with_an_empty_or_infinite_window():
+    assert monitoring.downsample([1.0], [1.0], 5, 5, 10) == []
+    assert monitoring.downsample([1.0], [1.0], -1e308, 1e308, 10) == []
+
+
+def test_samples_that_are_not_numbers_become_null():
+    assert monitoring.finite_or_none(1.5) == 1.5
+    assert monitoring.finite_or_none(float('nan')) is None
+    assert monitoring.finite_or_none(-math.inf) is None
+
+
+def test_reload_keeps_the_history_of_unchanged_variables(program):
+    monitoring.parse_st(program)
+    level = [debug_data for debug_data in monitoring.snapshot()[1] if debug_data.name == 'level'][0]
+    level.history.append(1.0, 2.5)
+    monitoring.cleanup()
+    monitoring.parse_st(program)
+    level = [debug_data for debug_data in monitoring.snapshot()[1] if debug_data.name == 'level'][0]
+    assert list(level.history.window(0, 2)[1]) == [2.5]
+
+
+def test_recording_keeps_the_poller_running_without_viewers(monkeypatch):
+    monkeypatch.setattr(monitoring, 'ModbusTcpClient', lambda host, port: FakeClient())
+    monitoring.start_recording(5020)
+    try:
+        monitoring.stop_monitor()
+        assert monitoring.monitor_active
+    finally:
+        monitoring.stop_recording()
+    assert not monitoring.monitor_active
@@ -0,0 +1,357 @@
+import socket
+
+import pytest
+
+import openplc
+
+
+class FakeConnection:
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.sent = []
+        self.reusable = True
+
+    def request(self, msg, max_size):
+        reply = self.replies.pop(0)
+        if isinstance(reply, Exception):
+            raise reply
+        self.sent.append(msg)
+        return reply
+
+
+class FakePool:
+    def __init__(self, pooled, fresh):
+        self.pooled = pooled
+        self.fresh = fresh
+        self.opened = 0
+
+    def acquire(self):
+        if self.pooled is not None:
+            conn, self.pooled = self.pooled, None
+            return conn, False
+        self.opened += 1
+        return self.fresh, True
+
+    def release(self, conn):
+        pass
+
+    def discard(self, conn):
+        pass
+
+    def close_all(self):
+        pass
+
+
+def make_runtime(pooled, fresh):
+    rt = openplc.runtime()
+    rt.rpc_pool = FakePool(pooled, fresh)
+    rt.runtime_status = "Running"
+    return rt
+
+
+def test_runtimes_do_not_share_connections_queue_or_status():
+    first = openplc.runtime()
+    second = openplc.runtime()
+    assert first.rpc_pool is not second.rpc_pool
+    assert first.compile_queue is not second.compile_queue
+    assert first._status_lock is not second._status_lock
+    first.invalidate_status()
+    assert first._status_wakeup.is_set()
+    assert not second._status_wakeup.is_set()
+
+
+def test_read_only_command_is_retried_on_a_fresh_connection():
+    rt = make_runtime(FakeConnection([socket.error('reset')]), FakeConnection(['12.5']))
+    assert rt._rpc('exec_time()') == '12.5'
+    assert rt.rpc_pool.opened == 1
+
+
+def test_command_with_side_effects_is_not_sent_twice():
+    fresh = FakeConnection(['OK'])
+    rt = make_runtime(FakeConnection([socket.error('reset')]), fresh)
+    assert rt._rpc('start_modbus(502)') == ''
+    assert fresh.sent == []
+    # the runtime may still be alive, the status poller decides
+    assert rt.runtime_status == "Running"
+
+
+def test_command_that_was_never_sent_is_retried():
+    fresh = FakeConnection(['OK'])
+    rt = make_runtime(FakeConnection([openplc.RequestNotSent('broken pipe')]), fresh)
+    assert rt._rpc('quit()') == 'OK'
+    assert fresh.sent == ['quit()']
+
+
+def test_failure_on_a_fresh_connection_marks_the_runtime_stopped():
+    rt = make_runtime(None, FakeConnection([socket.error('refused')]))
+    assert rt._rpc('exec_time()') == ''
+    assert rt.runtime_status == "Stopped"
+
+
+@pytest.fixture
+def framed_connection():
+    (client, server) = socket.socketpair()
+    conn = openplc.RuntimeConnection.__new__(openplc.RuntimeConnection)
+    conn.sock = client
+    conn._rfile = client.makefile('rb')
+    conn.framed = True
+    yield conn, server
+    conn.close()
+    server.close()
+
+
+def test_framed_reply_spanning_several_writes(framed_connection):
+    (conn, server) = framed_connection
+    server.sendall(b'11\nhello ')
+    server.sendall(b'world')
+    assert conn.request('runtime_logs()', 1024) == 'hello world'
+    assert server.recv(64) == b'runtime_logs()\n'
+
+
+def test_malformed_reply_header(framed_connection):
+    (conn, server) = framed_connection
+    server.sendall(b'abc\n')
+    with pytest.raises(socket.error):
+        conn.request('exec_time()', 1024)
+
+
+def test_reply_over_the_limit(framed_connection):
+    (conn, server) = framed_connection
+    server.sendall(str(openplc.RuntimeConnection.max_reply_size + 1).encode() + b'\n')
+    with pytest.raises(socket.error):
+        conn.request('runtime_logs()', 1024)
+
+
+def test_idle_connection_closed_by_the_runtime_is_stale(framed_connection):
+    (conn, server) = framed_connection
+    assert not conn.is_stale()
+    server.close()
+    assert conn.is_stale()
+
+
+class LogRuntime(openplc.runtime):
+    def __init__(self, log):
+        self.log = log
+        self.asked = []
+        self.log_epoch = 7
+
+    def _rpc(self, msg, max_size=0):
+        cursor = int(msg[len('runtime_logs_since('):-1])
+        self.asked.append(cursor)
+        if cursor > len(self.log):
+            cursor = 0
+        return str(len(self.log)) + '\n' + self.log[cursor:]
+
+
+def test_logs_since_continues_within_an_epoch():
+    rt = LogRuntime('started\nrunning\n')
+    assert rt.logs_since(8, 7) == (7, 16, 'running\n')
+
+
+def test_logs_since_starts_over_after_a_restart():
+    # the old process handed out cursor 10, which falls inside the new log
+    rt = LogRuntime('new start\nscan 1\n')
+    assert rt.logs_since(10, 6) == (7, 17, 'new start\nscan 1\n')
+    assert rt.asked == [0]
+
+
+def wait_until_done(job, timeout = 5.0):
+    with job._output:
+        job._output.wait_for(lambda: job.done, timeout)
+    assert job.done
+
+
+def test_queue_builds_a_waiting_file_only_once():
+    queue = openplc.CompileQueue()
+    started = openplc.Event()
+    release = openplc.Event()
+    def runner(job):
+        started.set()
+        release.wait(5)
+        job.finish(0)
+    running = queue.submit('a.st', runner)
+    started.wait(5)
+    first = queue.submit('b.st', runner)
+    assert queue.submit('b.st', runner) is first
+    # the running build is not waiting anymore, sending it again queues a new one
+    assert queue.submit('a.st', runner) is not running
+    release.set()
+    for job in queue.jobs():
+        wait_until_done(job)
+    assert [job.st_file for job in queue.jobs()] == ['a.st', 'b.st', 'a.st']
+
+
+def test_queue_marks_a_build_that_raised_as_failed():
+    queue = openplc.CompileQueue()
+    def runner(job):
+        raise IOError('no such file')
+    job = queue.submit('a.st', runner)
+    wait_until_done(job)
+    assert job.state == 'failed'
+    assert 'no such file' in ''.join(job.log)
+    assert not queue.busy()
+
+
+def test_status_is_refreshed_when_a_build_raises():
+    rt = openplc.runtime()
+    invalidated = []
+    def build(job):
+        raise IOError('no such file')
+    rt._build = build
+    rt.invalidate_status = lambda: invalidated.append(True)
+    with pytest.raises(IOError):
+        rt._run_compile_job(openplc.CompileJob(1, 'a.st'))
+    assert invalidated == [True]
+
+
+def test_queue_keeps_a_hot_swap_and_a_cold_build_of_the_same_file():
+    queue = openplc.CompileQueue()
+    release = openplc.Event()
+    def runner(job):
+        release.wait(5)
+        job.finish(0)
+    queue.submit('busy.st', runner)
+    cold = queue.submit('a.st', runner)
+    swaps = []
+    hot = queue.submit('a.st', runner, hot_swap = True, after_swap = swaps.append)
+    assert hot is not cold
+    assert hot.after_swap is not None
+    assert queue.submit('a.st', runner, hot_swap = True) is hot
+    release.set()
+    for job in queue.jobs():
+        wait_until_done(job)
+
+
+def test_queue_reports_files_still_being_built():
+    queue = openplc.CompileQueue()
+    release = openplc.Event()
+    def runner(job):
+        release.wait(5)
+        job.finish(0)
+    queue.submit('a.st', runner)
+    queue.submit('b.st', runner)
+    assert queue.building('a.st')
+    assert queue.building('b.st')
+    assert not queue.building('c.st')
+    release.set()
+    for job in queue.jobs():
+        wait_until_done(job)
+    assert not queue.building('a.st')
+
+
+@pytest.fixture
+def hot_swap_runtime(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'core').mkdir()
+    (tmp_path / 'st_files').mkdir()
+    (tmp_path / 'core' / 'openplc').write_text('old binary')
+    (tmp_path / 'core' / 'LOCATED_VARIABLES.h').write_text('old layout')
+    (tmp_path / 'active_program').write_text('old.st\n')
+    rt = openplc.runtime()
+    def refresh_status():
+        rt.runtime_status = "Running"
+    rt._refresh_status = refresh_status
+    rt.invalidate_status = lambda: None
+    rt.stops = []
+    rt._stop_process = lambda: rt.stops.append(True)
+    return rt
+
+
+def new_build(tmp_path):
+    def build(job, st_file):
+        (tmp_path / 'core' / 'openplc').write_text('new binary')
+        (tmp_path / 'core' / 'LOCATED_VARIABLES.h').write_text('new layout')
+        (tmp_path / 'active_program').write_text(st_file + '\n')
+        return 0
+    return build
+
+
+def test_hot_swap_restores_the_old_binary_when_the_build_raises(hot_swap_runtime, tmp_path):
+    job = openplc.CompileJob(1, 'missing.st', hot_swap = True)
+    with pytest.raises(IOError):
+        hot_swap_runtime._run_compile_job(job)
+    assert (tmp_path / 'core' / 'openplc').read_text() == 'old binary'
+    assert not (tmp_path / 'core' / 'openplc.previous').exists()
+    assert (tmp_path / 'active_program').read_text() == 'old.st\n'
+
+
+def test_hot_swap_restores_the_old_build_when_the_build_fails(hot_swap_runtime, tmp_path):
+    def failed_build(job, st_file):
+        (tmp_path / 'core' / 'LOCATED_VARIABLES.h').write_text('new layout')
+        (tmp_path / 'core' / 'Config0.c').write_text('new config')
+        (tmp_path / 'active_program').write_text(st_file + '\n')
+        return 1
+    hot_swap_runtime._compile = failed_build
+    job = openplc.CompileJob(1, 'new.st', hot_swap = True)
+    hot_swap_runtime._run_compile_job(job)
+    assert job.state == 'failed'
+    assert hot_swap_runtime.stops == []
+    assert (tmp_path / 'core' / 'openplc').read_text() == 'old binary'
+    # the next swap compares against the layout of the program still running
+    assert (tmp_path / 'core' / 'LOCATED_VARIABLES.h').read_text() == 'old layout'
+    assert (tmp_path / 'core' / 'Config0.c').read_text() == 'new config'
+    assert not (tmp_path / 'core' / 'previous').exists()
+    assert (tmp_path / 'active_program').read_text() == 'old.st\n'
+
+
+def test_hot_swap_restarts_on_the_new_program(hot_swap_runtime, tmp_path):
+    (tmp_path / 'persistent.file').write_text('retained')
+    swaps = []
+    hot_swap_runtime._compile = new_build(tmp_path)
+    hot_swap_runtime._start_process = lambda: True
+    job = openplc.CompileJob(1, 'new.st', hot_swap = True, after_swap = lambda job: swaps.append(job.st_file))
+    hot_swap_runtime._run_compile_job(job)
+    assert job.state == 'succeeded'
+    assert hot_swap_runtime.stops == [True]
+    assert swaps == ['new.st']
+    assert hot_swap_runtime.project_file == 'new.st'
+    assert (tmp_path / 'core' / 'openplc').read_text() == 'new binary'
+    assert not (tmp_path / 'core' / 'openplc.previous').exists()
+    assert not (tmp_path / 'core' / 'previous').exists()
+    assert not (tmp_path / 'persistent.file').exists()
+
+
+def test_hot_swap_reports_a_new_program_that_does_not_start(hot_swap_runtime, tmp_path):
+    def start():
+        raise OSError('exec format error')
+    hot_swap_runtime._compile = new_build(tmp_path)
+    hot_swap_runtime._start_process = start
+    job = openplc.CompileJob(1, 'new.st', hot_swap = True)
+    hot_swap_runtime._run_compile_job(job)
+    assert job.state == 'failed'
+    log = ''.join(job.log)
+    assert 'Error starting the new program: exec format error' in log
+    assert 'running program was kept' not in log
+    # the old program was already stopped, nothing to roll back to
+    assert (tmp_path / 'core' / 'openplc').read_text() == 'new binary'
+    assert (tmp_path / 'active_program').read_text() == 'new.st\n'
+
+
+def test_hot_swap_reports_settings_that_fail_on_the_new_program(hot_swap_runtime, tmp_path):
+    def after_swap(job):
+        raise IOError('mbconfig.cfg')
+    hot_swap_runtime._compile = new_build(tmp_path)
+    hot_swap_runtime._start_process = lambda: True
+    job = openplc.CompileJob(1, 'new.st', hot_swap = True, after_swap = after_swap)
+    hot_swap_runtime._run_compile_job(job)
+    assert job.state == 'failed'
+    log = ''.join(job.log)
+    assert 'new program is running, but applying the settings to it failed: mbconfig.cfg' in log
+    assert 'running program was kept' not in log
+    assert hot_swap_runtime.project_file == 'new.st'
+    assert (tmp_path / 'active_program').read_text() == 'new.st\n'
+
+
+def test_compile_leaves_the_uploaded_program_untouched(hot_swap_runtime, tmp_path):
+    (tmp_path / 'scripts').mkdir()
+    script = tmp_path / 'scripts' / 'compile_program.sh'
+    script.write_text('#!/bin/sh\necho "$1"\ncat "$2"\n')
+    script.chmod(0o755)
+    uploaded = 'PROGRAM prog0\nEND_PROGRAM\n(*DBG:int x;*)'
+    (tmp_path / 'st_files' / 'new.st').write_text(uploaded)
+    job = openplc.CompileJob(1, 'new.st')
+    assert hot_swap_runtime._compile(job, 'new.st') == 0
+    assert (tmp_path / 'st_files' / 'new.st').read_text() == uploaded
+    assert not (tmp_path / 'st_files' / 'new.st.dbg').exists()
+    assert (tmp_path / 'core' / 'debug.cpp').read_text() == 'int x;'
+    assert ''.join(job.log) == 'new.st\nPROGRAM prog0\nEND_PROGRAM'
@@ -0,0 +1,373 @@
+import gzip
+import hashlib
+import http.client
+import io
+import socket
+import sqlite3
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('flask')
+pytest.importorskip('flask_login')
+
+import openplc
+import webserver
+
+
+PROGRAM = b'PROGRAM prog0\nEND_PROGRAM\n'
+
+
+class Upload:
+    def __init__(self, data):
+        self.stream = io.BytesIO(data)
+
+
+@pytest.fixture
+def st_files(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'st_files').mkdir()
+    monkeypatch.setattr(webserver.openplc_runtime, 'compile_queue', openplc.CompileQueue())
+    return tmp_path / 'st_files'
+
+
+@pytest.fixture
+def programs():
+    conn = sqlite3.connect(':memory:')
+    conn.execute("CREATE TABLE Programs (Prog_ID INTEGER PRIMARY KEY AUTOINCREMENT, Name TEXT NOT NULL, Description TEXT, File TEXT NOT NULL, Date_upload INTEGER NOT NULL)")
+    yield conn.cursor()
+    conn.close()
+
+
+def test_same_upload_is_stored_once(st_files):
+    filename = webserver.store_program_file(Upload(PROGRAM))
+    assert filename == hashlib.sha256(PROGRAM).hexdigest() + '.st'
+    assert webserver.store_program_file(Upload(PROGRAM)) == filename
+    assert webserver.store_program_file(Upload(PROGRAM + b'\n')) != filename
+    assert sorted(path.suffix for path in st_files.iterdir()) == ['.st', '.st']
+
+
+def test_release_keeps_files_still_in_use(st_files, programs):
+    filename = webserver.store_program_file(Upload(PROGRAM))
+    (st_files / (filename + '.dbg')).write_text('int x;')
+    programs.execute("INSERT INTO Programs (Name, File, Date_upload) VALUES ('a', ?, 1)", (filename,))
+    webserver.release_program_file(programs, filename)
+    assert (st_files / filename).exists()
+
+    programs.execute("DELETE FROM Programs")
+    (st_files.parent / 'active_program').write_text(filename + '\n')
+    webserver.release_program_file(programs, filename)
+    assert (st_files / filename).exists()
+
+    (st_files.parent / 'active_program').write_text('other.st\n')
+    webserver.release_program_file(programs, filename)
+    assert not (st_files / filename).exists()
+    assert not (st_files / (filename + '.dbg')).exists()
+
+
+def test_release_keeps_files_a_compile_job_needs(st_files, programs):
+    filename = webserver.store_program_file(Upload(PROGRAM))
+    release = openplc.Event()
+    def runner(job):
+        release.wait(5)
+        job.finish(0)
+    job = webserver.openplc_runtime.compile_queue.submit(filename, runner)
+    webserver.release_program_file(programs, filename)
+    assert (st_files / filename).exists()
+    release.set()
+    with job._output:
+        job._output.wait_for(lambda: job.done, 5)
+    webserver.release_program_file(programs, filename)
+    assert not (st_files / filename).exists()
+
+
+def test_release_leaves_older_uploads_alone(st_files, programs):
+    (st_files / '123456.st').write_bytes(PROGRAM)
+    webserver.release_program_file(programs, '123456.st')
+    assert (st_files / '123456.st').exists()
+
+
+@pytest.fixture
+def program_db(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # pools are keyed by path, start from a fresh one in this directory
+    monkeypatch.setattr(webserver, 'db_pools', {})
+    conn = sqlite3.connect('openplc.db')
+    conn.execute("CREATE TABLE Programs (Prog_ID INTEGER PRIMARY KEY AUTOINCREMENT, Name TEXT NOT NULL, Description TEXT, File TEXT NOT NULL, Date_upload INTEGER NOT NULL)")
+    yield conn
+    conn.close()
+
+
+def test_program_cursor_parsing():
+    assert webserver.parse_program_cursor('1527184953-12') == (1527184953, 12)
+    assert webserver.parse_program_cursor(None) is None
+    assert webserver.parse_program_cursor('12') is None
+    assert webserver.parse_program_cursor('a-b') is None
+    assert webserver.parse_program_cursor('1-2-3') is None
+
+
+def test_program_pages_follow_the_cursor(program_db):
+    # two uploads share a timestamp, the id breaks the tie
+    for (name, date_upload) in [('a', 10), ('b', 20), ('c', 20), ('d', 30), ('e', 40)]:
+        program_db.execute("INSERT INTO Programs (Name, File, Date_upload) VALUES (?, 'x.st', ?)", (name, date_upload))
+    program_db.commit()
+    names = []
+    cursor = None
+    while True:
+        (rows, cursor) = webserver.list_programs(cursor=webserver.parse_program_cursor(cursor), limit=2)
+        names.append([row[1] for row in rows])
+        if cursor == None:
+            break
+    assert names == [['e', 'd'], ['c', 'b'], ['a']]
+
+
+def test_program_search_matches_wildcards_literally(program_db):
+    for name in ['50% speed', '50 speed', 'tank_1', 'tank-1', 'back\\slash']:
+        program_db.execute("INSERT INTO Programs (Name, File, Date_upload) VALUES (?, 'x.st', 1)", (name,))
+    program_db.commit()
+    def search(text):
+        return sorted(row[1] for row in webserver.list_programs(search=text)[0])
+    assert search('50%') == ['50% speed']
+    assert search('tank_') == ['tank_1']
+    assert search('k\\s') == ['back\\slash']
+    assert search('speed') == ['50 speed', '50% speed']
+
+
+@pytest.fixture
+def db_pool(tmp_path):
+    pool = webserver.ConnectionPool(str(tmp_path / 'test.db'), max_idle=2, busy_timeout=0.2)
+    conn = pool.acquire()
+    conn.execute("CREATE TABLE Settings (Key TEXT NOT NULL UNIQUE, Value TEXT NOT NULL)")
+    conn.commit()
+    pool.release(conn)
+    return pool
+
+
+def test_new_connections_use_wal_and_the_busy_timeout(db_pool):
+    conn = db_pool.acquire()
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+    assert conn.execute("PRAGMA busy_timeout").fetchone()[0] == 200
+    db_pool.release(conn)
+
+
+def test_released_connection_drops_its_open_transaction(db_pool):
+    conn = webserver.PooledConnection(db_pool, db_pool.acquire())
+    conn.execute("INSERT INTO Settings VALUES ('Modbus_port', '502')")
+    conn.close()
+    with pytest.raises(sqlite3.ProgrammingError):
+        conn.execute("SELECT 1")
+    reused = db_pool.acquire()
+    assert not reused.in_transaction
+    assert reused.execute("SELECT COUNT(*) FROM Settings").fetchone()[0] == 0
+    db_pool.release(reused)
+
+
+def test_pool_keeps_at_most_max_idle_connections(db_pool):
+    conns = [db_pool.acquire() for i in range(4)]
+    # an empty pool opens new connections instead of waiting
+    assert len(set(id(conn) for conn in conns)) == 4
+    for conn in conns:
+        db_pool.release(conn)
+    assert db_pool.idle == conns[:2]
+    with pytest.raises(sqlite3.ProgrammingError):
+        conns[3].execute("SELECT 1")
+
+
+def test_writer_gives_up_after_the_busy_timeout(db_pool):
+    first = db_pool.acquire()
+    second = db_pool.acquire()
+    first.execute("BEGIN IMMEDIATE")
+    first.execute("INSERT INTO Settings VALUES ('Modbus_port', '502')")
+    started = time.monotonic()
+    with pytest.raises(sqlite3.OperationalError, match='locked'):
+        second.execute("INSERT INTO Settings VALUES ('Dnp3_port', '20000')")
+    assert time.monotonic() - started >= 0.15
+    db_pool.release(first)
+    db_pool.release(second)
+
+
+@pytest.fixture
+def users_db(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(webserver, 'db_pools', {})
+    monkeypatch.setattr(webserver, 'user_cache', {})
+    monkeypatch.setattr(webserver.openplc_runtime, 'status', lambda: 'Stopped')
+    conn = sqlite3.connect('openplc.db')
+    conn.execute("CREATE TABLE Users (user_id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, username TEXT NOT NULL UNIQUE, email TEXT, password TEXT NOT NULL, pict_file TEXT)")
+    conn.execute("INSERT INTO Users VALUES (10, 'OpenPLC User', 'openplc', 'openplc@openplc.com', 'openplc', NULL)")
+    conn.execute("INSERT INTO Users VALUES (11, 'Operator', 'ops', 'ops@openplc.com', 'ops', NULL)")
+    conn.commit()
+    conn.close()
+
+
+def logged_in(username):
+    client = webserver.app.test_client()
+    response = client.post('/login', data={'username': username, 'password': username})
+    assert response.status_code == 302
+    return client
+
+
+def shown_user_name(client):
+    response = client.get('/users')
+    assert response.status_code == 200
+    page = response.get_data(as_text=True)
+    # the top bar shows the name of the logged in user
+    return page.split("padding:13px 0px 0px 0px; margin: 0px 0px 0px 0px'>", 1)[1].split('</h3>', 1)[0]
+
+
+def test_stale_session_sees_an_edited_user(users_db):
+    operator = logged_in('ops')
+    admin = logged_in('openplc')
+    assert shown_user_name(operator) == 'Operator'
+    assert 'ops' in webserver.user_cache
+    response = admin.post('/edit-user', data={'user_id': '11', 'full_name': 'Night Shift', 'user_name': 'ops', 'user_email': 'ops@openplc.com', 'user_password': 'mypasswordishere'})
+    assert response.status_code == 302
+    assert shown_user_name(operator) == 'Night Shift'
+
+
+def test_stale_session_of_a_deleted_user_is_logged_out(users_db):
+    operator = logged_in('ops')
+    admin = logged_in('openplc')
+    assert shown_user_name(operator) == 'Operator'
+    response = admin.get('/delete-user?user_id=11')
+    assert response.status_code == 302
+    response = operator.get('/users')
+    assert response.status_code == 302
+    assert '/login' in response.headers['Location']
+
+
+@pytest.fixture
+def settings_db(users_db, monkeypatch):
+    monkeypatch.setattr(webserver, 'plc_settings', None)
+    monkeypatch.setattr(webserver, 'generate_mbconfig', lambda: None)
+    calls = []
+    for name in ['start_modbus', 'start_dnp3', 'start_enip', 'start_pstorage']:
+        monkeypatch.setattr(webserver.openplc_runtime, name, lambda value, name=name: calls.append((name, value)))
+    for name in ['stop_modbus', 'stop_dnp3', 'stop_enip', 'stop_pstorage']:
+        monkeypatch.setattr(webserver.openplc_runtime, name, lambda name=name: calls.append((name,)))
+    monkeypatch.setattr(webserver.monitor, 'start_recording', lambda port: None)
+    monkeypatch.setattr(webserver.monitor, 'stop_recording', lambda: None)
+    conn = sqlite3.connect('openplc.db')
+    conn.execute("CREATE TABLE Settings (Key TEXT NOT NULL UNIQUE, Value TEXT NOT NULL, PRIMARY KEY(Key))")
+    conn.executemany("INSERT INTO Settings VALUES (?, ?)", webserver.PLCSettings.defaults.items())
+    conn.commit()
+    conn.close()
+    return calls
+
+
+def test_saved_settings_reload_the_snapshot_and_reconfigure_the_runtime(settings_db):
+    before = webserver.get_settings()
+    assert before.modbus_port() == 502
+    assert before.dnp3_port() == 20000
+    admin = logged_in('openplc')
+    response = admin.post('/settings', data={'modbus_server_port': '5020', 'enip_server_port': '44818',
+                                             'auto_run_text': 'true', 'slave_polling_period': '250',
+                                             'slave_timeout': '500', 'device_hostname': socket.gethostname()})
+    assert response.status_code == 302
+    settings = webserver.get_settings()
+    assert settings is not before
+    assert settings.modbus_port() == 5020
+    assert settings.dnp3_port() == None
+    assert settings.pstorage_polling() == None
+    assert settings.start_run_mode()
+    assert settings.slave_polling() == 250
+    # snapshots are not changed in place
+    assert before.modbus_port() == 502
+    assert settings_db == [('start_modbus', 5020), ('stop_dnp3',), ('start_enip', 44818), ('stop_pstorage',)]
+
+
+def test_settings_snapshot_is_kept_when_the_table_cant_be_read(settings_db):
+    before = webserver.get_settings()
+    conn = sqlite3.connect('openplc.db')
+    conn.execute("DROP TABLE Settings")
+    conn.commit()
+    conn.close()
+    assert webserver.reload_settings() is before
+
+
+@pytest.fixture
+def pooled_server():
+    app = webserver.flask.Flask('pooled')
+    @app.route('/ping')
+    def ping():
+        return 'pong'
+    @app.route('/monitor-stream')
+    def monitor_stream():
+        def events():
+            while True:
+                yield 'data: {}\n\n'
+                time.sleep(0.05)
+        return webserver.flask.Response(events(), mimetype='text/event-stream')
+    servers = []
+    def start(workers, streams):
+        server = webserver.PooledWSGIServer('127.0.0.1', 0, app, workers, streams)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def open_stream(server):
+    conn = socket.create_connection(('127.0.0.1', server.server_port), timeout=5)
+    conn.sendall(b'GET /monitor-stream HTTP/1.1\r\nHost: localhost\r\n\r\n')
+    return conn, conn.recv(64).decode()
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_streams_over_the_limit_are_refused(pooled_server):
+    server = pooled_server(workers=1, streams=1)
+    (first, status) = open_stream(server)
+    assert status.startswith('HTTP/1.1 200')
+    (second, status) = open_stream(server)
+    assert status.startswith('HTTP/1.1 503')
+    # the stream doesn't hold the only worker
+    page = http.client.HTTPConnection('127.0.0.1', server.server_port, timeout=5)
+    page.request('GET', '/ping')
+    assert page.getresponse().read() == b'pong'
+    first.close()
+    second.close()
+    page.close()
+    # a closed stream gives its slot back
+    assert wait_for(lambda: server.stream_slots._value == 1)
+
+
+def test_keep_alive_connection_frees_the_worker_between_requests(pooled_server):
+    server = pooled_server(workers=1, streams=1)
+    # a client that connected and hasn't sent its request yet
+    idle = socket.create_connection(('127.0.0.1', server.server_port), timeout=5)
+    client = http.client.HTTPConnection('127.0.0.1', server.server_port, timeout=5)
+    for i in range(3):
+        client.request('GET', '/ping', headers={'Connection': 'keep-alive'})
+        assert client.getresponse().read() == b'pong'
+        assert wait_for(lambda: server.request_slots._value == 1)
+    idle.close()
+    client.close()
+
+
+def test_gzip_copies_of_static_files_are_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(webserver.app, 'static_folder', str(tmp_path))
+    monkeypatch.setattr(webserver, 'compressed_static', webserver.collections.OrderedDict())
+    monkeypatch.setattr(webserver, 'max_compressed_static', 2)
+    for name in ['a', 'b', 'c']:
+        (tmp_path / (name + '.css')).write_text('body { color: ' + name + '; }')
+    client = webserver.app.test_client()
+    def get(name):
+        response = client.get('/static/' + name + '.css', headers={'Accept-Encoding': 'gzip'})
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert gzip.decompress(response.get_data()) == ('body { color: ' + name + '; }').encode()
+        return response.get_etag()[0]
+    etags = {name: get(name) for name in ['a', 'b']}
+    # a is used again, so b is the least recently used one
+    get('a')
+    etags['c'] = get('c')
+    assert list(webserver.compressed_static) == [etags['a'], etags['c']]
@@ -9,13 +9,26 @@ import datetime
 import time
 import pages
 import openplc
+import check_openplc_db
 import monitoring as monitor
 import sys
 import ctypes
 import socket
+import json
+import threading
+import hashlib
+import gzip
+import re
+import concurrent.futures
+import collections
+import urllib.parse
+import select
+import math
+import tempfile
 
 import flask 
 import flask_login
+import werkzeug.serving
 
 app = flask.Flask(__name__)
 app.secret_key = str(os.urandom(16))
@@ -30,51 +43,193 @@ class User(flask_login.UserMixin):
 
 def configure_runtime():
     global openplc_runtime
-    database = "openplc.db"
-    conn = create_connection(database)
-    if (conn != None):
-        try:
-            print("Openning database")
-            cur = conn.cursor()
-            cur.execute("SELECT * FROM Settings")
-            rows = cur.fetchall()
-            cur.close()
-            conn.close()
-
-            for row in rows:
-                if (row[0] == "Modbus_port"):
-                    if (row[1] != "disabled"):
-                        print("Enabling Modbus on port " + str(int(row[1])))
-                        openplc_runtime.start_modbus(int(row[1]))
-                    else:
-                        print("Disabling Modbus")
-                        openplc_runtime.stop_modbus()
-                elif (row[0] == "Dnp3_port"):
-                    if (row[1] != "disabled"):
-                        print("Enabling DNP3 on port " + str(int(row[1])))
-                        openplc_runtime.start_dnp3(int(row[1]))
-                    else:
-                        print("Disabling DNP3")
-                        openplc_runtime.stop_dnp3()
-                elif (row[0] == "Enip_port"):
-                    if (row[1] != "disabled"):
-                        print("Enabling EtherNet/IP on port " + str(int(row[1])))
-                        openplc_runtime.start_enip(int(row[1]))
-                    else:
-                        print("Disabling EtherNet/IP")
-                        openplc_runtime.stop_enip()
-                elif (row[0] == "Pstorage_polling"):
-                    if (row[1] != "disabled"):
-                        print("Enabling Persistent Storage with polling rate of " + str(int(row[1])) + " seconds")
-                        openplc_runtime.start_pstorage(int(row[1]))
-                    else:
-                        print("Disabling Persistent Storage")
-                        openplc_runtime.stop_pstorage()
-                        delete_persistent_file()
-        except Error as e:
-            print("error connecting to the database" + str(e))
+    settings = get_settings()
+    
+    modbus_port = settings.modbus_port()
+    if (modbus_port != None):
+        print("Enabling Modbus on port " + str(modbus_port))
+        openplc_runtime.start_modbus(modbus_port)
     else:
-        print("Error opening DB")
+        print("Disabling Modbus")
+        openplc_runtime.stop_modbus()
+    
+    #Trend history is sampled through the Modbus server whenever the program runs, not only while someone watches
+    if (modbus_port != None) and (openplc_runtime.runtime_status == "Running"):
+        monitor.start_recording(modbus_port)
+    else:
+        monitor.stop_recording()
+    
+    dnp3_port = settings.dnp3_port()
+    if (dnp3_port != None):
+        print("Enabling DNP3 on port " + str(dnp3_port))
+        openplc_runtime.start_dnp3(dnp3_port)
+    else:
+        print("Disabling DNP3")
+        openplc_runtime.stop_dnp3()
+    
+    enip_port = settings.enip_port()
+    if (enip_port != None):
+        print("Enabling EtherNet/IP on port " + str(enip_port))
+        openplc_runtime.start_enip(enip_port)
+    else:
+        print("Disabling EtherNet/IP")
+        openplc_runtime.stop_enip()
+    
+    pstorage_polling = settings.pstorage_polling()
+    if (pstorage_polling != None):
+        print("Enabling Persistent Storage with polling rate of " + str(pstorage_polling) + " seconds")
+        openplc_runtime.start_pstorage(pstorage_polling)
+    else:
+        print("Disabling Persistent Storage")
+        openplc_runtime.stop_pstorage()
+        delete_persistent_file()
+
+
+#Runtime start/stop calls run one at a time on this worker instead of inside request threads
+runtime_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='runtime')
+
+
+def report_runtime_task(future):
+    if (future.exception() != None):
+        print("Runtime task failed: " + str(future.exception()))
+
+
+def run_runtime_task(task, wait=2.0):
+    """ Queues task on the runtime worker and waits up to wait seconds for it. Slower tasks finish in the background """
+    future = runtime_executor.submit(task)
+    future.add_done_callback(report_runtime_task)
+    try:
+        future.result(timeout=wait)
+    except concurrent.futures.TimeoutError:
+        print("Runtime task still running, not waiting for it")
+    except Exception:
+        #Already reported by report_runtime_task
+        pass
+
+
+# Reads answered by the runtime (logs, point writes). Kept apart from
+# runtime_executor so that polling never queues behind a start or stop
+runtime_queries = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix='runtime-query')
+
+
+def query_runtime(task, default, wait=2.0):
+    """ Runs task on a runtime query worker and returns its result, or default if it takes longer than wait seconds """
+    future = runtime_queries.submit(task)
+    future.add_done_callback(report_runtime_task)
+    try:
+        return future.result(timeout=wait)
+    except concurrent.futures.TimeoutError:
+        print("Runtime query timed out")
+    except Exception:
+        #Already reported by report_runtime_task
+        pass
+    return default
+
+
+def start_plc_program():
+    monitor.stop_monitor()
+    #returns once the runtime answers on its control socket
+    openplc_runtime.start_runtime()
+    configure_runtime()
+    monitor.cleanup()
+    monitor.parse_st(openplc_runtime.project_file)
+
+
+def stop_plc_program():
+    openplc_runtime.stop_runtime()
+    monitor.stop_recording()
+
+
+def parse_cursor(value):
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def parse_log_cursor(value):
+    """ Log cursors look like '<epoch>-<offset>'. Returns (epoch, offset), epoch is None when it is missing """
+    (epoch, sep, offset) = str(value).rpartition('-')
+    if not sep:
+        return (None, parse_cursor(offset))
+    return (parse_cursor(epoch), parse_cursor(offset))
+
+
+def stream_runtime_logs(epoch, cursor, poll_interval=1.0, keepalive_interval=15.0):
+    """ Generates server-sent events carrying only the log text written after cursor """
+    global openplc_runtime
+    first_event = True
+    last_event = time.time()
+    while True:
+        last_epoch = epoch
+        (epoch, cursor, logs) = query_runtime(lambda: openplc_runtime.logs_since(cursor, epoch), (openplc_runtime.log_epoch if epoch is None else epoch, cursor, ''))
+        if logs or first_event or (epoch != last_epoch):
+            yield 'id: ' + str(epoch) + '-' + str(cursor) + '\ndata: ' + json.dumps({'epoch': epoch, 'logs': logs}) + '\n\n'
+            first_event = False
+            last_event = time.time()
+        elif (time.time() - last_event >= keepalive_interval):
+            # Comment line, lets the server notice clients that went away
+            yield ': keepalive\n\n'
+            last_event = time.time()
+        time.sleep(poll_interval)
+
+
+def stream_compilation_logs(job, cursor, keepalive_interval=15.0):
+    """ Generates server-sent events carrying the build output written after cursor, until the build is over """
+    first_event = True
+    while True:
+        (cursor, logs, done) = job.output_since(cursor)
+        if logs or done or first_event:
+            yield 'id: ' + str(cursor) + '\ndata: ' + json.dumps({'logs': logs, 'done': done}) + '\n\n'
+            first_event = False
+            if done:
+                return
+        else:
+            # Comment line, lets the server notice clients that went away
+            yield ': keepalive\n\n'
+        job.wait_for_output(cursor, keepalive_interval)
+
+
+def find_compile_job(job_id):
+    """ Returns the compile job with the given id, or the latest one if job_id is not set """
+    if (parse_cursor(job_id) > 0):
+        return openplc_runtime.compile_queue.get(parse_cursor(job_id))
+    return openplc_runtime.compile_queue.latest()
+
+
+def collect_monitor_changes(seq):
+    """ Returns the monitored values that changed after seq, ready to be sent as JSON """
+    (version, current_seq, changed) = monitor.changes_since(seq)
+    changes = []
+    for (index, debug_data) in changed:
+        if (debug_data.type == 'REAL') or (debug_data.type == 'LREAL'):
+            changes.append([index, "{:10.4f}".format(debug_data.value)])
+        else:
+            changes.append([index, debug_data.value])
+    return {'version': version, 'seq': current_seq, 'changes': changes}
+
+
+def stream_monitor_changes(seq, min_interval=0.5, keepalive_interval=15.0):
+    """ Generates server-sent events carrying the monitored values that changed after seq """
+    # All viewers share the monitor's single poller, each one only keeps its own seq
+    monitor.add_viewer()
+    try:
+        first_event = True
+        while True:
+            if not first_event:
+                monitor.wait_for_changes(seq, keepalive_interval)
+            update = collect_monitor_changes(seq)
+            if update['changes'] or first_event:
+                yield 'id: ' + str(update['seq']) + '\ndata: ' + json.dumps(update) + '\n\n'
+                first_event = False
+            else:
+                # Comment line, lets the server notice clients that went away
+                yield ': keepalive\n\n'
+            seq = update['seq']
+            # Don't push faster than the refresh rate the viewer asked for
+            time.sleep(min_interval)
+    finally:
+        monitor.remove_viewer()
 
 
 def delete_persistent_file():
@@ -95,19 +250,9 @@ def generate_mbconfig():
             mbconfig = 'Num_Devices = "' + str(num_devices) + '"'
             cur.close()
             
-            cur=conn.cursor()
-            cur.execute("SELECT * FROM Settings")
-            rows = cur.fetchall()
-            cur.close()
-                    
-            for row in rows:
-                if (row[0] == "Slave_polling"):
-                    slave_polling = str(row[1])
-                elif (row[0] == "Slave_timeout"):
-                    slave_timeout = str(row[1])
-                    
-            mbconfig += '\nPolling_Period = "' + slave_polling + '"'
-            mbconfig += '\nTimeout = "' + slave_timeout + '"'
+            settings = get_settings()
+            mbconfig += '\nPolling_Period = "' + str(settings.slave_polling()) + '"'
+            mbconfig += '\nTimeout = "' + str(settings.slave_timeout()) + '"'
             
             cur = conn.cursor()
             cur.execute("SELECT * FROM Slave_dev")
@@ -164,6 +309,106 @@ def generate_mbconfig():
                 
 
     
+bundles = {}
+static_versions = {}
+#gzip copies of static files by ETag, most recently used last. Bounded, as
+#pictures uploaded to static/ and edited files bring new ETags
+compressed_static = collections.OrderedDict()
+compressed_static_lock = threading.Lock()
+max_compressed_static = 64
+compressible_types = ('text/html', 'text/css', 'text/plain', 'application/javascript', 'text/javascript', 'application/json', 'image/svg+xml')
+
+
+def static_url(match):
+    """ Adds a content hash to a /static/ reference, so the file can be cached for good """
+    path = match.group(2)
+    version = static_versions.get(path)
+    if version is None:
+        file_path = os.path.join(app.static_folder, path)
+        if not os.path.isfile(file_path):
+            return match.group(0)
+        with open(file_path, 'rb') as f:
+            version = hashlib.sha256(f.read()).hexdigest()[:12]
+        static_versions[path] = version
+    return match.group(1) + '/static/' + path + '?v=' + version
+
+
+def versioned_static(text):
+    return re.sub(r"""(["'(])/static/([\w\-./]+)""", static_url, text)
+
+
+def cached_compressed_static(etag):
+    with compressed_static_lock:
+        compressed = compressed_static.get(etag)
+        if (compressed != None):
+            compressed_static.move_to_end(etag)
+        return compressed
+
+
+def cache_compressed_static(etag, compressed):
+    with compressed_static_lock:
+        compressed_static[etag] = compressed
+        compressed_static.move_to_end(etag)
+        while (len(compressed_static) > max_compressed_static):
+            compressed_static.popitem(last=False)
+
+
+def add_bundle(content, extension, mimetype):
+    """ Stores content under a name derived from its hash and returns the URL it is served from """
+    data = versioned_static(content).encode('utf-8')
+    name = hashlib.sha256(data).hexdigest()[:16] + extension
+    if name not in bundles:
+        bundles[name] = (data, gzip.compress(data), mimetype)
+    return '/bundles/' + name
+
+
+def bundle_assets(text):
+    """ Moves inline <style> and <script> blocks out of the page into bundles the browser keeps in cache """
+    text = re.sub(r'<style>(.*?)</style>', lambda m: "<link rel='stylesheet' href='" + add_bundle(m.group(1), '.css', 'text/css') + "'>", text, flags=re.S)
+    text = re.sub(r'<script( type="text/javascript")?>(.*?)</script>', lambda m: "<script src='" + add_bundle(m.group(2), '.js', 'application/javascript') + "'></script>", text, flags=re.S)
+    return versioned_static(text)
+
+
+static_chunks = {}
+
+def static_chunk(*names):
+    """ The named pages.py strings joined once, then reused as-is on every request """
+    chunk = static_chunks.get(names)
+    if chunk is None:
+        chunk = ''.join(static_chunks[(name,)] for name in names)
+        static_chunks[names] = chunk
+    return chunk
+
+
+def build_sidebar(active):
+    """ Sidebar markup with the entry for active highlighted. None draws the entries as plain text, without links """
+    sidebar = pages.sidebar_head
+    for (href, icon, alt, label) in pages.sidebar_items:
+        if (active == None):
+            entry = pages.sidebar_disabled_link
+        elif (href == active):
+            entry = pages.sidebar_active_link
+        else:
+            entry = pages.sidebar_link
+        sidebar += entry.format(href=href, icon=icon, alt=alt, label=label)
+    sidebar += pages.sidebar_tail
+    return versioned_static(sidebar)
+
+
+#Every page constant is prepared once at startup, so all bundles exist before the first page asks for them
+for (name, value) in vars(pages).items():
+    if isinstance(value, str) and not name.startswith('_'):
+        static_chunks[(name,)] = bundle_assets(value)
+
+sidebars = {item[0]: build_sidebar(item[0]) for item in pages.sidebar_items}
+sidebars[None] = build_sidebar(None)
+
+
+def draw_page(style, active):
+    """ Start of a page: cached head and sidebar, plus the parts that change per request (top bar and PLC status) """
+    return static_chunk('w3_style', style) + draw_top_div() + sidebars[active] + draw_status()
+
+
 def draw_top_div():
     global openplc_runtime
     top_div = ("<div class='top'>"
@@ -202,30 +447,23 @@ def draw_status():
     return status_str    
 
 
-def draw_blank_page():
-    return_str = pages.w3_style + pages.dashboard_head + draw_top_div() + """
-            <div class='main'>
-                <div class='w3-sidebar w3-bar-block' style='width:250px; background-color:#1F1F1F'>
-                    <br>
-                    <br>
-                    <div class="w3-bar-item"><img src="/static/home-icon-64x64.png" alt="Dashboard" style="width:47px;height:32px;padding:0px 15px 0px 0px;float:left"><p style='font-family:"Roboto", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Dashboard</p></div>
-                    <div class="w3-bar-item"><img src='/static/programs-icon-64x64.png' alt='Programs' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Programs</p></div>
-                    <div class="w3-bar-item"><img src='/static/modbus-icon-512x512.png' alt='Modbus' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Slave Devices</p></div>
-                    <div class="w3-bar-item"><img src='/static/monitoring-icon-64x64.png' alt='Monitoring' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Monitoring</p></div>
-                    <div class="w3-bar-item"><img src='/static/hardware-icon-980x974.png' alt='Hardware' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Hardware</p></div>
-                    <div class="w3-bar-item"><img src='/static/users-icon-64x64.png' alt='Users' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Users</p></div>
-                    <div class="w3-bar-item"><img src='/static/settings-icon-64x64.png' alt='Settings' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Settings</p></div>
-                    <div class="w3-bar-item"><img src='/static/logout-icon-64x64.png' alt='Logout' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Logout</p></div>
-                    <br>
-                    <br>
+def draw_blank_page(content=''):
+    return_str = static_chunk('w3_style', 'dashboard_head') + draw_top_div() + sidebars[None]
+    return_str += """
                 </div>
                 <div style="margin-left:320px; margin-right:70px">
                 <div style="w3-container">
                     <br>"""
+    if content:
+        return_str += content
     return return_str
     
-def draw_compiling_page():
+def draw_compiling_page(job=None):
+    """ Shows the build output of job, or of the latest build when no job is given """
+    if (job == None):
+        job = openplc_runtime.compile_queue.latest()
     return_str = draw_blank_page()
+    return_str += "<input type='hidden' id='compile_job' value='" + (str(job.id) if job != None else '0') + "'>"
     return_str += """
                     <h2>Compiling program</h2>
                     <textarea id='mytextarea' style='height:500px; resize:vertical'>
@@ -287,10 +525,51 @@ loading logs...
         })(window);
         
         var req;
+        var log_cursor = 0;
+        var logs_loaded = false;
+        
+        function appendLogs(text, done)
+        {
+            compilation_logs = document.getElementById('mytextarea');
+            dashboard_button = document.getElementById('dashboard_button');
+            
+            //Drop the 'loading logs...' placeholder on the first update
+            if (!logs_loaded)
+            {
+                compilation_logs.value = '';
+                logs_loaded = true;
+            }
+            compilation_logs.value += text;
+            compilation_logs.scrollTop = compilation_logs.scrollHeight;
+            
+            if (done)
+            {
+                dashboard_button.style.background='#0066FC'
+                dashboard_button.style.pointerEvents='auto'
+            }
+        }
         
         function loadData()
         {
-            url = 'compilation-logs'
+            job_id = document.getElementById('compile_job').value;
+            
+            //Only new output lines are pushed by the server, the browser reconnects by itself
+            if (typeof(EventSource) !== 'undefined')
+            {
+                var log_source = new EventSource('compilation-logs-stream?job=' + job_id);
+                log_source.onmessage = function(e)
+                {
+                    var update = JSON.parse(e.data);
+                    appendLogs(update.logs, update.done);
+                    if (update.done)
+                    {
+                        log_source.close();
+                    }
+                };
+                return;
+            }
+            
+            url = 'compilation-logs-since?job=' + job_id + '&cursor=' + log_cursor;
             try
             {
                 req = new XMLHttpRequest();
@@ -328,16 +607,16 @@ loading logs...
                 //If 'OK'
                 if (req.status == 200)
                 {
-                    //Update textarea text
-                    compilation_logs.value = req.responseText;
-                    if ((req.responseText.search("Compilation finished with errors!") != -1) || (req.responseText.search("Compilation finished successfully!") != -1))
-                    {
-                        dashboard_button.style.background='#0066FC'
-                        dashboard_button.style.pointerEvents='auto'
-                    }
+                    //Append the new lines and remember where to continue from
+                    var reply = JSON.parse(req.responseText);
+                    log_cursor = reply.cursor;
+                    appendLogs(reply.logs, reply.done);
                     
                     //Start a new update timer
-                    timeoutID = setTimeout('loadData()', 1000);
+                    if (!reply.done)
+                    {
+                        timeoutID = setTimeout('loadData()', 1000);
+                    }
                 }
                 else
                 {
@@ -350,63 +629,77 @@ loading logs...
     return return_str
 
     
-@login_manager.user_loader
-def user_loader(username):
+user_cache = {}
+user_cache_lock = threading.Lock()
+
+
+def find_user(username):
+    """ Return the (username, password, name, pict_file) row for a user, or None. Raises Error when the database can't be read """
+    if (username == None):
+        return None
+    with user_cache_lock:
+        row = user_cache.get(username)
+    if (row != None):
+        return row
+    
     database = "openplc.db"
     conn = create_connection(database)
-    if (conn != None):
-        try:
-            cur = conn.cursor()
-            cur.execute("SELECT username, password, name, pict_file FROM Users")
-            rows = cur.fetchall()
-            cur.close()
-            conn.close()
+    if (conn == None):
+        raise Error("Error opening DB")
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT username, password, name, pict_file FROM Users WHERE username = ?", (username,))
+        row = cur.fetchone()
+        cur.close()
+    finally:
+        conn.close()
+    
+    #Only known users are cached, so bogus login attempts can't grow the cache
+    if (row != None):
+        with user_cache_lock:
+            user_cache[username] = row
+    return row
 
-            for row in rows:
-                if (row[0] == username):
-                    user = User()
-                    user.id = row[0]
-                    user.name = row[2]
-                    user.pict_file = str(row[3])
-                    return user
-            return
-                    
-        except Error as e:
-            print("error connecting to the database" + str(e))
-            return
-    else:
+
+def invalidate_user_cache():
+    """ Drop cached user rows after the Users table has been modified """
+    with user_cache_lock:
+        user_cache.clear()
+
+
+@login_manager.user_loader
+def user_loader(username):
+    try:
+        row = find_user(username)
+    except Error as e:
+        print("error connecting to the database" + str(e))
         return
+    if (row != None):
+        user = User()
+        user.id = row[0]
+        user.name = row[2]
+        user.pict_file = str(row[3])
+        return user
+    return
 
 
 @login_manager.request_loader
 def request_loader(request):
     username = request.form.get('username')
     
-    database = "openplc.db"
-    conn = create_connection(database)
-    if (conn != None):
-        try:
-            cur = conn.cursor()
-            cur.execute("SELECT username, password, name, pict_file FROM Users")
-            rows = cur.fetchall()
-            cur.close()
-            conn.close()
-
-            for row in rows:
-                if (row[0] == username):
-                    user = User()
-                    user.id = row[0]
-                    user.name = row[2]
-                    user.pict_file = str(row[3])
-                    user.is_authenticated = (request.form['password'] == row[1])
-                    return user
-            return
-                    
-        except Error as e:
-            print("error connecting to the database" + str(e))
-            return
-    else:
+    try:
+        row = find_user(username)
+    except Error as e:
+        print("error connecting to the database" + str(e))
         return
+    if (row != None):
+        user = User()
+        user.id = row[0]
+        user.name = row[2]
+        user.pict_file = str(row[3])
+        user.is_authenticated = (request.form['password'] == row[1])
+        return user
+    return
 
 
 @app.before_request
@@ -414,6 +707,60 @@ def before_request():
     flask.session.permanent = True
     app.permanent_session_lifetime = datetime.timedelta(minutes=5)
     flask.session.modified = True
+
+
+@app.after_request
+def after_request(response):
+    """ Long-lived caching for versioned static files, ETags and gzip for everything that isn't streamed """
+    accepts_gzip = ('gzip' in flask.request.headers.get('Accept-Encoding', ''))
+    if (response.status_code != 200 or 'Content-Encoding' in response.headers):
+        return response
+    
+    if (flask.request.endpoint == 'static'):
+        if (flask.request.args.get('v') != None):
+            response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        if (response.mimetype in compressible_types):
+            #Flask gives static files an ETag, which is also used to remember the compressed copy
+            (etag, weak) = response.get_etag()
+            if (accepts_gzip):
+                compressed = cached_compressed_static(etag)
+                if (compressed == None):
+                    response.direct_passthrough = False
+                    compressed = gzip.compress(response.get_data())
+                    if (etag != None):
+                        cache_compressed_static(etag, compressed)
+                response.close()
+                response.set_data(compressed)
+                response.headers['Content-Encoding'] = 'gzip'
+            response.vary.add('Accept-Encoding')
+        return response
+    
+    if (response.is_streamed or response.mimetype not in compressible_types):
+        return response
+    
+    data = response.get_data()
+    response.set_etag(hashlib.sha1(data).hexdigest(), weak=True)
+    response.make_conditional(flask.request)
+    if (response.status_code == 200 and len(data) > 512 and accepts_gzip):
+        response.set_data(gzip.compress(data, compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+@app.route('/bundles/<name>')
+def bundle(name):
+    """ CSS and JavaScript taken out of the pages. The name changes with the content, so it never goes stale """
+    if name not in bundles:
+        return flask.abort(404)
+    (data, compressed, mimetype) = bundles[name]
+    response = flask.Response(data, mimetype=mimetype)
+    if ('gzip' in flask.request.headers.get('Accept-Encoding', '')):
+        response.set_data(compressed)
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    response.vary.add('Accept-Encoding')
+    return response
         
 @app.route('/')
 def index():
@@ -426,42 +773,26 @@ def index():
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if flask.request.method == 'GET':
-        return pages.login_head + pages.login_body
+        return static_chunk('login_head', 'login_body')
 
     username = flask.request.form['username']
     password = flask.request.form['password']
     
-    database = "openplc.db"
-    conn = create_connection(database)
-    if (conn != None):
-        try:
-            cur = conn.cursor()
-            cur.execute("SELECT username, password, name, pict_file FROM Users")
-            rows = cur.fetchall()
-            cur.close()
-            conn.close()
-
-            for row in rows:
-                if (row[0] == username):
-                    if (row[1] == password):
-                        user = User()
-                        user.id = row[0]
-                        user.name = row[2]
-                        user.pict_file = str(row[3])
-                        flask_login.login_user(user)
-                        return flask.redirect(flask.url_for('dashboard'))
-                    else:
-                        return pages.login_head + pages.bad_login_body
-                        
-            return pages.login_head + pages.bad_login_body
-                    
-        except Error as e:
-            print("error connecting to the database" + str(e))
-            return 'Error opening DB'
-    else:
-        return 'Error opening DB'
+    try:
+        row = find_user(username)
+    except Error as e:
+        #a database that can't be read is not a wrong password
+        print("error connecting to the database" + str(e))
+        return 'Error opening DB', 500
+    if (row != None and row[1] == password):
+        user = User()
+        user.id = row[0]
+        user.name = row[2]
+        user.pict_file = str(row[3])
+        flask_login.login_user(user)
+        return flask.redirect(flask.url_for('dashboard'))
 
-    return pages.login_head + pages.bad_login_body
+    return static_chunk('login_head', 'bad_login_body')
 
 
 @app.route('/start_plc')
@@ -470,12 +801,7 @@ def start_plc():
     if (flask_login.current_user.is_authenticated == False):
         return flask.redirect(flask.url_for('login'))
     else:
-        monitor.stop_monitor()
-        openplc_runtime.start_runtime()
-        time.sleep(1)
-        configure_runtime()
-        monitor.cleanup()
-        monitor.parse_st(openplc_runtime.project_file)
+        run_runtime_task(start_plc_program)
         return flask.redirect(flask.url_for('dashboard'))
 
 
@@ -485,9 +811,7 @@ def stop_plc():
     if (flask_login.current_user.is_authenticated == False):
         return flask.redirect(flask.url_for('login'))
     else:
-        openplc_runtime.stop_runtime()
-        time.sleep(1)
-        monitor.stop_monitor()
+        run_runtime_task(stop_plc_program)
         return flask.redirect(flask.url_for('dashboard'))
 
 
@@ -497,7 +821,28 @@ def runtime_logs():
     if (flask_login.current_user.is_authenticated == False):
         return flask.redirect(flask.url_for('login'))
     else:
-        return openplc_runtime.logs()
+        return query_runtime(openplc_runtime.logs, '')
+
+
+@app.route('/runtime_logs_since')
+def runtime_logs_since():
+    global openplc_runtime
+    if (flask_login.current_user.is_authenticated == False):
+        return flask.redirect(flask.url_for('login'))
+    else:
+        (epoch, cursor) = parse_log_cursor(flask.request.args.get('cursor'))
+        (epoch, next_cursor, logs) = query_runtime(lambda: openplc_runtime.logs_since(cursor, epoch), (openplc_runtime.log_epoch if epoch is None else epoch, cursor, ''))
+        return flask.jsonify(cursor=str(epoch) + '-' + str(next_cursor), epoch=epoch, logs=logs)
+
+
+@app.route('/runtime_logs_stream')
+def runtime_logs_stream():
+    if (flask_login.current_user.is_authenticated == False):
+        return flask.redirect(flask.url_for('login'))
+    else:
+        # EventSource sends back the id of the last event it got when it reconnects
+        (epoch, cursor) = parse_log_cursor(flask.request.headers.get('Last-Event-ID', flask.request.args.get('cursor')))
+        return flask.Response(stream_runtime_logs(epoch, cursor), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 @app.route('/dashboard')
@@ -508,23 +853,7 @@ def dashboard():
     else:
         monitor.stop_monitor()
         if (openplc_runtime.status() == "Compiling"): return draw_compiling_page()
-        return_str = pages.w3_style + pages.dashboard_head + draw_top_div()
-        return_str += """
-            <div class='main'>
-                <div class='w3-sidebar w3-bar-block' style='width:250px; background-color:#1F1F1F'>
-                    <br>
-                    <br>
-                    <a href='dashboard' class='w3-bar-item w3-button' style='background-color:#0066FC; padding-right:0px;padding-top:0px;padding-bottom:0px'><img src='/static/home-icon-64x64.png' alt='Dashboard' style='width:47px;height:39px;padding:7px 15px 0px 0px;float:left'><img src='/static/arrow.png' style='width:17px;height:49px;padding:0px 0px 0px 0px;margin: 0px 0px 0px 0px; float:right'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 10px 0px 0px 0px'>Dashboard</p></a>
-                    <a href='programs' class='w3-bar-item w3-button'><img src='/static/programs-icon-64x64.png' alt='Programs' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Programs</p></a>
-                    <a href='modbus' class='w3-bar-item w3-button'><img src='/static/modbus-icon-512x512.png' alt='Modbus' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Slave Devices</p></a>
-                    <a href='monitoring' class='w3-bar-item w3-button'><img src='/static/monitoring-icon-64x64.png' alt='Monitoring' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Monitoring</p></a>
-                    <a href='hardware' class='w3-bar-item w3-button'><img src='/static/hardware-icon-980x974.png' alt='Hardware' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Hardware</p></a>
-                    <a href='users' class='w3-bar-item w3-button'><img src='/static/users-icon-64x64.png' alt='Users' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Users</p></a>
-                    <a href='settings' class='w3-bar-item w3-button'><img src='/static/settings-icon-64x64.png' alt='Settings' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Settings</p></a>
-                    <a href='logout' class='w3-bar-item w3-button'><img src='/static/logout-icon-64x64.png' alt='Logout' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Logout</p></a>
-                    <br>
-                    <br>"""
-        return_str += draw_status()
+        return_str = draw_page('dashboard_head', 'dashboard')
         return_str += """
         </div>
                 <div style='margin-left:320px'>
@@ -542,11 +871,79 @@ def dashboard():
         return_str += "<p style='font-family:'Roboto', sans-serif; font-size:16px'><b>File:</b> " + openplc_runtime.project_file + "</p>"
         return_str += "<p style='font-family:'Roboto', sans-serif; font-size:16px'><b>Runtime:</b> " + openplc_runtime.exec_time() + "</p>"
         
-        return_str += pages.dashboard_tail
+        return_str += static_chunk('dashboard_tail')
         
         return return_str
 
 
+max_programs_page = 100
+
+
+def parse_program_cursor(value):
+    """ Cursors look like '<Date_upload>-<Prog_ID>' of the last row on the previous page """
+    try:
+        (date_upload, prog_id) = value.split('-')
+        return (int(date_upload), int(prog_id))
+    except (AttributeError, ValueError):
+        return None
+
+
+def list_programs(search=None, cursor=None, limit=10):
+    """ One page of programs, newest first. Returns the rows and the cursor of the next page, or None on the last page """
+    query = "SELECT Prog_ID, Name, File, Date_upload FROM Programs"
+    conditions = []
+    params = []
+    if (cursor != None):
+        #Written so SQLite can seek the Date_upload index to the cursor instead of scanning from the top
+        conditions.append("Date_upload <= ? AND (Date_upload < ? OR Prog_ID < ?)")
+        params += [cursor[0], cursor[0], cursor[1]]
+    if search:
+        conditions.append("Name LIKE ? ESCAPE '\\'")
+        params.append('%' + search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY Date_upload DESC, Prog_ID DESC LIMIT ?"
+    #One extra row tells whether there is a next page
+    params.append(limit + 1)
+    
+    conn = create_connection("openplc.db")
+    if (conn == None):
+        raise Error("Error opening DB")
+    try:
+        cur = conn.cursor()
+        cur.execute(query, params)
+        rows = cur.fetchall()
+        cur.close()
+    finally:
+        conn.close()
+    
+    next_cursor = None
+    if (len(rows) > limit):
+        rows = rows[:limit]
+        next_cursor = str(rows[-1][3]) + '-' + str(rows[-1][0])
+    return (rows, next_cursor)
+
+
+@app.route('/program-list')
+def program_list():
+    if (flask_login.current_user.is_authenticated == False):
+        return flask.redirect(flask.url_for('login'))
+    else:
+        try:
+            limit = min(max(int(flask.request.args.get('limit', '10')), 1), max_programs_page)
+        except ValueError:
+            limit = 10
+        cursor = parse_program_cursor(flask.request.args.get('cursor'))
+        try:
+            (rows, next_cursor) = list_programs(flask.request.args.get('search'), cursor, limit)
+        except Error as e:
+            print("error connecting to the database" + str(e))
+            return flask.jsonify(error=str(e)), 500
+        
+        programs = [{'id': row[0], 'name': row[1], 'file': row[2], 'date_upload': row[3]} for row in rows]
+        return flask.jsonify(programs=programs, next=next_cursor)
+
+
 @app.route('/programs', methods=['GET', 'POST'])
 def programs():
     if (flask_login.current_user.is_authenticated == False):
@@ -554,26 +951,10 @@ def programs():
     else:
         monitor.stop_monitor()
         if (openplc_runtime.status() == "Compiling"): return draw_compiling_page()
-        list_all = False
-        if (flask.request.args.get('list_all') == '1'):
-            list_all = True
-        return_str = pages.w3_style + pages.style + draw_top_div()
-        return_str += """
-            <div class='main'>
-                <div class='w3-sidebar w3-bar-block' style='width:250px; background-color:#1F1F1F'>
-                    <br>
-                    <br>
-                    <a href="dashboard" class="w3-bar-item w3-button"><img src="/static/home-icon-64x64.png" alt="Dashboard" style="width:47px;height:32px;padding:0px 15px 0px 0px;float:left"><p style='font-family:"Roboto", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Dashboard</p></a>
-                    <a href="programs" class="w3-bar-item w3-button" style="background-color:#0066FC; padding-right:0px;padding-top:0px;padding-bottom:0px"><img src="/static/programs-icon-64x64.png" alt="Programs" style="width:47px;height:39px;padding:7px 15px 0px 0px;float:left"><img src="/static/arrow.png" style="width:17px;height:49px;padding:0px 0px 0px 0px;margin: 0px 0px 0px 0px; float:right"><p style='font-family:"Roboto", sans-serif; font-size:20px; color:white;margin: 10px 0px 0px 0px'>Programs</p></a>
-                    <a href='modbus' class='w3-bar-item w3-button'><img src='/static/modbus-icon-512x512.png' alt='Modbus' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Slave Devices</p></a>
-                    <a href='monitoring' class='w3-bar-item w3-button'><img src='/static/monitoring-icon-64x64.png' alt='Monitoring' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Monitoring</p></a>
-                    <a href='hardware' class='w3-bar-item w3-button'><img src='/static/hardware-icon-980x974.png' alt='Hardware' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Hardware</p></a>
-                    <a href='users' class='w3-bar-item w3-button'><img src='/static/users-icon-64x64.png' alt='Users' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Users</p></a>
-                    <a href='settings' class='w3-bar-item w3-button'><img src='/static/settings-icon-64x64.png' alt='Settings' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Settings</p></a>
-                    <a href='logout' class='w3-bar-item w3-button'><img src='/static/logout-icon-64x64.png' alt='Logout' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Logout</p></a>
-                    <br>
-                    <br>"""
-        return_str += draw_status()
+        list_all = (flask.request.args.get('list_all') == '1')
+        search = flask.request.args.get('search', '')
+        cursor = parse_program_cursor(flask.request.args.get('cursor'))
+        return_str = draw_page('style', 'programs')
         return_str += """
         </div>
             <div style="margin-left:320px; margin-right:70px">
@@ -581,30 +962,38 @@ def programs():
                     <br>
                     <h2>Programs</h2>
                     <p>Here you can upload a new program to OpenPLC or revert back to a previous uploaded program shown on the table.</p>
+                    <form action="programs" method="get">
+                        <input type="text" name="search" placeholder="Search by program name" value='""" + escape(search) + "'>"
+        if (list_all):
+            return_str += "<input type='hidden' name='list_all' value='1'>"
+        return_str += """
+                    </form>
                     <table>
                         <tr style='background-color: white'>
                             <th>Program Name</th><th>File</th><th>Date Uploaded</th>
                         </tr>"""
-        database = "openplc.db"
-        conn = create_connection(database)
-        if (conn != None):
-            try:
-                cur = conn.cursor()
-                if (list_all == True):
-                    cur.execute("SELECT Prog_ID, Name, File, Date_upload FROM Programs ORDER BY Date_upload DESC")
-                else:
-                    cur.execute("SELECT Prog_ID, Name, File, Date_upload FROM Programs ORDER BY Date_upload DESC LIMIT 10")
-                rows = cur.fetchall()
-                cur.close()
-                conn.close()
-                
-                for row in rows:
-                    return_str += "<tr onclick=\"document.location='reload-program?table_id=" + str(row[0]) + "'\">"
-                    return_str += "<td>" + str(row[1]) + "</td><td>" + str(row[2]) + "</td><td>" + time.strftime('%b %d, %Y - %I:%M%p', time.localtime(row[3])) + "</td></tr>"
-                    
-                return_str += """
-                    </table>
-                    <a href="programs?list_all=1" style="text-align:right; float:right; color:black; font-weight:bold;">List all programs</a>
+        try:
+            (rows, next_cursor) = list_programs(search, cursor, max_programs_page if list_all else 10)
+            
+            for row in rows:
+                return_str += "<tr onclick=\"document.location='reload-program?table_id=" + str(row[0]) + "'\">"
+                return_str += "<td>" + str(row[1]) + "</td><td>" + str(row[2]) + "</td><td>" + time.strftime('%b %d, %Y - %I:%M%p', time.localtime(row[3])) + "</td></tr>"
+            
+            #Page links keep the search and page size of the current listing
+            page_args = ''
+            if search:
+                page_args += '&search=' + urllib.parse.quote(search)
+            if list_all:
+                page_args += '&list_all=1'
+            return_str += """
+                    </table>"""
+            if (next_cursor != None):
+                return_str += '<a href="programs?cursor=' + next_cursor + page_args + '" style="text-align:right; float:right; color:black; font-weight:bold; margin-left:20px;">Next page</a>'
+            if (cursor != None):
+                return_str += '<a href="programs?' + page_args[1:] + '" style="text-align:right; float:right; color:black; font-weight:bold; margin-left:20px;">First page</a>'
+            if (not list_all):
+                return_str += '<a href="programs?list_all=1" style="text-align:right; float:right; color:black; font-weight:bold;">List all programs</a>'
+            return_str += """
                     <br>
                     <br>
                     <h2>Upload Program</h2>
@@ -621,15 +1010,68 @@ def programs():
         </div>
     </body>
 </html>"""
-            except Error as e:
-                print("error connecting to the database" + str(e))
-                return_str += 'Error connecting to the database. Make sure that your openplc.db file is not corrupt.<br><br>Error: ' + str(e)
-        else:
-            return_str += 'Error connecting to the database. Make sure that your openplc.db file is not corrupt.'
+        except Error as e:
+            print("error connecting to the database" + str(e))
+            return_str += 'Error connecting to the database. Make sure that your openplc.db file is not corrupt.<br><br>Error: ' + str(e)
         
         return return_str
 
 
+program_chunk_size = 64 * 1024
+program_file_name = re.compile(r'^[0-9a-f]{64}\.st$')
+
+
+def store_program_file(upload):
+    """ Streams an uploaded program into st_files under the sha256 of its contents. Returns the file name """
+    digest = hashlib.sha256()
+    (fd, tmp_path) = tempfile.mkstemp(dir='st_files', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            while True:
+                chunk = upload.stream.read(program_chunk_size)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                f.write(chunk)
+        filename = digest.hexdigest() + '.st'
+        #Same program was uploaded before: keep that copy
+        if not os.path.isfile(os.path.join('st_files', filename)):
+            os.replace(tmp_path, os.path.join('st_files', filename))
+        return filename
+    finally:
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+
+
+def find_program_by_file(cur, filename):
+    """ Prog_ID of the program stored in filename, or None """
+    cur.execute("SELECT Prog_ID FROM Programs WHERE File = ? LIMIT 1", (filename,))
+    row = cur.fetchone()
+    if (row == None):
+        return None
+    return row[0]
+
+
+def release_program_file(cur, filename):
+    """ Deletes a stored program file once no program uses it, no compile job needs it and it is not the one loaded on the runtime """
+    if not program_file_name.match(filename):
+        #only files named by their contents are managed here, older uploads are left alone
+        return
+    if (find_program_by_file(cur, filename) != None):
+        return
+    if openplc_runtime.compile_queue.building(filename):
+        return
+    try:
+        with open('active_program') as f:
+            if (f.read().strip() == filename):
+                return
+    except IOError:
+        pass
+    for path in (os.path.join('st_files', filename), os.path.join('st_files', filename + '.dbg')):
+        if os.path.isfile(path):
+            os.remove(path)
+
+
 @app.route('/reload-program', methods=['GET', 'POST'])
 def reload_program():
     if (flask_login.current_user.is_authenticated == False):
@@ -637,23 +1079,7 @@ def reload_program():
     else:
         if (openplc_runtime.status() == "Compiling"): return draw_compiling_page()
         prog_id = flask.request.args.get('table_id')
-        return_str = pages.w3_style + pages.style + draw_top_div()
-        return_str += """
-            <div class='main'>
-                <div class='w3-sidebar w3-bar-block' style='width:250px; background-color:#1F1F1F'>
-                    <br>
-                    <br>
-                    <a href="dashboard" class="w3-bar-item w3-button"><img src="/static/home-icon-64x64.png" alt="Dashboard" style="width:47px;height:32px;padding:0px 15px 0px 0px;float:left"><p style='font-family:"Roboto", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Dashboard</p></a>
-                    <a href="programs" class="w3-bar-item w3-button" style="background-color:#0066FC; padding-right:0px;padding-top:0px;padding-bottom:0px"><img src="/static/programs-icon-64x64.png" alt="Programs" style="width:47px;height:39px;padding:7px 15px 0px 0px;float:left"><img src="/static/arrow.png" style="width:17px;height:49px;padding:0px 0px 0px 0px;margin: 0px 0px 0px 0px; float:right"><p style='font-family:"Roboto", sans-serif; font-size:20px; color:white;margin: 10px 0px 0px 0px'>Programs</p></a>
-                    <a href='modbus' class='w3-bar-item w3-button'><img src='/static/modbus-icon-512x512.png' alt='Modbus' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Slave Devices</p></a>
-                    <a href='monitoring' class='w3-bar-item w3-button'><img src='/static/monitoring-icon-64x64.png' alt='Monitoring' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Monitoring</p></a>
-                    <a href='hardware' class='w3-bar-item w3-button'><img src='/static/hardware-icon-980x974.png' alt='Hardware' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Hardware</p></a>
-                    <a href='users' class='w3-bar-item w3-button'><img src='/static/users-icon-64x64.png' alt='Users' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Users</p></a>
-                    <a href='settings' class='w3-bar-item w3-button'><img src='/static/settings-icon-64x64.png' alt='Settings' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Settings</p></a>
-                    <a href='logout' class='w3-bar-item w3-button'><img src='/static/logout-icon-64x64.png' alt='Logout' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Logout</p></a>
-                    <br>
-                    <br>"""
-        return_str += draw_status()
+        return_str = draw_page('style', 'programs')
         return_str += """
             </div>
             <div style="margin-left:320px; margin-right:70px">
@@ -675,6 +1101,9 @@ def reload_program():
                 return_str += "<label for='prog_file'><b>File</b></label><input type='text' id='prog_file' name='program_file' value='" + str(row[3]) + "' disabled>"
                 return_str += "<label for='prog_date'><b>Date Uploaded</b></label><input type='text' id='prog_date' name='program_date' value='" + time.strftime('%b %d, %Y - %I:%M%p', time.localtime(row[4])) + "' disabled>"
                 return_str += "<br><br><center><a href='compile-program?file=" + str(row[3]) + "' class='button' style='width: 200px; height: 53px; margin: 0px 20px 0px 20px;'><b>Launch program</b></a><a href='update-program?id=" + str(prog_id) + "' class='button' style='width: 200px; height: 53px; margin: 0px 20px 0px 20px;'><b>Update program</b></a><a href='remove-program?id=" + str(prog_id) + "' class='button' style='width: 200px; height: 53px; margin: 0px 20px 0px 20px;'><b>Remove program</b></a></center>"
+                if (openplc_runtime.status() == "Running"):
+                    #build while the current program keeps running, then restart on the new one
+                    return_str += "<br><center><a href='compile-program?file=" + str(row[3]) + "&hot_swap=1' class='button' style='width: 310px; height: 53px; margin: 0px 20px 0px 20px;'><b>Launch without stopping</b></a></center>"
                 return_str += """
                 </div>
             </div>
@@ -699,23 +1128,7 @@ def update_program():
         if (openplc_runtime.status() == "Compiling"): return draw_compiling_page()
         prog_id = flask.request.args.get('id')
         
-        return_str = pages.w3_style + pages.style + draw_top_div()
-        return_str += """
-            <div class='main'>
-                <div class='w3-sidebar w3-bar-block' style='width:250px; background-color:#1F1F1F'>
-                    <br>
-                    <br>
-                    <a href="dashboard" class="w3-bar-item w3-button"><img src="/static/home-icon-64x64.png" alt="Dashboard" style="width:47px;height:32px;padding:0px 15px 0px 0px;float:left"><p style='font-family:"Roboto", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Dashboard</p></a>
-                    <a href="programs" class="w3-bar-item w3-button" style="background-color:#0066FC; padding-right:0px;padding-top:0px;padding-bottom:0px"><img src="/static/programs-icon-64x64.png" alt="Programs" style="width:47px;height:39px;padding:7px 15px 0px 0px;float:left"><img src="/static/arrow.png" style="width:17px;height:49px;padding:0px 0px 0px 0px;margin: 0px 0px 0px 0px; float:right"><p style='font-family:"Roboto", sans-serif; font-size:20px; color:white;margin: 10px 0px 0px 0px'>Programs</p></a>
-                    <a href='modbus' class='w3-bar-item w3-button'><img src='/static/modbus-icon-512x512.png' alt='Modbus' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Slave Devices</p></a>
-                    <a href='monitoring' class='w3-bar-item w3-button'><img src='/static/monitoring-icon-64x64.png' alt='Monitoring' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Monitoring</p></a>
-                    <a href='hardware' class='w3-bar-item w3-button'><img src='/static/hardware-icon-980x974.png' alt='Hardware' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Hardware</p></a>
-                    <a href='users' class='w3-bar-item w3-button'><img src='/static/users-icon-64x64.png' alt='Users' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Users</p></a>
-                    <a href='settings' class='w3-bar-item w3-button'><img src='/static/settings-icon-64x64.png' alt='Settings' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Settings</p></a>
-                    <a href='logout' class='w3-bar-item w3-button'><img src='/static/logout-icon-64x64.png' alt='Logout' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Logout</p></a>
-                    <br>
-                    <br>"""
-        return_str += draw_status()
+        return_str = draw_page('style', 'programs')
         return_str += """
         </div>
             <div style="margin-left:320px; margin-right:70px">
@@ -749,10 +1162,10 @@ def update_program_action():
     else:
         if (openplc_runtime.status() == "Compiling"): return draw_compiling_page()
         if ('file' not in flask.request.files):
-            return draw_blank_page() + "<h2>Error</h2><p>You need to select a file to be uploaded!<br><br>Use the back-arrow on your browser to return</p></div></div></div></body></html>"
+            return draw_blank_page("<h2>Error</h2><p>You need to select a file to be uploaded!<br><br>Use the back-arrow on your browser to return</p></div></div></div></body></html>")
         prog_file = flask.request.files['file']
         if (prog_file.filename == ''):
-            return draw_blank_page() + "<h2>Error</h2><p>You need to select a file to be uploaded!<br><br>Use the back-arrow on your browser to return</p></div></div></div></body></html>"
+            return draw_blank_page("<h2>Error</h2><p>You need to select a file to be uploaded!<br><br>Use the back-arrow on your browser to return</p></div></div></div></body></html>")
         prog_id = flask.request.form['prog_id']
         epoch_time = flask.request.form['epoch_time']
         
@@ -763,10 +1176,16 @@ def update_program_action():
                 cur = conn.cursor()
                 cur.execute("SELECT * FROM Programs WHERE Prog_ID = ?", (int(prog_id),))
                 row = cur.fetchone()
-                cur.close()
                 
-                filename = str(row[3])
-                prog_file.save(os.path.join('st_files', filename))
+                #The new version gets its own file, the old one goes away if nothing else uses it
+                filename = store_program_file(prog_file)
+                old_filename = str(row[3])
+                if (filename != old_filename):
+                    cur.execute("UPDATE Programs SET File = ? WHERE Prog_ID = ?", (filename, int(prog_id)))
+                    conn.commit()
+                    release_program_file(cur, old_filename)
+                cur.close()
+                conn.close()
                 
                 #Redirect back to the compiling page
                 return '<!DOCTYPE html><html><head><meta http-equiv="refresh" content="0; url=/compile-program?file=' + filename + '"></head></html>'
@@ -790,8 +1209,12 @@ def remove_program():
         if (conn != None):
             try:
                 cur = conn.cursor()
+                cur.execute("SELECT File FROM Programs WHERE Prog_ID = ?", (int(prog_id),))
+                row = cur.fetchone()
                 cur.execute("DELETE FROM Programs WHERE Prog_ID = ?", (int(prog_id),))
                 conn.commit()
+                if (row != None):
+                    release_program_file(cur, str(row[0]))
                 cur.close()
                 conn.close()
                 return flask.redirect(flask.url_for('programs'))
@@ -810,31 +1233,27 @@ def upload_program():
     else:
         if (openplc_runtime.status() == "Compiling"): return draw_compiling_page()
         if ('file' not in flask.request.files):
-            return draw_blank_page() + "<h2>Error</h2><p>You need to select a file to be uploaded!<br><br>Use the back-arrow on your browser to return</p></div></div></div></body></html>"
+            return draw_blank_page("<h2>Error</h2><p>You need to select a file to be uploaded!<br><br>Use the back-arrow on your browser to return</p></div></div></div></body></html>")
         prog_file = flask.request.files['file']
         if (prog_file.filename == ''):
-            return draw_blank_page() + "<h2>Error</h2><p>You need to select a file to be uploaded!<br><br>Use the back-arrow on your browser to return</p></div></div></div></body></html>"
+            return draw_blank_page("<h2>Error</h2><p>You need to select a file to be uploaded!<br><br>Use the back-arrow on your browser to return</p></div></div></div></body></html>")
         
-        filename = str(random.randint(1,1000000)) + ".st"
-        prog_file.save(os.path.join('st_files', filename))
+        filename = store_program_file(prog_file)
         
-        return_str = pages.w3_style + pages.style + draw_top_div()
-        return_str += """
-            <div class='main'>
-                <div class='w3-sidebar w3-bar-block' style='width:250px; background-color:#1F1F1F'>
-                    <br>
-                    <br>
-                    <a href="dashboard" class="w3-bar-item w3-button"><img src="/static/home-icon-64x64.png" alt="Dashboard" style="width:47px;height:32px;padding:0px 15px 0px 0px;float:left"><p style='font-family:"Roboto", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Dashboard</p></a>
-                    <a href="programs" class="w3-bar-item w3-button" style="background-color:#0066FC; padding-right:0px;padding-top:0px;padding-bottom:0px"><img src="/static/programs-icon-64x64.png" alt="Programs" style="width:47px;height:39px;padding:7px 15px 0px 0px;float:left"><img src="/static/arrow.png" style="width:17px;height:49px;padding:0px 0px 0px 0px;margin: 0px 0px 0px 0px; float:right"><p style='font-family:"Roboto", sans-serif; font-size:20px; color:white;margin: 10px 0px 0px 0px'>Programs</p></a>
-                    <a href='modbus' class='w3-bar-item w3-button'><img src='/static/modbus-icon-512x512.png' alt='Modbus' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Slave Devices</p></a>
-                    <a href='monitoring' class='w3-bar-item w3-button'><img src='/static/monitoring-icon-64x64.png' alt='Monitoring' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Monitoring</p></a>
-                    <a href='hardware' class='w3-bar-item w3-button'><img src='/static/hardware-icon-980x974.png' alt='Hardware' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Hardware</p></a>
-                    <a href='users' class='w3-bar-item w3-button'><img src='/static/users-icon-64x64.png' alt='Users' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Users</p></a>
-                    <a href='settings' class='w3-bar-item w3-button'><img src='/static/settings-icon-64x64.png' alt='Settings' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Settings</p></a>
-                    <a href='logout' class='w3-bar-item w3-button'><img src='/static/logout-icon-64x64.png' alt='Logout' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Logout</p></a>
-                    <br>
-                    <br>"""
-        return_str += draw_status()
+        #An identical program is already in the list, open it instead of adding a copy
+        conn = create_connection("openplc.db")
+        if (conn != None):
+            try:
+                cur = conn.cursor()
+                prog_id = find_program_by_file(cur, filename)
+                cur.close()
+                conn.close()
+                if (prog_id != None):
+                    return flask.redirect(flask.url_for('reload_program', table_id=prog_id))
+            except Error as e:
+                print("error connecting to the database" + str(e))
+        
+        return_str = draw_page('style', 'programs')
         return_str += """
         </div>
             <div style="margin-left:320px; margin-right:70px">
@@ -901,8 +1320,10 @@ def upload_program_action():
         if (conn != None):
             try:
                 cur = conn.cursor()
-                cur.execute("INSERT INTO Programs (Name, Description, File, Date_upload) VALUES (?, ?, ?, ?)", (prog_name, prog_descr, prog_file, epoch_time))
-                conn.commit()
+                #the form can be sent twice for the same file, keep a single row for it
+                if (find_program_by_file(cur, prog_file) == None):
+                    cur.execute("INSERT INTO Programs (Name, Description, File, Date_upload) VALUES (?, ?, ?, ?)", (prog_name, prog_descr, prog_file, epoch_time))
+                    conn.commit()
                 cur.close()
                 conn.close()
                 #Redirect back to the compiling page
@@ -915,37 +1336,90 @@ def upload_program_action():
             return 'Error connecting to the database. Make sure that your openplc.db file is not corrupt.'
         
 
+def program_swapped(job):
+    """ Called by the runtime after a hot swap restarted it on the new program """
+    configure_runtime()
+    monitor.cleanup()
+    monitor.parse_st(job.st_file)
+
+
+def queue_compile_job(st_file, require_program=False, hot_swap=False):
+    """ Queues a build of st_file. Returns the CompileJob, or None if require_program is set and st_file is not in the Programs table """
+    global openplc_runtime
+    project_name = ''
+    project_description = ''
+    
+    #load information about the program being compiled, the runtime picks it up when the build starts
+    row = None
+    database = "openplc.db"
+    conn = create_connection(database)
+    if (conn != None):
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT * FROM Programs WHERE File=?", (st_file,))
+            row = cur.fetchone()
+            cur.close()
+            conn.close()
+            if (row != None):
+                project_name = str(row[1])
+                project_description = str(row[2])
+        except Error as e:
+            print("error connecting to the database" + str(e))
+    else:
+        print("error connecting to the database")
+    
+    #the build rewrites files named after st_file, so only known programs are accepted
+    if (row == None) and require_program:
+        return None
+    
+    if (hot_swap):
+        #the runtime decides whether retained values can be kept once the build is done
+        return openplc_runtime.compile_program(st_file, project_name, project_description, hot_swap=True, after_swap=program_swapped)
+    delete_persistent_file()
+    #the build stops the runtime, there is nothing left to sample
+    monitor.stop_recording()
+    return openplc_runtime.compile_program(st_file, project_name, project_description)
+
+
 @app.route('/compile-program', methods=['GET', 'POST'])
 def compile_program():
-    global openplc_runtime
     if (flask_login.current_user.is_authenticated == False):
         return flask.redirect(flask.url_for('login'))
     else:
-        if (openplc_runtime.status() == "Compiling"): return draw_compiling_page()
+        #builds are queued, so a program sent while another one compiles is built next
         st_file = flask.request.args.get('file')
+        job = queue_compile_job(st_file, require_program=True, hot_swap=(flask.request.args.get('hot_swap') == '1')) if st_file else None
+        if (job == None):
+            return draw_blank_page("<h2>Error</h2><p>This program is not in the programs list!<br><br>Use the back-arrow on your browser to return</p></div></div></div></body></html>"), 404
         
-        #load information about the program being compiled into the openplc_runtime object
-        database = "openplc.db"
-        conn = create_connection(database)
-        if (conn != None):
-            try:
-                cur = conn.cursor()
-                cur.execute("SELECT * FROM Programs WHERE File=?", (st_file,))
-                row = cur.fetchone()
-                openplc_runtime.project_name = str(row[1])
-                openplc_runtime.project_description = str(row[2])
-                openplc_runtime.project_file = str(row[3])
-                cur.close()
-                conn.close()
-            except Error as e:
-                print("error connecting to the database" + str(e))
-        else:
-            print("error connecting to the database")
-        
-        delete_persistent_file()
-        openplc_runtime.compile_program(st_file)
+        return draw_compiling_page(job)
+
+
+@app.route('/compile-jobs', methods=['GET', 'POST'])
+def compile_jobs():
+    if (flask_login.current_user.is_authenticated == False):
+        return flask.redirect(flask.url_for('login'))
+    else:
+        if (flask.request.method == 'POST'):
+            st_file = flask.request.values.get('file')
+            hot_swap = (flask.request.values.get('hot_swap') == '1')
+            job = queue_compile_job(st_file, require_program=True, hot_swap=hot_swap) if st_file else None
+            if (job == None):
+                return flask.jsonify(error='unknown program file'), 404
+            return flask.jsonify(job.to_dict()), 202
         
-        return draw_compiling_page()
+        return flask.jsonify(jobs=[job.to_dict() for job in openplc_runtime.compile_queue.jobs()])
+
+
+@app.route('/compile-jobs/<int:job_id>')
+def compile_job(job_id):
+    if (flask_login.current_user.is_authenticated == False):
+        return flask.redirect(flask.url_for('login'))
+    else:
+        job = openplc_runtime.compile_queue.get(job_id)
+        if (job == None):
+            return flask.jsonify(error='unknown job'), 404
+        return flask.jsonify(job.to_dict(logs=(flask.request.args.get('logs') == '1')))
 
 
 @app.route('/compilation-logs', methods=['GET', 'POST'])
@@ -956,6 +1430,31 @@ def compilation_logs():
         return openplc_runtime.compilation_status()
 
 
+@app.route('/compilation-logs-since')
+def compilation_logs_since():
+    if (flask_login.current_user.is_authenticated == False):
+        return flask.redirect(flask.url_for('login'))
+    else:
+        job = find_compile_job(flask.request.args.get('job'))
+        if (job == None):
+            return flask.jsonify(cursor=0, logs='', done=True)
+        (cursor, logs, done) = job.output_since(parse_cursor(flask.request.args.get('cursor')))
+        return flask.jsonify(job=job.id, cursor=cursor, logs=logs, done=done)
+
+
+@app.route('/compilation-logs-stream')
+def compilation_logs_stream():
+    if (flask_login.current_user.is_authenticated == False):
+        return flask.redirect(flask.url_for('login'))
+    else:
+        job = find_compile_job(flask.request.args.get('job'))
+        if (job == None):
+            return flask.Response('id: 0\ndata: ' + json.dumps({'logs': '', 'done': True}) + '\n\n', mimetype='text/event-stream')
+        # EventSource sends back the id of the last event it got when it reconnects
+        cursor = parse_cursor(flask.request.headers.get('Last-Event-ID', flask.request.args.get('cursor')))
+        return flask.Response(stream_compilation_logs(job, cursor), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 @app.route('/modbus', methods=['GET', 'POST'])
 def modbus():
     if (flask_login.current_user.is_authenticated == False):
@@ -963,23 +1462,7 @@ def modbus():
     else:
         monitor.stop_monitor()
         if (openplc_runtime.status() == "Compiling"): return draw_compiling_page()
-        return_str = pages.w3_style + pages.style + draw_top_div()
-        return_str += """
-            <div class='main'>
-                <div class='w3-sidebar w3-bar-block' style='width:250px; background-color:#1F1F1F'>
-                    <br>
-                    <br>
-                    <a href="dashboard" class="w3-bar-item w3-button"><img src="/static/home-icon-64x64.png" alt="Dashboard" style="width:47px;height:32px;padding:0px 15px 0px 0px;float:left"><p style='font-family:"Roboto", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Dashboard</p></a>
-                    <a href="programs" class="w3-bar-item w3-button"><img src="/static/programs-icon-64x64.png" alt="Programs" style="width:47px;height:32px;padding:0px 15px 0px 0px;float:left"><p style='font-family:"Roboto", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Programs</p></a>
-                    <a href="modbus" class="w3-bar-item w3-button" style="background-color:#0066FC; padding-right:0px;padding-top:0px;padding-bottom:0px"><img src="/static/modbus-icon-512x512.png" alt="Modbus" style="width:47px;height:39px;padding:7px 15px 0px 0px;float:left"><img src="/static/arrow.png" style="width:17px;height:49px;padding:0px 0px 0px 0px;margin: 0px 0px 0px 0px; float:right"><p style='font-family:"Roboto", sans-serif; font-size:20px; color:white;margin: 10px 0px 0px 0px'>Slave Devices</p></a>
-                    <a href='monitoring' class='w3-bar-item w3-button'><img src='/static/monitoring-icon-64x64.png' alt='Monitoring' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Monitoring</p></a>
-                    <a href='hardware' class='w3-bar-item w3-button'><img src='/static/hardware-icon-980x974.png' alt='Hardware' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Hardware</p></a>
-                    <a href='users' class='w3-bar-item w3-button'><img src='/static/users-icon-64x64.png' alt='Users' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Users</p></a>
-                    <a href='settings' class='w3-bar-item w3-button'><img src='/static/settings-icon-64x64.png' alt='Settings' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Settings</p></a>
-                    <a href='logout' class='w3-bar-item w3-button'><img src='/static/logout-icon-64x64.png' alt='Logout' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Logout</p></a>
-                    <br>
-                    <br>"""
-        return_str += draw_status()
+        return_str = draw_page('style', 'modbus')
         return_str += """
         </div>
             <div style="margin-left:320px; margin-right:70px">
@@ -1071,23 +1554,7 @@ def add_modbus_device():
     else:
         if (openplc_runtime.status() == "Compiling"): return draw_compiling_page()
         if (flask.request.method == 'GET'):
-            return_str = pages.w3_style + pages.style + draw_top_div()
-            return_str += """
-                <div class='main'>
-                    <div class='w3-sidebar w3-bar-block' style='width:250px; background-color:#1F1F1F'>
-                        <br>
-                        <br>
-                        <a href="dashboard" class="w3-bar-item w3-button"><img src="/static/home-icon-64x64.png" alt="Dashboard" style="width:47px;height:32px;padding:0px 15px 0px 0px;float:left"><p style='font-family:"Roboto", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Dashboard</p></a>
-                        <a href="programs" class="w3-bar-item w3-button"><img src="/static/programs-icon-64x64.png" alt="Programs" style="width:47px;height:32px;padding:0px 15px 0px 0px;float:left"><p style='font-family:"Roboto", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Programs</p></a>
-                        <a href="modbus" class="w3-bar-item w3-button" style="background-color:#0066FC; padding-right:0px;padding-top:0px;padding-bottom:0px"><img src="/static/modbus-icon-512x512.png" alt="Modbus" style="width:47px;height:39px;padding:7px 15px 0px 0px;float:left"><img src="/static/arrow.png" style="width:17px;height:49px;padding:0px 0px 0px 0px;margin: 0px 0px 0px 0px; float:right"><p style='font-family:"Roboto", sans-serif; font-size:20px; color:white;margin: 10px 0px 0px 0px'>Slave Devices</p></a>
-                        <a href='monitoring' class='w3-bar-item w3-button'><img src='/static/monitoring-icon-64x64.png' alt='Monitoring' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Monitoring</p></a>
-                        <a href='hardware' class='w3-bar-item w3-button'><img src='/static/hardware-icon-980x974.png' alt='Hardware' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Hardware</p></a>
-                        <a href='users' class='w3-bar-item w3-button'><img src='/static/users-icon-64x64.png' alt='Users' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Users</p></a>
-                        <a href='settings' class='w3-bar-item w3-button'><img src='/static/settings-icon-64x64.png' alt='Settings' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Settings</p></a>
-                        <a href='logout' class='w3-bar-item w3-button'><img src='/static/logout-icon-64x64.png' alt='Logout' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Logout</p></a>
-                        <br>
-                        <br>"""
-            return_str += draw_status()
+            return_str = draw_page('style', 'modbus')
             return_str += """
                 </div>
                 <div style="margin-left:320px; margin-right:70px">
@@ -1132,7 +1599,7 @@ def add_modbus_device():
                     port_name = port
                 return_str += "<option value='" + port_name + "'>" + port_name + "</option>"
             
-            return_str += pages.add_slave_devices_tail + pages.add_devices_script
+            return_str += static_chunk('add_slave_devices_tail', 'add_devices_script')
             
             return return_str
             
@@ -1191,23 +1658,7 @@ def modbus_edit_device():
         if (openplc_runtime.status() == "Compiling"): return draw_compiling_page()
         if (flask.request.method == 'GET'):
             dev_id = flask.request.args.get('table_id')
-            return_str = pages.w3_style + pages.style + draw_top_div()
-            return_str += """
-                <div class='main'>
-                    <div class='w3-sidebar w3-bar-block' style='width:250px; background-color:#1F1F1F'>
-                        <br>
-                        <br>
-                        <a href="dashboard" class="w3-bar-item w3-button"><img src="/static/home-icon-64x64.png" alt="Dashboard" style="width:47px;height:32px;padding:0px 15px 0px 0px;float:left"><p style='font-family:"Roboto", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Dashboard</p></a>
-                        <a href="programs" class="w3-bar-item w3-button"><img src="/static/programs-icon-64x64.png" alt="Programs" style="width:47px;height:32px;padding:0px 15px 0px 0px;float:left"><p style='font-family:"Roboto", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Programs</p></a>
-                        <a href="modbus" class="w3-bar-item w3-button" style="background-color:#0066FC; padding-right:0px;padding-top:0px;padding-bottom:0px"><img src="/static/modbus-icon-512x512.png" alt="Modbus" style="width:47px;height:39px;padding:7px 15px 0px 0px;float:left"><img src="/static/arrow.png" style="width:17px;height:49px;padding:0px 0px 0px 0px;margin: 0px 0px 0px 0px; float:right"><p style='font-family:"Roboto", sans-serif; font-size:20px; color:white;margin: 10px 0px 0px 0px'>Slave Devices</p></a>
-                        <a href='monitoring' class='w3-bar-item w3-button'><img src='/static/monitoring-icon-64x64.png' alt='Monitoring' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Monitoring</p></a>
-                        <a href='hardware' class='w3-bar-item w3-button'><img src='/static/hardware-icon-980x974.png' alt='Hardware' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Hardware</p></a>
-                        <a href='users' class='w3-bar-item w3-button'><img src='/static/users-icon-64x64.png' alt='Users' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Users</p></a>
-                        <a href='settings' class='w3-bar-item w3-button'><img src='/static/settings-icon-64x64.png' alt='Settings' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Settings</p></a>
-                        <a href='logout' class='w3-bar-item w3-button'><img src='/static/logout-icon-64x64.png' alt='Logout' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Logout</p></a>
-                        <br>
-                        <br>"""
-            return_str += draw_status()
+            return_str = draw_page('style', 'modbus')
             return_str += """
                 </div>
                 <div style="margin-left:320px; margin-right:70px">
@@ -1273,7 +1724,7 @@ def modbus_edit_device():
                         else:   
                             return_str += "<option value='" + port_name + "'>" + port_name + "</option>"
                     
-                    return_str += pages.edit_slave_devices_tail
+                    return_str += static_chunk('edit_slave_devices_tail')
                     return_str += dev_id
                     return_str += """' class="button" style="width: 310px; height: 53px; margin: 0px 20px 0px 20px;"><b>Delete device</b></a></center>
                     </form>
@@ -1281,7 +1732,7 @@ def modbus_edit_device():
             </div>
         </div>
     </body>"""
-                    return_str += pages.edit_devices_script
+                    return_str += static_chunk('edit_devices_script')
                     return_str += 'devid.value = "' + str(row[3]) + '";'
                     return_str += 'devcport.value = "' + str(row[4]) + '";'
                     return_str += 'devbaud.value = "' + str(row[5]) + '";'
@@ -1389,23 +1840,7 @@ def monitoring():
         return flask.redirect(flask.url_for('login'))
     else:
         if (openplc_runtime.status() == "Compiling"): return draw_compiling_page()
-        return_str = pages.w3_style + pages.monitoring_head + draw_top_div()
-        return_str += """
-            <div class='main'>
-                <div class='w3-sidebar w3-bar-block' style='width:250px; background-color:#1F1F1F'>
-                    <br>
-                    <br>
-                    <a href="dashboard" class="w3-bar-item w3-button"><img src="/static/home-icon-64x64.png" alt="Dashboard" style="width:47px;height:32px;padding:0px 15px 0px 0px;float:left"><p style='font-family:"Roboto", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Dashboard</p></a>
-                    <a href='programs' class='w3-bar-item w3-button'><img src='/static/programs-icon-64x64.png' alt='Programs' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Programs</p></a>
-                    <a href='modbus' class='w3-bar-item w3-button'><img src='/static/modbus-icon-512x512.png' alt='Modbus' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Slave Devices</p></a>
-                    <a href="monitoring" class="w3-bar-item w3-button" style="background-color:#0066FC; padding-right:0px;padding-top:0px;padding-bottom:0px"><img src="/static/monitoring-icon-64x64.png" alt="Monitoring" style="width:47px;height:39px;padding:7px 15px 0px 0px;float:left"><img src="/static/arrow.png" style="width:17px;height:49px;padding:0px 0px 0px 0px;margin: 0px 0px 0px 0px; float:right"><p style='font-family:"Roboto", sans-serif; font-size:20px; color:white;margin: 10px 0px 0px 0px'>Monitoring</p></a>                    
-                    <a href='hardware' class='w3-bar-item w3-button'><img src='/static/hardware-icon-980x974.png' alt='Hardware' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Hardware</p></a>
-                    <a href='users' class='w3-bar-item w3-button'><img src='/static/users-icon-64x64.png' alt='Users' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Users</p></a>
-                    <a href='settings' class='w3-bar-item w3-button'><img src='/static/settings-icon-64x64.png' alt='Settings' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Settings</p></a>
-                    <a href='logout' class='w3-bar-item w3-button'><img src='/static/logout-icon-64x64.png' alt='Logout' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Logout</p></a>
-                    <br>
-                    <br>"""
-        return_str += draw_status()
+        return_str = draw_page('monitoring_head', 'monitoring')
         return_str += """
         </div>
             <div style="margin-left:320px; margin-right:70px">
@@ -1427,42 +1862,20 @@ def monitoring():
         
         if (openplc_runtime.status() == "Running"):
             #Check Modbus Server status
-            modbus_enabled = False
-            modbus_port_cfg = 502
-            database = "openplc.db"
-            conn = create_connection(database)
-            if (conn != None):
-                try:
-                    print("Openning database")
-                    cur = conn.cursor()
-                    cur.execute("SELECT * FROM Settings")
-                    rows = cur.fetchall()
-                    cur.close()
-                    conn.close()
-
-                    for row in rows:
-                        if (row[0] == "Modbus_port"):
-                            if (row[1] != "disabled"):
-                                modbus_enabled = True
-                                modbus_port_cfg = int(row[1])
-                            else:
-                                modbus_enabled = False
-            
-                except Error as e:
-                    return "error connecting to the database" + str(e)
-            else:
-                return "Error opening DB"
+            modbus_port_cfg = get_settings().modbus_port()
             
-            if modbus_enabled == True:
+            if modbus_port_cfg != None:
                 monitor.start_monitor(modbus_port_cfg)
+                monitor_seq = monitor.change_seq
+                (monitor_version, variables) = monitor.snapshot()
                 data_index = 0
-                for debug_data in monitor.debug_vars:
+                for debug_data in variables:
                     return_str += '<tr style="height:60px">' # onclick="document.location=\'point-info?table_id=' + str(data_index) + '\'">'
                     return_str += '<td>' + debug_data.name + '</td><td>' + debug_data.type + '</td><td>' + debug_data.location + '</td><td>'
                     if (debug_data.location.find('QX') != -1):
                         return_str += '<button class="write-button true" onclick="fetch(\'/point-write?value=1&address=' + str(debug_data.location) + '\')">true</button>'
                         return_str += '<button class="write-button false" onclick="fetch(\'/point-write?value=0&address=' + str(debug_data.location) + '\')">false</button>'
-                    return_str += '</td><td valign="middle">'
+                    return_str += '</td><td valign="middle" id="value_' + str(data_index) + '" data-type="' + debug_data.type + '">'
                     if (debug_data.type == 'BOOL'):
                         if (debug_data.value == 0):
                             return_str += '<img src="/static/bool_false.png" alt="bool_false" style="width:40px;height:40px;vertical-align:middle; margin-right:10px">FALSE</td>'
@@ -1485,7 +1898,9 @@ def monitoring():
                         </table>
                     </div>
                     <input type='hidden' id='modbus_port_cfg' name='modbus_port_cfg' value='""" + str(modbus_port_cfg) + "'>"
-                return_str += pages.monitoring_tail
+                return_str += "<input type='hidden' id='monitor_seq' value='" + str(monitor_seq) + "'>"
+                return_str += "<input type='hidden' id='monitor_version' value='" + str(monitor_version) + "'>"
+                return_str += static_chunk('monitoring_tail')
             
             #Modbus Server is not enabled
             else:
@@ -1538,7 +1953,7 @@ def monitor_update():
                 if (debug_data.location.find('QX') != -1):
                     return_str += '<button class="write-button true" onclick="fetch(\'/point-write?value=1&address=' + str(debug_data.location) + '\')">true</button>'
                     return_str += '<button class="write-button false" onclick="fetch(\'/point-write?value=0&address=' + str(debug_data.location) + '\')">false</button>'
-                return_str += '</td><td valign="middle">'
+                return_str += '</td><td valign="middle" id="value_' + str(data_index) + '" data-type="' + debug_data.type + '">'
                 if (debug_data.type == 'BOOL'):
                     if (debug_data.value == 0):
                         return_str += '<img src="/static/bool_false.png" alt="bool_false" style="width:40px;height:40px;vertical-align:middle; margin-right:10px">FALSE</td>'
@@ -1563,6 +1978,79 @@ def monitor_update():
         
         return return_str
 
+@app.route('/monitor-changes')
+def monitor_changes():
+    if (flask_login.current_user.is_authenticated == False):
+        return flask.redirect(flask.url_for('login'))
+    else:
+        mb_port_cfg = flask.request.args.get('mb_port')
+        monitor.start_monitor(int(mb_port_cfg))
+        seq = parse_cursor(flask.request.args.get('seq'))
+        return flask.jsonify(collect_monitor_changes(seq))
+
+
+@app.route('/monitor-stream')
+def monitor_stream():
+    if (flask_login.current_user.is_authenticated == False):
+        return flask.redirect(flask.url_for('login'))
+    else:
+        mb_port_cfg = flask.request.args.get('mb_port')
+        monitor.start_monitor(int(mb_port_cfg))
+        # EventSource sends back the id of the last event it got when it reconnects
+        seq = parse_cursor(flask.request.headers.get('Last-Event-ID', flask.request.args.get('seq')))
+        min_interval = max(parse_cursor(flask.request.args.get('rate')), 100) / 1000.0
+        return flask.Response(stream_monitor_changes(seq, min_interval), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/monitor-history')
+def monitor_history():
+    if (flask_login.current_user.is_authenticated == False):
+        return flask.redirect(flask.url_for('login'))
+    else:
+        # Window defaults to the last minute. buckets > 0 returns
+        # [start, min, max, avg] per bucket instead of the raw samples
+        end = time.time()
+        start = end - 60
+        try:
+            if (flask.request.args.get('seconds') != None):
+                start = end - float(flask.request.args.get('seconds'))
+            if (flask.request.args.get('start') != None):
+                start = float(flask.request.args.get('start'))
+            if (flask.request.args.get('end') != None):
+                end = float(flask.request.args.get('end'))
+        except ValueError:
+            return flask.jsonify(error='invalid time window'), 400
+        if not (math.isfinite(start) and math.isfinite(end)):
+            return flask.jsonify(error='invalid time window'), 400
+        #More buckets than a history buffer holds samples can't add any detail
+        try:
+            buckets = int(flask.request.args.get('buckets', '0'))
+        except ValueError:
+            return flask.jsonify(error='invalid bucket count'), 400
+        if (buckets < 0) or (buckets > monitor.history_depth):
+            return flask.jsonify(error='invalid bucket count'), 400
+        
+        (version, variables) = monitor.snapshot()
+        if (flask.request.args.get('points') != None):
+            points = [int(point) for point in flask.request.args.get('points').split(',') if point.strip().isdigit()]
+        else:
+            points = range(len(variables))
+        
+        tags = []
+        for point in points:
+            if (point >= len(variables)) or (variables[point].history is None):
+                continue
+            debug_data = variables[point]
+            (times, values) = debug_data.history.window(start, end)
+            tag = {'point': point, 'name': debug_data.name, 'type': debug_data.type}
+            if (buckets > 0):
+                tag['buckets'] = monitor.downsample(times, values, start, end, buckets)
+            else:
+                tag['samples'] = [(timestamp, monitor.finite_or_none(value)) for (timestamp, value) in zip(times, values)]
+            tags.append(tag)
+        return flask.jsonify(version=version, start=start, end=end, tags=tags)
+
+
 @app.route('/point-write', methods=['GET', 'POST'])
 def point_write():
     if (flask_login.current_user.is_authenticated == False):
@@ -1570,7 +2058,8 @@ def point_write():
     else:
         point_value = flask.request.args.get('value')
         point_address = flask.request.args.get('address')
-        monitor.write_value(point_address, int(point_value))
+        point_value = int(point_value)
+        query_runtime(lambda: monitor.write_value(point_address, point_value), None)
         return ''
 
 @app.route('/point-info', methods=['GET', 'POST'])
@@ -1581,23 +2070,7 @@ def point_info():
         #if (openplc_runtime.status() == "Compiling"): return draw_compiling_page()
         point_id = flask.request.args.get('table_id')
         debug_data = monitor.debug_vars[int(point_id)]
-        return_str = pages.w3_style + pages.settings_style + draw_top_div()
-        return_str += """
-            <div class='main'>
-                <div class='w3-sidebar w3-bar-block' style='width:250px; background-color:#1F1F1F'>
-                    <br>
-                    <br>
-                    <a href="dashboard" class="w3-bar-item w3-button"><img src="/static/home-icon-64x64.png" alt="Dashboard" style="width:47px;height:32px;padding:0px 15px 0px 0px;float:left"><p style='font-family:"Roboto", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Dashboard</p></a>
-                    <a href='programs' class='w3-bar-item w3-button'><img src='/static/programs-icon-64x64.png' alt='Programs' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Programs</p></a>
-                    <a href='modbus' class='w3-bar-item w3-button'><img src='/static/modbus-icon-512x512.png' alt='Modbus' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Slave Devices</p></a>
-                    <a href="monitoring" class="w3-bar-item w3-button" style="background-color:#0066FC; padding-right:0px;padding-top:0px;padding-bottom:0px"><img src="/static/monitoring-icon-64x64.png" alt="Monitoring" style="width:47px;height:39px;padding:7px 15px 0px 0px;float:left"><img src="/static/arrow.png" style="width:17px;height:49px;padding:0px 0px 0px 0px;margin: 0px 0px 0px 0px; float:right"><p style='font-family:"Roboto", sans-serif; font-size:20px; color:white;margin: 10px 0px 0px 0px'>Monitoring</p></a>                    
-                    <a href='hardware' class='w3-bar-item w3-button'><img src='/static/hardware-icon-980x974.png' alt='Hardware' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Hardware</p></a>
-                    <a href='users' class='w3-bar-item w3-button'><img src='/static/users-icon-64x64.png' alt='Users' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Users</p></a>
-                    <a href='settings' class='w3-bar-item w3-button'><img src='/static/settings-icon-64x64.png' alt='Settings' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Settings</p></a>
-                    <a href='logout' class='w3-bar-item w3-button'><img src='/static/logout-icon-64x64.png' alt='Logout' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Logout</p></a>
-                    <br>
-                    <br>"""
-        return_str += draw_status()
+        return_str = draw_page('settings_style', 'monitoring')
         return_str += """
         </div>
             <div style="margin-left:320px; margin-right:70px">
@@ -1646,7 +2119,7 @@ def point_info():
             return_str += """
                         <input type='text' id='forced_value' name='forced_value' style="width:200px;height:30px;font-size: 16px;font-family: 'Roboto', sans-serif;" value='0'>
                         """
-        return_str += pages.point_info_tail
+        return_str += static_chunk('point_info_tail')
         return return_str
 
 
@@ -1696,8 +2169,7 @@ def hardware():
         if (openplc_runtime.status() == "Compiling"): return draw_compiling_page()
         if (flask.request.method == 'GET'):
             with open('./scripts/openplc_driver') as f: current_driver = f.read().rstrip()
-            return_str = pages.w3_style + pages.hardware_style + draw_top_div() + pages.hardware_head
-            return_str += draw_status()
+            return_str = draw_page('hardware_style', 'hardware')
             return_str += """
             </div>
             <div style="margin-left:320px; margin-right:70px">
@@ -1757,7 +2229,7 @@ def hardware():
                             <p>PSM is a powerful bridge that connects OpenPLC core to Python. You can use PSM to write your own OpenPLC driver in pure Python. See below for a sample driver that switches %IX0.0 every second</p>
                             <textarea wrap="off" spellcheck="false" name="custom_layer_code" id="custom_layer_code">"""
             with open('./core/psm/main.py') as f: return_str += f.read()
-            return_str += pages.hardware_tail
+            return_str += static_chunk('hardware_tail')
             
         else:
             hardware_layer = flask.request.form['hardware_layer']
@@ -1791,23 +2263,7 @@ def users():
     else:
         monitor.stop_monitor()
         if (openplc_runtime.status() == "Compiling"): return draw_compiling_page()
-        return_str = pages.w3_style + pages.style + draw_top_div()
-        return_str += """
-            <div class='main'>
-                <div class='w3-sidebar w3-bar-block' style='width:250px; background-color:#1F1F1F'>
-                    <br>
-                    <br>
-                    <a href="dashboard" class="w3-bar-item w3-button"><img src="/static/home-icon-64x64.png" alt="Dashboard" style="width:47px;height:32px;padding:0px 15px 0px 0px;float:left"><p style='font-family:"Roboto", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Dashboard</p></a>
-                    <a href='programs' class='w3-bar-item w3-button'><img src='/static/programs-icon-64x64.png' alt='Programs' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Programs</p></a>
-                    <a href='modbus' class='w3-bar-item w3-button'><img src='/static/modbus-icon-512x512.png' alt='Modbus' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Slave Devices</p></a>
-                    <a href='monitoring' class='w3-bar-item w3-button'><img src='/static/monitoring-icon-64x64.png' alt='Monitoring' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Monitoring</p></a>
-                    <a href='hardware' class='w3-bar-item w3-button'><img src='/static/hardware-icon-980x974.png' alt='Hardware' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Hardware</p></a>
-                    <a href="users" class="w3-bar-item w3-button" style="background-color:#0066FC; padding-right:0px;padding-top:0px;padding-bottom:0px"><img src="/static/users-icon-64x64.png" alt="Users" style="width:47px;height:39px;padding:7px 15px 0px 0px;float:left"><img src="/static/arrow.png" style="width:17px;height:49px;padding:0px 0px 0px 0px;margin: 0px 0px 0px 0px; float:right"><p style='font-family:"Roboto", sans-serif; font-size:20px; color:white;margin: 10px 0px 0px 0px'>Users</p></a>
-                    <a href='settings' class='w3-bar-item w3-button'><img src='/static/settings-icon-64x64.png' alt='Settings' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Settings</p></a>
-                    <a href='logout' class='w3-bar-item w3-button'><img src='/static/logout-icon-64x64.png' alt='Logout' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Logout</p></a>
-                    <br>
-                    <br>"""
-        return_str += draw_status()
+        return_str = draw_page('style', 'users')
         return_str += """
             </div>
             <div style="margin-left:320px; margin-right:70px">
@@ -1859,23 +2315,8 @@ def add_user():
     else:
         if (openplc_runtime.status() == "Compiling"): return draw_compiling_page()
         if (flask.request.method == 'GET'):
-            return_str = pages.w3_style + pages.style + draw_top_div()
-            return_str += """
-                <div class='main'>
-                    <div class='w3-sidebar w3-bar-block' style='width:250px; background-color:#1F1F1F'>
-                        <br>
-                        <br>
-                        <a href="dashboard" class="w3-bar-item w3-button"><img src="/static/home-icon-64x64.png" alt="Dashboard" style="width:47px;height:32px;padding:0px 15px 0px 0px;float:left"><p style='font-family:"Roboto", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Dashboard</p></a>
-                        <a href='programs' class='w3-bar-item w3-button'><img src='/static/programs-icon-64x64.png' alt='Programs' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Programs</p></a>
-                        <a href='modbus' class='w3-bar-item w3-button'><img src='/static/modbus-icon-512x512.png' alt='Modbus' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Slave Devices</p></a>
-                        <a href='monitoring' class='w3-bar-item w3-button'><img src='/static/monitoring-icon-64x64.png' alt='Monitoring' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Monitoring</p></a>
-                        <a href='hardware' class='w3-bar-item w3-button'><img src='/static/hardware-icon-980x974.png' alt='Hardware' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Hardware</p></a>
-                        <a href="users" class="w3-bar-item w3-button" style="background-color:#0066FC; padding-right:0px;padding-top:0px;padding-bottom:0px"><img src="/static/users-icon-64x64.png" alt="Users" style="width:47px;height:39px;padding:7px 15px 0px 0px;float:left"><img src="/static/arrow.png" style="width:17px;height:49px;padding:0px 0px 0px 0px;margin: 0px 0px 0px 0px; float:right"><p style='font-family:"Roboto", sans-serif; font-size:20px; color:white;margin: 10px 0px 0px 0px'>Users</p></a>
-                        <a href='settings' class='w3-bar-item w3-button'><img src='/static/settings-icon-64x64.png' alt='Settings' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Settings</p></a>
-                        <a href='logout' class='w3-bar-item w3-button'><img src='/static/logout-icon-64x64.png' alt='Logout' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Logout</p></a>
-                        <br>
-                        <br>"""
-            return_str += draw_status() + pages.add_user_tail
+            return_str = draw_page('style', 'users')
+            return_str += static_chunk('add_user_tail')
             return return_str
             
         elif (flask.request.method == 'POST'):
@@ -1909,6 +2350,7 @@ def add_user():
                     conn.commit()
                     cur.close()
                     conn.close()
+                    invalidate_user_cache()
                     return flask.redirect(flask.url_for('users'))
                     
                 except Error as e:
@@ -1926,23 +2368,7 @@ def edit_user():
         if (openplc_runtime.status() == "Compiling"): return draw_compiling_page()
         if (flask.request.method == 'GET'):
             user_id = flask.request.args.get('table_id')
-            return_str = pages.w3_style + pages.style + draw_top_div()
-            return_str += """
-                <div class='main'>
-                    <div class='w3-sidebar w3-bar-block' style='width:250px; background-color:#1F1F1F'>
-                        <br>
-                        <br>
-                        <a href="dashboard" class="w3-bar-item w3-button"><img src="/static/home-icon-64x64.png" alt="Dashboard" style="width:47px;height:32px;padding:0px 15px 0px 0px;float:left"><p style='font-family:"Roboto", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Dashboard</p></a>
-                        <a href='programs' class='w3-bar-item w3-button'><img src='/static/programs-icon-64x64.png' alt='Programs' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Programs</p></a>
-                        <a href='modbus' class='w3-bar-item w3-button'><img src='/static/modbus-icon-512x512.png' alt='Modbus' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Slave Devices</p></a>
-                        <a href='monitoring' class='w3-bar-item w3-button'><img src='/static/monitoring-icon-64x64.png' alt='Monitoring' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Monitoring</p></a>
-                        <a href='hardware' class='w3-bar-item w3-button'><img src='/static/hardware-icon-980x974.png' alt='Hardware' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Hardware</p></a>
-                        <a href="users" class="w3-bar-item w3-button" style="background-color:#0066FC; padding-right:0px;padding-top:0px;padding-bottom:0px"><img src="/static/users-icon-64x64.png" alt="Users" style="width:47px;height:39px;padding:7px 15px 0px 0px;float:left"><img src="/static/arrow.png" style="width:17px;height:49px;padding:0px 0px 0px 0px;margin: 0px 0px 0px 0px; float:right"><p style='font-family:"Roboto", sans-serif; font-size:20px; color:white;margin: 10px 0px 0px 0px'>Users</p></a>
-                        <a href='settings' class='w3-bar-item w3-button'><img src='/static/settings-icon-64x64.png' alt='Settings' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Settings</p></a>
-                        <a href='logout' class='w3-bar-item w3-button'><img src='/static/logout-icon-64x64.png' alt='Logout' style='width:47px;height:32px;padding:0px 15px 0px 0px;float:left'><p style='font-family:\"Roboto\", sans-serif; font-size:20px; color:white;margin: 2px 0px 0px 0px'>Logout</p></a>
-                        <br>
-                        <br>"""
-            return_str += draw_status()
+            return_str = draw_page('style', 'users')
             return_str += """
                 </div>
                 <div style="margin-left:320px; margin-right:70px">
@@ -2039,6 +2465,7 @@ def edit_user():
                             conn.commit()
                     cur.close()
                     conn.close()
+                    invalidate_user_cache()
                     return flask.redirect(flask.url_for('users'))
                     
                 except Error as e:
@@ -2065,13 +2492,14 @@ def delete_user():
                 if (flask_login.current_user.id == row[0]):
                     cur.close()
                     conn.close()
-                    return draw_blank_page() + "<h2>Error</h2><p>You cannot delete yourself!<br><br>Use the back-arrow on your browser to return</p></div></div></div></body></html>"
+                    return draw_blank_page("<h2>Error</h2><p>You cannot delete yourself!<br><br>Use the back-arrow on your browser to return</p></div></div></div></body></html>")
                 else:
                     cur = conn.cursor()
                     cur.execute("DELETE FROM Users WHERE user_id = ?", (int(user_id),))
                     conn.commit()
                     cur.close()
                     conn.close()
+                    invalidate_user_cache()
                     return flask.redirect(flask.url_for('users'))
             except Error as e:
                 print("error connecting to the database" + str(e))
@@ -2088,8 +2516,7 @@ def settings():
         monitor.stop_monitor()
         if (openplc_runtime.status() == "Compiling"): return draw_compiling_page()
         if (flask.request.method == 'GET'):
-            return_str = pages.w3_style + pages.settings_style + draw_top_div() + pages.settings_head
-            return_str += draw_status()
+            return_str = draw_page('settings_style', 'settings')
             return_str += """
             </div>
             <div style="margin-left:320px; margin-right:70px">
@@ -2125,152 +2552,130 @@ def settings():
                         <label class="container">
                             <b>Enable Modbus Server</b>"""
             
-            database = "openplc.db"
-            conn = create_connection(database)
-            if (conn != None):
-                try:
-                    cur = conn.cursor()
-                    cur.execute("SELECT * FROM Settings")
-                    rows = cur.fetchall()
-                    cur.close()
-                    conn.close()
-                    
-                    for row in rows:
-                        if (row[0] == "Modbus_port"):
-                            modbus_port = str(row[1])
-                        elif (row[0] == "Dnp3_port"):
-                            dnp3_port = str(row[1])
-                        elif (row[0] == "Enip_port"):
-                            enip_port = str(row[1])
-                        elif (row[0] == "Pstorage_polling"):
-                            pstorage_poll = str(row[1])
-                        elif (row[0] == "Start_run_mode"):
-                            start_run = str(row[1])
-                        elif (row[0] == "Slave_polling"):
-                            slave_polling = str(row[1])
-                        elif (row[0] == "Slave_timeout"):
-                            slave_timeout = str(row[1])
-                    
-                    if (modbus_port == 'disabled'):
-                        return_str += """
-                            <input id="modbus_server" type="checkbox">
-                            <span class="checkmark"></span>
-                        </label>
-                        <label for='modbus_server_port'><b>Modbus Server Port</b></label>
-                        <input type='text' id='modbus_server_port' name='modbus_server_port' value='502'>"""
-                    else:
-                        return_str += """
-                            <input id="modbus_server" type="checkbox" checked>
-                            <span class="checkmark"></span>
-                        </label>
-                        <label for='modbus_server_port'><b>Modbus Server Port</b></label>
-                        <input type='text' id='modbus_server_port' name='modbus_server_port' value='""" + modbus_port + "'>"
-                        
-                    return_str += """
-                        <br>
-                        <br>
-                        <br>
-                        <label class="container">
-                            <b>Enable DNP3 Server</b>"""
-                    
-                    if (dnp3_port == 'disabled'):
-                        return_str += """
-                            <input id="dnp3_server" type="checkbox">
-                            <span class="checkmark"></span>
-                        </label>
-                        <label for='dnp3_server_port'><b>DNP3 Server Port</b></label>
-                        <input type='text' id='dnp3_server_port' name='dnp3_server_port' value='20000'>"""
-                    else:
-                        return_str += """
-                            <input id="dnp3_server" type="checkbox" checked>
-                            <span class="checkmark"></span>
-                        </label>
-                        <label for='dnp3_server_port'><b>DNP3 Server Port</b></label>
-                        <input type='text' id='dnp3_server_port' name='dnp3_server_port' value='""" + dnp3_port + "'>"
-                    
-                    return_str += """
-                        <br>
-                        <br>
-                        <br>
-                        <label class="container">
-                            <b>Enable EtherNet/IP Server</b>"""
-                            
-                    if (enip_port == 'disabled'):
-                        return_str += """
-                            <input id="enip_server" type="checkbox">
-                            <span class="checkmark"></span>
-                        </label>
-                        <label for='enip_server_port'><b>EtherNet/IP Server Port</b></label>
-                        <input type='text' id='enip_server_port' name='enip_server_port' value='44818'>"""
-                    else:
-                        return_str += """
-                            <input id="enip_server" type="checkbox" checked>
-                            <span class="checkmark"></span>
-                        </label>
-                        <label for='enip_server_port'><b>EtherNet/IP Server Port</b></label>
-                        <input type='text' id='enip_server_port' name='enip_server_port' value='""" + enip_port + "'>"
-                    
-                    return_str += """
-                        <br>
-                        <br>
-                        <br>
-                        <label class="container">
-                            <b>Enable Persistent Storage Thread</b>"""
-                            
-                    if (pstorage_poll == 'disabled'):
-                        return_str += """
-                            <input id="pstorage_thread" type="checkbox">
-                            <span class="checkmark"></span>
-                        </label>
-                        <label for='pstorage_thread_poll'><b>Persistent Storage polling rate</b></label>
-                        <input type='text' id='pstorage_thread_poll' name='pstorage_thread_poll' value='10'>"""
-                    else:
-                        return_str += """
-                            <input id="pstorage_thread" type="checkbox" checked>
-                            <span class="checkmark"></span>
-                        </label>
-                        <label for='pstorage_thread_poll'><b>Persistent Storage polling rate</b></label>
-                        <input type='text' id='pstorage_thread_poll' name='pstorage_thread_poll' value='""" + pstorage_poll + "'>"
-                    
-                    return_str += """
-                        <br>
-                        <br>
-                        <br>
-                        <label class="container">
-                            <b>Start OpenPLC in RUN mode</b>"""
-                            
-                    if (start_run == 'false'):
-                        return_str += """
-                            <input id="auto_run" type="checkbox">
-                            <span class="checkmark"></span>
-                        </label>
-                        <input type='hidden' value='false' id='auto_run_text' name='auto_run_text'/>"""
-                    else:
-                        return_str += """
-                            <input id="auto_run" type="checkbox" checked>
-                            <span class="checkmark"></span>
-                        </label>
-                        <input type='hidden' value='true' id='auto_run_text' name='auto_run_text'/>"""
-                    
-                    return_str += """
-                        <br>
-                        <h2>Slave Devices</h2>
-                        <label for='slave_polling_period'><b>Polling Period (ms)</b></label>
-                        <input type='text' id='slave_polling_period' name='slave_polling_period' value='""" + slave_polling + "'>"
+            settings = get_settings()
+            modbus_port = settings.get('Modbus_port')
+            dnp3_port = settings.get('Dnp3_port')
+            enip_port = settings.get('Enip_port')
+            pstorage_poll = settings.get('Pstorage_polling')
+            start_run = settings.get('Start_run_mode')
+            slave_polling = settings.get('Slave_polling')
+            slave_timeout = settings.get('Slave_timeout')
+            
+            if (modbus_port == 'disabled'):
+                return_str += """
+                    <input id="modbus_server" type="checkbox">
+                    <span class="checkmark"></span>
+                </label>
+                <label for='modbus_server_port'><b>Modbus Server Port</b></label>
+                <input type='text' id='modbus_server_port' name='modbus_server_port' value='502'>"""
+            else:
+                return_str += """
+                    <input id="modbus_server" type="checkbox" checked>
+                    <span class="checkmark"></span>
+                </label>
+                <label for='modbus_server_port'><b>Modbus Server Port</b></label>
+                <input type='text' id='modbus_server_port' name='modbus_server_port' value='""" + modbus_port + "'>"
+                
+            return_str += """
+                <br>
+                <br>
+                <br>
+                <label class="container">
+                    <b>Enable DNP3 Server</b>"""
+            
+            if (dnp3_port == 'disabled'):
+                return_str += """
+                    <input id="dnp3_server" type="checkbox">
+                    <span class="checkmark"></span>
+                </label>
+                <label for='dnp3_server_port'><b>DNP3 Server Port</b></label>
+                <input type='text' id='dnp3_server_port' name='dnp3_server_port' value='20000'>"""
+            else:
+                return_str += """
+                    <input id="dnp3_server" type="checkbox" checked>
+                    <span class="checkmark"></span>
+                </label>
+                <label for='dnp3_server_port'><b>DNP3 Server Port</b></label>
+                <input type='text' id='dnp3_server_port' name='dnp3_server_port' value='""" + dnp3_port + "'>"
+            
+            return_str += """
+                <br>
+                <br>
+                <br>
+                <label class="container">
+                    <b>Enable EtherNet/IP Server</b>"""
                     
-                    return_str += """
-                        <br>
-                        <br>
-                        <br>
-                        <label for='slave_timeout'><b>Timeout (ms)</b></label>
-                        <input type='text' id='slave_timeout' name='slave_timeout' value='""" + slave_timeout + "'>"
+            if (enip_port == 'disabled'):
+                return_str += """
+                    <input id="enip_server" type="checkbox">
+                    <span class="checkmark"></span>
+                </label>
+                <label for='enip_server_port'><b>EtherNet/IP Server Port</b></label>
+                <input type='text' id='enip_server_port' name='enip_server_port' value='44818'>"""
+            else:
+                return_str += """
+                    <input id="enip_server" type="checkbox" checked>
+                    <span class="checkmark"></span>
+                </label>
+                <label for='enip_server_port'><b>EtherNet/IP Server Port</b></label>
+                <input type='text' id='enip_server_port' name='enip_server_port' value='""" + enip_port + "'>"
+            
+            return_str += """
+                <br>
+                <br>
+                <br>
+                <label class="container">
+                    <b>Enable Persistent Storage Thread</b>"""
                     
-                    return_str += pages.settings_tail
+            if (pstorage_poll == 'disabled'):
+                return_str += """
+                    <input id="pstorage_thread" type="checkbox">
+                    <span class="checkmark"></span>
+                </label>
+                <label for='pstorage_thread_poll'><b>Persistent Storage polling rate</b></label>
+                <input type='text' id='pstorage_thread_poll' name='pstorage_thread_poll' value='10'>"""
+            else:
+                return_str += """
+                    <input id="pstorage_thread" type="checkbox" checked>
+                    <span class="checkmark"></span>
+                </label>
+                <label for='pstorage_thread_poll'><b>Persistent Storage polling rate</b></label>
+                <input type='text' id='pstorage_thread_poll' name='pstorage_thread_poll' value='""" + pstorage_poll + "'>"
+            
+            return_str += """
+                <br>
+                <br>
+                <br>
+                <label class="container">
+                    <b>Start OpenPLC in RUN mode</b>"""
                     
-                except Error as e:
-                    return_str += "error connecting to the database" + str(e)
+            if (start_run == 'false'):
+                return_str += """
+                    <input id="auto_run" type="checkbox">
+                    <span class="checkmark"></span>
+                </label>
+                <input type='hidden' value='false' id='auto_run_text' name='auto_run_text'/>"""
             else:
-                return_str += "Error opening DB"
+                return_str += """
+                    <input id="auto_run" type="checkbox" checked>
+                    <span class="checkmark"></span>
+                </label>
+                <input type='hidden' value='true' id='auto_run_text' name='auto_run_text'/>"""
+            
+            return_str += """
+                <br>
+                <h2>Slave Devices</h2>
+                <label for='slave_polling_period'><b>Polling Period (ms)</b></label>
+                <input type='text' id='slave_polling_period' name='slave_polling_period' value='""" + slave_polling + "'>"
+            
+            return_str += """
+                <br>
+                <br>
+                <br>
+                <label for='slave_timeout'><b>Timeout (ms)</b></label>
+                <input type='text' id='slave_timeout' name='slave_timeout' value='""" + slave_timeout + "'>"
+            
+            return_str += static_chunk('settings_tail')
 
             return return_str
 
@@ -2339,7 +2744,8 @@ def settings():
                     
                     cur.close()
                     conn.close()
-                    configure_runtime()
+                    reload_settings()
+                    run_runtime_task(configure_runtime)
                     generate_mbconfig()
                     return flask.redirect(flask.url_for('dashboard'))
                     
@@ -2364,20 +2770,274 @@ def logout():
 def unauthorized_handler():
     return 'Unauthorized'
     
+#----------------------------------------------------------------------------
+#Keeps idle SQLite connections around so that a query doesn't have to open
+#the database file, parse the schema and prepare its statements again.
+#Connections are opened in WAL mode, so readers don't block on a writer, and
+#wait on a busy database instead of failing right away.
+#----------------------------------------------------------------------------
+class ConnectionPool:
+   def __init__(self, db_file, max_idle=8, busy_timeout=5.0):
+      self.db_file = db_file
+      self.max_idle = max_idle
+      self.busy_timeout = busy_timeout
+      self.idle = []
+      self.lock = threading.Lock()
+
+   def acquire(self):
+      with self.lock:
+         if self.idle:
+            return self.idle.pop()
+      conn = sqlite3.connect(self.db_file, timeout=self.busy_timeout, check_same_thread=False)
+      conn.execute("PRAGMA journal_mode=WAL")
+      conn.execute("PRAGMA synchronous=NORMAL")
+      return conn
+
+   def release(self, conn):
+      try:
+         #same as closing it: whatever wasn't committed is dropped
+         conn.rollback()
+      except Error:
+         conn.close()
+         return
+      with self.lock:
+         if len(self.idle) < self.max_idle:
+            self.idle.append(conn)
+            return
+      conn.close()
+
+
+#----------------------------------------------------------------------------
+#Connection handed out by create_connection. Works like the sqlite3 one,
+#but close() gives it back to the pool. Only used by one thread at a time.
+#----------------------------------------------------------------------------
+class PooledConnection:
+   def __init__(self, pool, conn):
+      self._pool = pool
+      self._conn = conn
+
+   def __getattr__(self, name):
+      if self._conn is None:
+         raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+      return getattr(self._conn, name)
+
+   def close(self):
+      if self._conn is not None:
+         conn = self._conn
+         self._conn = None
+         self._pool.release(conn)
+
+
+db_pools = {}
+db_pools_lock = threading.Lock()
+
 #----------------------------------------------------------------------------
 #Creates a connection with the SQLite database.
 #----------------------------------------------------------------------------
 """ Create a connection to the database file """
 def create_connection(db_file):
    try:
-      conn = sqlite3.connect(db_file)
-      return conn
+      with db_pools_lock:
+         if db_file not in db_pools:
+            db_pools[db_file] = ConnectionPool(db_file)
+         pool = db_pools[db_file]
+      return PooledConnection(pool, pool.acquire())
    except Error as e:
       print(e)
 
    return None
 
 
+#----------------------------------------------------------------------------
+#Snapshot of the Settings table with typed accessors. A snapshot is never
+#modified, reload_settings() builds a new one and swaps it in as a whole.
+#----------------------------------------------------------------------------
+class PLCSettings:
+   defaults = {'Modbus_port': '502', 'Dnp3_port': '20000', 'Enip_port': '44818',
+               'Pstorage_polling': 'disabled', 'Start_run_mode': 'false',
+               'Slave_polling': '100', 'Slave_timeout': '1000'}
+
+   def __init__(self, values):
+      self.values = dict(self.defaults)
+      self.values.update(values)
+
+   def get(self, key):
+      return self.values.get(key)
+
+   def is_enabled(self, key):
+      return self.values.get(key) != 'disabled'
+
+   def get_int(self, key):
+      """ Integer value of key, None if disabled. Bad values fall back to the default """
+      if not self.is_enabled(key):
+         return None
+      try:
+         return int(self.values[key])
+      except (KeyError, TypeError, ValueError):
+         return int(self.defaults[key])
+
+   def modbus_port(self):
+      return self.get_int('Modbus_port')
+
+   def dnp3_port(self):
+      return self.get_int('Dnp3_port')
+
+   def enip_port(self):
+      return self.get_int('Enip_port')
+
+   def pstorage_polling(self):
+      return self.get_int('Pstorage_polling')
+
+   def start_run_mode(self):
+      return self.values.get('Start_run_mode') == 'true'
+
+   def slave_polling(self):
+      return self.get_int('Slave_polling')
+
+   def slave_timeout(self):
+      return self.get_int('Slave_timeout')
+
+
+plc_settings = None
+plc_settings_lock = threading.Lock()
+
+#----------------------------------------------------------------------------
+#Reads the Settings table into a new snapshot. If the database can't be
+#read the previous snapshot is kept.
+#----------------------------------------------------------------------------
+def reload_settings():
+   global plc_settings
+   with plc_settings_lock:
+      conn = create_connection("openplc.db")
+      if (conn != None):
+         try:
+            cur = conn.cursor()
+            cur.execute("SELECT Key, Value FROM Settings")
+            rows = cur.fetchall()
+            cur.close()
+            conn.close()
+            plc_settings = PLCSettings({str(row[0]): str(row[1]) for row in rows})
+         except Error as e:
+            conn.close()
+            print("error connecting to the database" + str(e))
+      else:
+         print("Error opening DB")
+
+      if (plc_settings == None):
+         #Not cached, so the next call tries the database again
+         return PLCSettings({})
+      return plc_settings
+
+#----------------------------------------------------------------------------
+#Returns the current settings snapshot, loading it on first use.
+#----------------------------------------------------------------------------
+def get_settings():
+   current = plc_settings
+   if (current == None):
+      current = reload_settings()
+   return current
+
+
+#Server-sent event routes. They stay open for as long as the page is shown
+stream_paths = ('/runtime_logs_stream', '/monitor-stream', '/compilation-logs-stream')
+
+
+#----------------------------------------------------------------------------
+#Request handler for PooledWSGIServer. A request only holds a worker slot
+#while it runs, not while its connection waits for the next one, and a
+#connection left idle for keepalive_timeout seconds is closed. Live streams
+#take a stream slot instead of a worker slot, so open dashboards can't
+#starve the other pages. The timeout applies to every socket read and
+#write, so stalled clients are dropped too.
+#----------------------------------------------------------------------------
+class PooledRequestHandler(werkzeug.serving.WSGIRequestHandler):
+   protocol_version = 'HTTP/1.1'
+   timeout = 30.0
+   keepalive_timeout = 5.0
+   kept_alive = False
+
+   def handle_one_request(self):
+      if self.kept_alive:
+         (readable, writable, failed) = select.select([self.connection], [], [], self.keepalive_timeout)
+         if not readable:
+            self.close_connection = True
+            return
+      self.kept_alive = True
+      werkzeug.serving.WSGIRequestHandler.handle_one_request(self)
+
+   def run_wsgi(self):
+      if (urllib.parse.urlsplit(self.path).path in stream_paths):
+         slots = self.server.stream_slots
+         if not slots.acquire(blocking=False):
+            self.send_error(503, 'Too many live streams open')
+            return
+      else:
+         slots = self.server.request_slots
+         slots.acquire()
+      try:
+         werkzeug.serving.WSGIRequestHandler.run_wsgi(self)
+      finally:
+         slots.release()
+
+
+#----------------------------------------------------------------------------
+#WSGI server that serves every connection on its own thread, up to a fixed
+#number of connections. Past that, new connections wait in the listen backlog
+#instead of spawning more threads. Idle connections are closed after a few
+#seconds, so that wait stays short.
+#----------------------------------------------------------------------------
+class PooledWSGIServer(werkzeug.serving.BaseWSGIServer):
+   multithread = True
+   request_queue_size = 64
+
+   def __init__(self, host, port, app, workers, streams=16, connections=64):
+      werkzeug.serving.BaseWSGIServer.__init__(self, host, port, app, handler=PooledRequestHandler)
+      #every stream keeps a connection, leave room for the pages
+      connections = max(connections, workers + streams)
+      self.request_slots = threading.BoundedSemaphore(workers)
+      self.stream_slots = threading.BoundedSemaphore(streams)
+      self.free_connections = threading.BoundedSemaphore(connections)
+
+   def process_request(self, request, client_address):
+      self.free_connections.acquire()
+      #daemon, a live stream must not keep the process from exiting
+      thread = threading.Thread(target=self.process_request_thread, args=(request, client_address), name='http')
+      thread.daemon = True
+      thread.start()
+
+   def process_request_thread(self, request, client_address):
+      try:
+         self.finish_request(request, client_address)
+      except Exception:
+         self.handle_error(request, client_address)
+      finally:
+         self.shutdown_request(request)
+         self.free_connections.release()
+
+
+#----------------------------------------------------------------------------
+#Serves the web interface. OPENPLC_WEB_WORKERS sets how many requests run at
+#once, OPENPLC_WEB_STREAMS how many live log/monitoring streams can be open,
+#OPENPLC_WEB_CONNECTIONS how many connections are served at once,
+#OPENPLC_WEB_TIMEOUT the socket timeout and OPENPLC_WEB_KEEPALIVE how long
+#an idle connection is kept, in seconds.
+#OPENPLC_WEB_SERVER=development runs the Flask development server instead.
+#----------------------------------------------------------------------------
+def run_server(host='0.0.0.0', port=8080):
+   if (os.environ.get('OPENPLC_WEB_SERVER') == 'development'):
+      app.run(debug=False, host=host, threaded=True, port=port)
+      return
+
+   workers = int(os.environ.get('OPENPLC_WEB_WORKERS', '32'))
+   streams = int(os.environ.get('OPENPLC_WEB_STREAMS', '16'))
+   connections = int(os.environ.get('OPENPLC_WEB_CONNECTIONS', '64'))
+   PooledRequestHandler.timeout = float(os.environ.get('OPENPLC_WEB_TIMEOUT', '30'))
+   PooledRequestHandler.keepalive_timeout = float(os.environ.get('OPENPLC_WEB_KEEPALIVE', '5'))
+   server = PooledWSGIServer(host, port, app, workers, streams, connections)
+   print("Serving the web interface on port " + str(port) + " with " + str(workers) + " workers")
+   server.serve_forever()
+
+
 #----------------------------------------------------------------------------
 #Returns a generator that yields the sanitized arguments.
 #----------------------------------------------------------------------------
@@ -2435,24 +3095,19 @@ if __name__ == '__main__':
             openplc_runtime.project_name = str(row[1])
             openplc_runtime.project_description = str(row[2])
             openplc_runtime.project_file = str(row[3])
-            
-            cur.execute("SELECT * FROM Settings")
-            rows = cur.fetchall()
             cur.close()
+            check_openplc_db.checkIndexesPrograms(conn)
+            conn.commit()
             conn.close()
             
-            for row in rows:
-                if (row[0] == "Start_run_mode"):
-                    start_run = str(row[1])
-                    
-            if (start_run == 'true'):
+            if (get_settings().start_run_mode()):
                 print("Initializing OpenPLC in RUN mode...")
-                openplc_runtime.start_runtime()
-                time.sleep(1)
-                configure_runtime()
-                monitor.parse_st(openplc_runtime.project_file)
+                #The web interface comes up while the runtime is still starting
+                runtime_executor.submit(start_plc_program).add_done_callback(report_runtime_task)
             
-            app.run(debug=False, host='0.0.0.0', threaded=True, port=8080)
+            # Page handlers read the runtime status from this cache
+            openplc_runtime.start_status_poller(interval=1.0)
+            run_server(host='0.0.0.0', port=8080)
         
         except Error as e:
             print("error connecting to the database" + str(e))